@@ -0,0 +1,171 @@
+import argparse
+import csv
+import json
+import os
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col, first, sum, when, broadcast
+from pyspark.sql.types import StructType, StructField, StringType, FloatType, IntegerType
+
+from i94_ingest import fingerprint
+from i94_labels import load_valid_ports, city_port_mapping
+
+
+DEMOGRAPHICS_SCHEMA = StructType([
+    StructField("City", StringType()),
+    StructField("State", StringType()),
+    StructField("Median Age", FloatType()),
+    StructField("Male Population", IntegerType()),
+    StructField("Female Population", IntegerType()),
+    StructField("Total Population", IntegerType()),
+    StructField("Number of Veterans", IntegerType()),
+    StructField("Foreign-born", IntegerType()),
+    StructField("Average Household Size", FloatType()),
+    StructField("State Code", StringType()),
+    StructField("Race", StringType()),
+    StructField("Count", IntegerType())
+])
+
+# city level columns, repeated on every race row of a city in the CSV
+CITY_COLUMNS = {
+    "State": "state_name",
+    "Median Age": "median_age",
+    "Male Population": "male_pop",
+    "Female Population": "female_pop",
+    "Total Population": "total_pop",
+    "Number of Veterans": "veterans",
+    "Foreign-born": "foreign_born",
+    "Average Household Size": "avg_household_size"
+}
+
+# values of the Race column, pivoted into one count column each
+RACE_COLUMNS = {
+    "American Indian and Alaska Native": "native_american_pop",
+    "Asian": "asian_pop",
+    "Black or African-American": "black_pop",
+    "Hispanic or Latino": "hispanic_or_latino_pop",
+    "White": "white_pop"
+}
+
+SOURCE_NAME = "_source.json"
+
+
+def create_spark_session():
+    spark = SparkSession.builder.enableHiveSupport().getOrCreate()
+    return spark
+
+
+def is_up_to_date(demographics_fname, output_data):
+    '''
+    Returns True when output_data was built from the current version of demographics_fname
+    '''
+    source_fname = os.path.join(output_data, SOURCE_NAME)
+    if not os.path.exists(source_fname):
+        return False
+    with open(source_fname) as f:
+        return json.load(f) == fingerprint(demographics_fname)
+
+
+def build_demographics_dim(spark, demographics_fname, output_data, valid_ports=None, force=False):
+    '''
+    Builds the city demographics table, one row per (city, state_code) with the race counts as columns
+    Parameters:
+        - spark              : SparkSession
+        - demographics_fname : path to us-cities-demographics.csv
+        - output_data        : where to store the parquet table, as a single file
+        - valid_ports        : {port code: port name} dict used to map cities to city_code
+        - force              : rebuild even if the source file has not changed
+    Returns True when the table was rebuilt
+    '''
+    if not force and is_up_to_date(demographics_fname, output_data):
+        print("{} unchanged, demographics table is up to date".format(demographics_fname))
+        return False
+
+    if valid_ports is None:
+        valid_ports = load_valid_ports()
+
+    demo_df = spark.read.format("csv").option("delimiter", ";").option("header", "true") \
+        .schema(DEMOGRAPHICS_SCHEMA).load(demographics_fname)
+
+    # One row per city: the city level columns once, a count column per race
+    city_df = demo_df.groupBy(col("City").alias("city_name"), col("State Code").alias("state_code")) \
+        .agg(*[first(source).alias(name) for source, name in CITY_COLUMNS.items()],
+             *[sum(when(col("Race") == race, col("Count"))).cast("long").alias(name)
+               for race, name in RACE_COLUMNS.items()])
+
+    # Map full name to city port abbreviation on the distinct city names only,
+    # cities without a port are kept with a null city_code
+    cities = [row.city_name for row in city_df.select("city_name").collect()]
+    ports_df = city_port_mapping(spark, cities, valid_ports).withColumnRenamed("city", "city_name")
+    demographics_dim_df = city_df.join(broadcast(ports_df), "city_name", "left") \
+        .select("city_code", "state_code", "city_name", *CITY_COLUMNS.values(), *RACE_COLUMNS.values())
+
+    demographics_dim_df.coalesce(1).write.mode("overwrite").parquet(output_data)
+
+    with open(os.path.join(output_data, SOURCE_NAME), "w") as f:
+        json.dump(fingerprint(demographics_fname), f)
+    print("demographics table written to {}".format(output_data))
+    return True
+
+
+def read_demographics_dim(spark, input_data):
+    '''
+    Reads the prebuilt demographics table, small enough to be broadcast in joins
+    '''
+    return spark.read.parquet(input_data)
+
+
+def raw_totals(demographics_fname):
+    '''
+    Totals of the raw CSV computed without Spark: number of distinct cities, their
+    population and the count of every race
+    '''
+    cities = set()
+    totals = dict(total_pop=0, **{name: 0 for name in RACE_COLUMNS.values()})
+    with open(demographics_fname, encoding="utf8") as f:
+        for row in csv.DictReader(f, delimiter=";"):
+            if (row["City"], row["State Code"]) not in cities:
+                cities.add((row["City"], row["State Code"]))
+                totals["total_pop"] += int(row["Total Population"])
+            totals[RACE_COLUMNS[row["Race"]]] += int(row["Count"])
+    totals["cities"] = len(cities)
+    return totals
+
+
+def check_totals(spark, demographics_fname, input_data):
+    '''
+    Checks that the demographics table has one row per (city, state_code) and the same
+    population and race totals as the raw file
+    '''
+    expected = raw_totals(demographics_fname)
+    dim_df = read_demographics_dim(spark, input_data)
+    row = dim_df.agg(*[sum(name).alias(name) for name in ["total_pop"] + list(RACE_COLUMNS.values())]).first()
+    actual = dict(row.asDict(), cities=dim_df.count())
+    keys = dim_df.select("city_name", "state_code").distinct().count()
+
+    problems = ["{}: {} in the table, {} in {}".format(name, actual[name], expected[name], demographics_fname)
+                for name in expected if actual[name] != expected[name]]
+    if keys != actual["cities"]:
+        problems.append("{} rows for {} (city, state_code) keys".format(actual["cities"], keys))
+    if problems:
+        raise ValueError("Demographics check failed: {}".format("; ".join(problems)))
+    print("demographics check passed, {cities} cities, {total_pop} inhabitants".format(**expected))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the city demographics table")
+    parser.add_argument("--source", default="us-cities-demographics.csv")
+    parser.add_argument("--output", default="city_demographics_dim")
+    parser.add_argument("--labels", default="I94_SAS_Labels_Descriptions.SAS")
+    parser.add_argument("--force", action="store_true", help="rebuild even if the source is unchanged")
+    parser.add_argument("--check", action="store_true", help="compare the table totals with the raw file")
+    args = parser.parse_args()
+
+    spark = create_spark_session()
+    build_demographics_dim(spark, args.source, args.output, valid_ports=load_valid_ports(args.labels),
+                           force=args.force)
+    if args.check:
+        check_totals(spark, args.source, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col, expr, round, broadcast, dayofweek, weekofyear, month
+
+from i94_ingest import ingest, read_i94, fingerprint
+from i94_labels import load_valid_ports
+from temperature_dim import build_temperature_dim, read_temperature_dim
+from demographics_dim import build_demographics_dim, read_demographics_dim, RACE_COLUMNS
+
+
+STAGES = ["extract", "clean", "stage", "model", "quality"]
+
+FINGERPRINT_NAME = "_fingerprint.json"
+
+# percentage columns of staging_demo and the demographics count they are computed from
+DEMOGRAPHICS_PCT_COLUMNS = {
+    "pct_male_pop": "male_pop",
+    "pct_female_pop": "female_pop",
+    "pct_veterans": "veterans",
+    "pct_foreign_born": "foreign_born",
+    "pct_native_american": RACE_COLUMNS["American Indian and Alaska Native"],
+    "pct_asian": RACE_COLUMNS["Asian"],
+    "pct_black": RACE_COLUMNS["Black or African-American"],
+    "pct_hispanic_or_latino": RACE_COLUMNS["Hispanic or Latino"],
+    "pct_white": RACE_COLUMNS["White"]
+}
+
+
+# join the bucketed model tables without a shuffle, on their bucket column and any other keys
+BUCKETING_CONF = {
+    "spark.sql.sources.bucketing.enabled": "true",
+    "spark.sql.requireAllClusterKeysForCoPartition": "false",
+    "spark.sql.legacy.bucketedTableScan.outputOrdering": "true"
+}
+
+# model tables stored as Hive tables bucketed and sorted on the city join key: bucket columns, sort columns
+BUCKETED_TABLES = {
+    "immigration": (["city_code"], ["city_code", "date"]),
+    "cities": (["city_code"], ["city_code"]),
+    "monthly_city_temperatures": (["city_code"], ["city_code", "year", "month"])
+}
+
+
+def create_spark_session():
+    builder = SparkSession.builder.\
+    config("spark.jars.packages","saurfang:spark-sas7bdat:2.0.0-s_2.11")
+    for key, value in BUCKETING_CONF.items():
+        builder = builder.config(key, value)
+    spark = builder.enableHiveSupport().getOrCreate()
+    return spark
+
+
+def stage_path(args, stage, name=""):
+    return os.path.join(args.output, stage, name)
+
+
+def read_stage(spark, args, stage, name):
+    return spark.read.parquet(stage_path(args, stage, name))
+
+
+def write_stage(df, args, stage, name, *partition_columns):
+    writer = df.write.mode("overwrite")
+    if partition_columns:
+        writer = writer.partitionBy(*partition_columns)
+    writer.parquet(stage_path(args, stage, name))
+
+
+def write_bucketed(spark, df, args, name):
+    '''
+    Saves a model table as the Hive table <database>.<name>, in --buckets buckets sorted
+    on the columns of BUCKETED_TABLES, with its files under the model stage directory.
+    Tables with the same number of buckets on the join key are joined without a shuffle.
+    '''
+    bucket_columns, sort_columns = BUCKETED_TABLES[name]
+    spark.sql("CREATE DATABASE IF NOT EXISTS {}".format(args.database))
+    # one task per bucket, so every bucket is a single sorted file
+    df.repartition(args.buckets, *bucket_columns).write.mode("overwrite") \
+        .bucketBy(args.buckets, *bucket_columns).sortBy(*sort_columns) \
+        .option("path", os.path.abspath(stage_path(args, "model", name))) \
+        .saveAsTable("{}.{}".format(args.database, name))
+
+
+def read_model(spark, args, name):
+    '''
+    A model table, from the Hive metastore when it is bucketed so that its buckets are used
+    '''
+    if name in BUCKETED_TABLES:
+        return spark.table("{}.{}".format(args.database, name))
+    return read_stage(spark, args, "model", name)
+
+
+# EXTRACT
+
+def extract(spark, args):
+    '''
+    Converts the raw inputs into parquet: I94 partitioned by arrival year/month/state,
+    the prebuilt monthly temperature table and the city demographics table
+    '''
+    ingest(spark, args.i94_source, stage_path(args, "extract", "i94"))
+    valid_ports = load_valid_ports(args.labels)
+    build_temperature_dim(spark, args.temperature, stage_path(args, "extract", "temperature"),
+                          valid_ports=valid_ports)
+    build_demographics_dim(spark, args.demographics, stage_path(args, "extract", "demographics"),
+                           valid_ports=valid_ports)
+
+
+# CLEAN
+
+def clean(spark, args):
+    '''
+    Removes nulls and invalid states from the immigration data, keeps the temperatures of the
+    analysed year and computes the demographics percentages
+    '''
+    demo_df = read_demographics_dim(spark, stage_path(args, "extract", "demographics"))
+    valid_states = [row[0] for row in demo_df.select("state_code").distinct().collect()]
+
+    # Remove any missing values, only keep us related immigration data and
+    # convert arrival_date (SAS format, days since 1960-01-01) to a date
+    i94_df = read_i94(spark, stage_path(args, "extract", "i94"), year=args.year, month=args.month)
+    cleaned_i94_df = i94_df.dropna(how="any", subset=["i94port", "i94addr", "gender"]) \
+        .filter(col("i94addr").isin(valid_states)) \
+        .withColumn("arrdate", expr("date_add(to_date('1960-01-01'), cast(arrdate as int))"))
+    write_stage(cleaned_i94_df, args, "clean", "i94")
+
+    # Only use temperatures from the analysed year
+    cleaned_temp_df = read_temperature_dim(spark, stage_path(args, "extract", "temperature"), years=[args.temperature_year])
+    write_stage(cleaned_temp_df, args, "clean", "temperature")
+
+    # Keep the cities with a port and calculate percentages of the population counts,
+    # one row per city since the demographics table already has the races as columns
+    cleaned_demo_df = demo_df.filter(col("city_code").isNotNull()) \
+        .select("city_code", "city_name", "state_code", "median_age",
+                *[(col(count) / col("total_pop") * 100).alias(pct) for pct, count in DEMOGRAPHICS_PCT_COLUMNS.items()],
+                "total_pop")
+    write_stage(cleaned_demo_df, args, "clean", "demographics")
+
+
+# STAGE
+
+def stage(spark, args):
+    '''
+    Builds the staging tables staging_i94, staging_temp and staging_demo
+    '''
+    cleaned_i94_df = read_stage(spark, args, "clean", "i94")
+    staging_i94_df = cleaned_i94_df.select(col("cicid").alias("id"),
+                                           col("arrdate").alias("date"),
+                                           col("i94port").alias("city_code"),
+                                           col("i94addr").alias("state_code"),
+                                           col("i94bir").alias("age"),
+                                           col("gender").alias("gender"),
+                                           col("i94visa").alias("visa_type"),
+                                           "count").drop_duplicates()
+    write_stage(staging_i94_df, args, "stage", "staging_i94")
+
+    staging_temp_df = read_stage(spark, args, "clean", "temperature").drop_duplicates()
+    write_stage(staging_temp_df, args, "stage", "staging_temp")
+
+    cleaned_demo_df = read_stage(spark, args, "clean", "demographics")
+    staging_demo_df = cleaned_demo_df.select("city_code", "state_code", "city_name", "median_age",
+                                             *[round(col(pct), 1).alias(pct) for pct in DEMOGRAPHICS_PCT_COLUMNS],
+                                             "total_pop")
+    write_stage(staging_demo_df, args, "stage", "staging_demo")
+
+
+# MODEL
+
+def model(spark, args):
+    '''
+    Creates the dimension tables immigrants, cities, monthly_city_temperatures, time
+    and the fact table immigration. The fact and the city keyed dimensions are bucketed
+    Hive tables, see write_bucketed.
+    '''
+    staging_i94_df = read_stage(spark, args, "stage", "staging_i94")
+    staging_temp_df = read_stage(spark, args, "stage", "staging_temp")
+    staging_demo_df = read_stage(spark, args, "stage", "staging_demo")
+
+    immigrant_df = staging_i94_df.select("id", "gender", "age", "visa_type").drop_duplicates()
+    write_stage(immigrant_df, args, "model", "immigrants", "gender", "age")
+
+    # one row per city, the demographics side is broadcast instead of shuffling the temperatures
+    city_df = broadcast(staging_demo_df).join(staging_temp_df, "city_code") \
+        .select("city_code", "state_code", "city_name", "median_age", "pct_male_pop", "pct_female_pop", "pct_veterans",
+                "pct_foreign_born", "pct_native_american", "pct_asian", "pct_black",
+                "pct_hispanic_or_latino", "pct_white", "total_pop", "lat", "long").drop_duplicates()
+    write_bucketed(spark, city_df, args, "cities")
+
+    monthly_city_temp_df = staging_temp_df.select("city_code", "year", "month", "avg_temperature").drop_duplicates()
+    write_bucketed(spark, monthly_city_temp_df, args, "monthly_city_temperatures")
+
+    time_df = staging_i94_df.withColumn("dayofweek", dayofweek("date")) \
+        .withColumn("weekofyear", weekofyear("date")) \
+        .withColumn("month", month("date")) \
+        .select("date", "dayofweek", "weekofyear", "month").drop_duplicates()
+    write_stage(time_df, args, "model", "time")
+
+    immigration_df = staging_i94_df.select("id", "state_code", "city_code", "date", "count").drop_duplicates()
+    write_bucketed(spark, immigration_df, args, "immigration")
+
+
+# QUALITY
+
+MODEL_TABLES = ["immigrants", "cities", "monthly_city_temperatures", "time", "immigration"]
+
+
+def quality(spark, args):
+    '''
+    Checks that every dimension and fact table exists and contains records
+    '''
+    failing_tables = []
+    for table in MODEL_TABLES:
+        if not os.path.exists(stage_path(args, "model", table)):
+            failing_tables.append("{} (missing)".format(table))
+        elif read_model(spark, args, table).limit(1).count() == 0:
+            failing_tables.append("{} (empty)".format(table))
+
+    if failing_tables:
+        raise ValueError("Data quality check failed: {}".format(", ".join(failing_tables)))
+    print("data quality check passed, dimension tables and fact table contain records")
+
+
+STAGE_FUNCTIONS = {
+    "extract": extract,
+    "clean": clean,
+    "stage": stage,
+    "model": model,
+    "quality": quality
+}
+
+
+def stage_fingerprint(args, stage_name):
+    '''
+    Fingerprint of everything a stage depends on: the raw inputs and parameters for
+    extract, the fingerprint of the previous stage otherwise
+    '''
+    if stage_name == "extract":
+        inputs = {
+            "i94_source": fingerprint(args.i94_source),
+            "temperature": fingerprint(args.temperature),
+            "demographics": fingerprint(args.demographics),
+            "labels": fingerprint(args.labels)
+        }
+    else:
+        previous = STAGES[STAGES.index(stage_name) - 1]
+        inputs = {
+            previous: load_fingerprint(args, previous),
+            "year": args.year,
+            "month": args.month,
+            "temperature_year": args.temperature_year,
+            "buckets": args.buckets,
+            "database": args.database
+        }
+    payload = json.dumps({"stage": stage_name, "inputs": inputs}, sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def load_fingerprint(args, stage_name):
+    fingerprint_fname = stage_path(args, stage_name, FINGERPRINT_NAME)
+    if not os.path.exists(fingerprint_fname):
+        return None
+    with open(fingerprint_fname) as f:
+        return json.load(f)["fingerprint"]
+
+
+def save_fingerprint(args, stage_name, value, elapsed):
+    os.makedirs(stage_path(args, stage_name), exist_ok=True)
+    with open(stage_path(args, stage_name, FINGERPRINT_NAME), "w") as f:
+        json.dump({"fingerprint": value, "elapsed": elapsed}, f)
+
+
+def run(spark, args):
+    '''
+    Runs the stages in order. A stage is skipped when its fingerprint matches the one stored
+    with its persisted output, unless it comes at or after --from-stage.
+    Returns a list of (stage, status, seconds)
+    '''
+    timings = []
+    first_forced = STAGES.index(args.from_stage) if args.from_stage else len(STAGES)
+
+    for index, stage_name in enumerate(STAGES):
+        current = stage_fingerprint(args, stage_name)
+        if index < first_forced and load_fingerprint(args, stage_name) == current:
+            print("{}: inputs unchanged, skipping".format(stage_name))
+            timings.append((stage_name, "skipped", 0.0))
+            continue
+
+        print("{}: running".format(stage_name))
+        start = time.time()
+        STAGE_FUNCTIONS[stage_name](spark, args)
+        elapsed = time.time() - start
+        save_fingerprint(args, stage_name, current, elapsed)
+        print("{}: completed in {:.1f}s".format(stage_name, elapsed))
+        timings.append((stage_name, "ran", elapsed))
+
+    print()
+    print("{:<10} {:<8} {:>10}".format("stage", "status", "seconds"))
+    for stage_name, status, elapsed in timings:
+        print("{:<10} {:<8} {:>10.1f}".format(stage_name, status, elapsed))
+    return timings
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="City Immigration, Demographics and Temperatures ETL")
+    parser.add_argument("--i94-source", default="../../data/18-83510-I94-Data-2016/")
+    parser.add_argument("--temperature", default="../../data2/GlobalLandTemperaturesByCity.csv")
+    parser.add_argument("--demographics", default="us-cities-demographics.csv")
+    parser.add_argument("--labels", default="I94_SAS_Labels_Descriptions.SAS")
+    parser.add_argument("--output", default="output")
+    parser.add_argument("--year", type=int, default=2016, help="I94 arrival year to model")
+    parser.add_argument("--month", type=int, default=4, help="I94 arrival month to model")
+    parser.add_argument("--temperature-year", type=int, default=2013,
+                        help="temperature year to use (2013 is the latest year in the dataset)")
+    parser.add_argument("--buckets", type=int, default=16,
+                        help="buckets of the immigration, cities and monthly_city_temperatures tables")
+    parser.add_argument("--database", default="capstone", help="Hive database of the bucketed model tables")
+    parser.add_argument("--from-stage", choices=STAGES,
+                        help="rerun this stage and every later stage regardless of fingerprints")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    spark = create_spark_session()
+    run(spark, args)
+
+
+if __name__ == "__main__":
+    main()
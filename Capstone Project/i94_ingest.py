@@ -0,0 +1,204 @@
+import argparse
+import glob
+import json
+import os
+import time
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col
+
+
+# partition layout of the ingested I94 data: arrival year / month / state
+PARTITION_COLUMNS = ["i94yr", "i94mon", "i94addr"]
+
+# columns read by the staging step, everything else is pruned at scan time
+STAGING_COLUMNS = ["cicid", "arrdate", "i94port", "i94addr", "i94bir", "gender", "i94visa", "count"]
+
+MANIFEST_NAME = "_ingested.json"
+
+
+def create_spark_session():
+    spark = SparkSession.builder.\
+    config("spark.jars.packages","saurfang:spark-sas7bdat:2.0.0-s_2.11")\
+    .config("spark.sql.parquet.filterPushdown", "true")\
+    .enableHiveSupport().getOrCreate()
+    return spark
+
+
+def list_sources(source):
+    '''
+    Lists the monthly I94 inputs found at source
+    Parameters:
+        - source : a sas7bdat file, a directory of sas7bdat files or a parquet directory
+    '''
+    if os.path.isdir(source) and not glob.glob(os.path.join(source, "*.sas7bdat")):
+        # already converted parquet (e.g. sas_data) is ingested as a single source
+        return [source]
+    if os.path.isdir(source):
+        return sorted(glob.glob(os.path.join(source, "*.sas7bdat")))
+    return [source]
+
+
+def fingerprint(path):
+    '''
+    Returns a cheap fingerprint (size and modification time) of a file or directory
+    '''
+    files = [path] if os.path.isfile(path) else sorted(glob.glob(os.path.join(path, "*")))
+    stats = [os.stat(f) for f in files]
+    return {"size": sum(s.st_size for s in stats),
+            "mtime": max([s.st_mtime for s in stats] or [0])}
+
+
+def load_manifest(output_data):
+    manifest_fname = os.path.join(output_data, MANIFEST_NAME)
+    if not os.path.exists(manifest_fname):
+        return {}
+    with open(manifest_fname) as f:
+        return json.load(f)
+
+
+def save_manifest(output_data, manifest):
+    os.makedirs(output_data, exist_ok=True)
+    with open(os.path.join(output_data, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def read_source(spark, source):
+    '''
+    Reads one monthly I94 input, either raw SAS or parquet
+    '''
+    if source.endswith(".sas7bdat"):
+        return spark.read.format("com.github.saurfang.sas.spark").load(source)
+    return spark.read.parquet(source)
+
+
+def ingest_source(spark, source, output_data):
+    '''
+    Converts one monthly I94 input into parquet partitioned by arrival year, month and state.
+    Only the partitions present in the input are replaced (dynamic partition overwrite), so
+    re-ingesting a month never touches the other months.
+    Parameters:
+        - spark       : SparkSession
+        - source      : path to the monthly SAS file (or parquet directory)
+        - output_data : root of the partitioned parquet dataset
+    '''
+    df = read_source(spark, source)
+
+    df = df.withColumn("i94yr", col("i94yr").cast("int")) \
+        .withColumn("i94mon", col("i94mon").cast("int"))
+
+    # one writer per partition, rows sorted by the usual filter columns so that
+    # the row group min/max statistics are tight enough for predicate pushdown
+    overwrite_mode = spark.conf.get("spark.sql.sources.partitionOverwriteMode", "static")
+    spark.conf.set("spark.sql.sources.partitionOverwriteMode", "dynamic")
+    try:
+        df.repartition(*PARTITION_COLUMNS) \
+            .sortWithinPartitions("i94port", "arrdate") \
+            .write.mode("overwrite") \
+            .option("compression", "snappy") \
+            .partitionBy(*PARTITION_COLUMNS) \
+            .parquet(output_data)
+    finally:
+        spark.conf.set("spark.sql.sources.partitionOverwriteMode", overwrite_mode)
+
+
+def ingest(spark, source, output_data, force=False):
+    '''
+    Ingests every monthly I94 input that is new or changed since the last run
+    Parameters:
+        - spark       : SparkSession
+        - source      : sas7bdat file, directory of sas7bdat files or parquet directory
+        - output_data : root of the partitioned parquet dataset
+        - force       : re-ingest all inputs regardless of the manifest
+    Returns the list of inputs that were ingested
+    '''
+    manifest = load_manifest(output_data)
+    ingested = []
+
+    for source_fname in list_sources(source):
+        key = os.path.basename(os.path.normpath(source_fname))
+        current = fingerprint(source_fname)
+        if not force and manifest.get(key) == current:
+            print("{} unchanged, skipping".format(key))
+            continue
+
+        start = time.time()
+        ingest_source(spark, source_fname, output_data)
+        manifest[key] = current
+        save_manifest(output_data, manifest)
+        ingested.append(source_fname)
+        print("{} ingested in {:.1f}s".format(key, time.time() - start))
+
+    return ingested
+
+
+def read_i94(spark, input_data, columns=STAGING_COLUMNS, year=None, month=None, state=None):
+    '''
+    Reads the partitioned I94 parquet with column pruning and partition filters
+    Parameters:
+        - spark      : SparkSession
+        - input_data : root of the partitioned parquet dataset
+        - columns    : columns to read, None reads all of them
+        - year       : arrival year to keep (partition pruned)
+        - month      : arrival month to keep (partition pruned)
+        - state      : arrival state code to keep (partition pruned)
+    '''
+    df = spark.read.parquet(input_data)
+
+    if year is not None:
+        df = df.filter(col("i94yr") == year)
+    if month is not None:
+        df = df.filter(col("i94mon") == month)
+    if state is not None:
+        df = df.filter(col("i94addr") == state)
+
+    if columns:
+        df = df.select(*columns)
+    return df
+
+
+def benchmark_scan(spark, raw_data, partitioned_data, year, month, state, runs=3):
+    '''
+    Compares the scan time of a single month/state query on the raw input and on the partitioned parquet
+    '''
+    def raw_query():
+        df = read_source(spark, raw_data)
+        return df.filter((col("i94yr") == year) & (col("i94mon") == month) & (col("i94addr") == state)) \
+            .select(*STAGING_COLUMNS).count()
+
+    def partitioned_query():
+        return read_i94(spark, partitioned_data, year=year, month=month, state=state).count()
+
+    results = {}
+    for name, query in [("raw", raw_query), ("partitioned", partitioned_query)]:
+        timings = []
+        for _ in range(runs):
+            start = time.time()
+            rows = query()
+            timings.append(time.time() - start)
+        results[name] = min(timings)
+        print("{:<12} rows={:<8} best of {}: {:.3f}s".format(name, rows, runs, min(timings)))
+
+    print("speedup: {:.1f}x".format(results["raw"] / max(results["partitioned"], 1e-9)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert I94 SAS files into partitioned parquet")
+    parser.add_argument("--source", default="../../data/18-83510-I94-Data-2016/")
+    parser.add_argument("--output", default="i94_parquet")
+    parser.add_argument("--force", action="store_true", help="re-ingest every input")
+    parser.add_argument("--benchmark", nargs=3, metavar=("YEAR", "MONTH", "STATE"),
+                        help="compare a single month/state scan before and after ingestion")
+    args = parser.parse_args()
+
+    spark = create_spark_session()
+    ingest(spark, args.source, args.output, force=args.force)
+
+    if args.benchmark:
+        year, month, state = args.benchmark
+        raw_data = list_sources(args.source)[0]
+        benchmark_scan(spark, raw_data, args.output, int(year), int(month), state)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import re
+
+
+I94_SAS_LABELS_FNAME = "I94_SAS_Labels_Descriptions.SAS"
+
+re_compiled = re.compile(r"\'(.*)\'.*\'(.*)\'")
+
+
+def load_valid_ports(fname=I94_SAS_LABELS_FNAME):
+    '''
+    Parses the $i94prtl block of the SAS labels file into a {port code: port name} dict
+    '''
+    with open(fname) as f:
+        lines = f.readlines()
+
+    valid_ports = {}
+    in_block = False
+    for line in lines:
+        if "$i94prtl" in line:
+            in_block = True
+            continue
+        if in_block and line.strip().startswith(";"):
+            break
+        if in_block:
+            results = re_compiled.search(line)
+            if results:
+                valid_ports[results.group(1)] = results.group(2)
+    return valid_ports
+
+
+def city_to_port(city, valid_ports):
+    '''
+    Maps a city full name to its I94 port code, None when no port matches
+    '''
+    if not city:
+        return None
+    for key in valid_ports:
+        if city.lower() in valid_ports[key].lower():
+            return key
+    return None
+
+
+def city_port_mapping(spark, cities, valid_ports):
+    '''
+    Returns a small (city, city_code) DataFrame for the given city names.
+    The mapping is computed once on the driver for the distinct cities, so it can be
+    broadcast-joined instead of evaluating a python udf on every row.
+    '''
+    rows = [(city, city_to_port(city, valid_ports)) for city in sorted(set(cities))]
+    rows = [row for row in rows if row[1] is not None]
+    return spark.createDataFrame(rows, "city string, city_code string")
@@ -0,0 +1,140 @@
+"""
+Times the common analysis queries on the model tables stored as plain parquet
+(before) and as the bucketed, sorted Hive tables written by the model stage (after).
+
+The tables are either those of an etl.py run (--output, --database), or generated
+with --synthetic rows of immigration over 600 cities, skewed towards a few of them,
+so the benchmark runs without the I94 data. Broadcast joins are disabled unless
+--broadcast is given, as they would be for dimensions too large to broadcast.
+For each query the median time and the number of shuffles (Exchange
+hashpartitioning) in the physical plan are reported.
+
+    python model_benchmark.py --synthetic 5000000 --buckets 16
+    python model_benchmark.py --output output --database capstone
+"""
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from types import SimpleNamespace
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col, lit, rand, floor, pow, format_string, date_add, to_date
+
+from etl import BUCKETING_CONF, BUCKETED_TABLES, write_bucketed, read_model
+
+
+QUERIES = {
+    "arrivals by state x month with temperature": """
+        SELECT i.state_code, month(i.date) AS month, sum(i.count) AS arrivals,
+               round(avg(t.avg_temperature), 1) AS avg_temperature
+        FROM {immigration} i
+        JOIN {monthly_city_temperatures} t ON i.city_code = t.city_code AND month(i.date) = t.month
+        GROUP BY i.state_code, month(i.date)
+    """,
+    "arrivals by city with demographics": """
+        SELECT c.state_code, c.city_name, sum(i.count) AS arrivals, max(c.total_pop) AS total_pop
+        FROM {immigration} i
+        JOIN {cities} c ON i.city_code = c.city_code
+        GROUP BY c.state_code, c.city_name
+    """
+}
+
+
+def create_spark_session(broadcast=False):
+    builder = SparkSession.builder.appName("model_benchmark")
+    for key, value in BUCKETING_CONF.items():
+        builder = builder.config(key, value)
+    if not broadcast:
+        builder = builder.config("spark.sql.autoBroadcastJoinThreshold", "-1")
+    return builder.enableHiveSupport().getOrCreate()
+
+
+def synthetic_tables(spark, rows, cities=600, seed=42):
+    '''
+    immigration, cities and monthly_city_temperatures DataFrames with the columns of the model
+    '''
+    city_df = spark.range(cities).select(format_string("C%03d", col("id")).alias("city_code"),
+                                         format_string("S%02d", col("id") % 50).alias("state_code"),
+                                         format_string("City %d", col("id")).alias("city_name"),
+                                         (rand(seed) * 1000000).cast("long").alias("total_pop"))
+    temperature_df = spark.range(cities * 12).select(
+        format_string("C%03d", col("id") % cities).alias("city_code"),
+        lit(2013).alias("year"),
+        (floor(col("id") / cities) + 1).cast("int").alias("month"),
+        (rand(seed) * 30).cast("float").alias("avg_temperature"))
+    # a few cities get most of the arrivals
+    city_id = floor(pow(rand(seed), 3) * cities)
+    immigration_df = spark.range(rows).select(
+        col("id").cast("double").alias("id"),
+        format_string("S%02d", city_id % 50).alias("state_code"),
+        format_string("C%03d", city_id).alias("city_code"),
+        date_add(to_date(lit("2016-01-01")), (rand(seed + 1) * 366).cast("int")).alias("date"),
+        lit(1.0).alias("count"))
+    return {"immigration": immigration_df, "cities": city_df, "monthly_city_temperatures": temperature_df}
+
+
+def shuffles(df):
+    plan = df._jdf.queryExecution().executedPlan().toString()
+    return plan.count("Exchange hashpartitioning")
+
+
+def time_query(spark, query, tables, repeat):
+    '''
+    Median seconds of the query on the tables {name: table or view name}, and its shuffles
+    '''
+    df = spark.sql(query.format(**tables))
+    runs = []
+    for _ in range(repeat):
+        start = time.time()
+        df.collect()
+        runs.append(time.time() - start)
+    return statistics.median(runs), shuffles(df)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the model queries before and after bucketing")
+    parser.add_argument("--output", help="output directory of an etl.py run, with its bucketed model tables")
+    parser.add_argument("--database", default="capstone", help="Hive database of the bucketed model tables")
+    parser.add_argument("--synthetic", type=int, metavar="ROWS", help="generate ROWS immigration rows instead")
+    parser.add_argument("--buckets", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--broadcast", action="store_true", help="let Spark broadcast the dimensions")
+    args = parser.parse_args()
+    if not args.output and not args.synthetic:
+        parser.error("one of --output or --synthetic is required")
+
+    spark = create_spark_session(args.broadcast)
+    workdir = tempfile.mkdtemp(prefix="capstone-model-")
+    try:
+        if args.synthetic:
+            # bucketed tables written by the model stage code, under workdir
+            model_args = SimpleNamespace(output=workdir, buckets=args.buckets, database="capstone_benchmark")
+            for name, df in synthetic_tables(spark, args.synthetic).items():
+                write_bucketed(spark, df, model_args, name)
+        else:
+            model_args = SimpleNamespace(output=args.output, database=args.database)
+
+        plain, bucketed = {}, {}
+        for name in BUCKETED_TABLES:
+            bucketed[name] = "{}.{}".format(model_args.database, name)
+            path = os.path.join(workdir, "plain", name)
+            read_model(spark, model_args, name).write.mode("overwrite").parquet(path)
+            spark.read.parquet(path).createOrReplaceTempView("plain_" + name)
+            plain[name] = "plain_" + name
+
+        print("{:<46}{:>10}{:>10}{:>10}{:>10}".format("query", "before s", "shuffles", "after s", "shuffles"))
+        for name, query in QUERIES.items():
+            before, before_shuffles = time_query(spark, query, plain, args.repeat)
+            after, after_shuffles = time_query(spark, query, bucketed, args.repeat)
+            print("{:<46}{:>10.2f}{:>10}{:>10.2f}{:>10}".format(name, before, before_shuffles, after, after_shuffles))
+    finally:
+        if args.synthetic:
+            spark.sql("DROP DATABASE IF EXISTS capstone_benchmark CASCADE")
+        spark.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
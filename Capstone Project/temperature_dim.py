@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col, year, month, avg, first, round, broadcast
+from pyspark.sql.types import StructType, StructField, DateType, FloatType, StringType
+
+from i94_ingest import fingerprint
+from i94_labels import load_valid_ports, city_port_mapping
+
+
+TEMPERATURE_SCHEMA = StructType([
+    StructField("dt", DateType()),
+    StructField("AverageTemperature", FloatType()),
+    StructField("AverageTemperatureUncertainty", FloatType()),
+    StructField("City", StringType()),
+    StructField("Country", StringType()),
+    StructField("Latitude", StringType()),
+    StructField("Longitude", StringType())
+])
+
+SOURCE_NAME = "_source.json"
+
+
+def create_spark_session():
+    spark = SparkSession.builder.enableHiveSupport().getOrCreate()
+    return spark
+
+
+def is_up_to_date(temperature_fname, output_data):
+    '''
+    Returns True when output_data was built from the current version of temperature_fname
+    '''
+    source_fname = os.path.join(output_data, SOURCE_NAME)
+    if not os.path.exists(source_fname):
+        return False
+    with open(source_fname) as f:
+        return json.load(f) == fingerprint(temperature_fname)
+
+
+def build_temperature_dim(spark, temperature_fname, output_data, valid_ports=None, force=False):
+    '''
+    Builds the city x year x month average temperature table for US cities
+    Parameters:
+        - spark             : SparkSession
+        - temperature_fname : path to GlobalLandTemperaturesByCity.csv
+        - output_data       : where to store the parquet table, partitioned by year
+        - valid_ports       : {port code: port name} dict used to map cities to city_code
+        - force             : rebuild even if the source file has not changed
+    Returns True when the table was rebuilt
+    '''
+    if not force and is_up_to_date(temperature_fname, output_data):
+        print("{} unchanged, temperature table is up to date".format(temperature_fname))
+        return False
+
+    if valid_ports is None:
+        valid_ports = load_valid_ports()
+
+    temperature_df = spark.read.format("csv").option("delimiter", ",").option("header", "true") \
+        .schema(TEMPERATURE_SCHEMA).load(temperature_fname)
+
+    # Only use temperatures from United States
+    us_temp_df = temperature_df.filter(col("Country") == "United States") \
+        .dropna(how="any", subset=["AverageTemperature"])
+
+    # Map full name to city port abbreviation on the distinct city names only
+    cities = [row.City for row in us_temp_df.select("City").distinct().collect()]
+    ports_df = city_port_mapping(spark, cities, valid_ports)
+
+    monthly_temp_df = us_temp_df.join(broadcast(ports_df), us_temp_df["City"] == ports_df["city"]) \
+        .groupBy("city_code", year("dt").alias("year"), month("dt").alias("month")) \
+        .agg(round(avg("AverageTemperature"), 1).alias("avg_temperature"),
+             first("Latitude").alias("lat"),
+             first("Longitude").alias("long"))
+
+    monthly_temp_df.coalesce(1).write.mode("overwrite").partitionBy("year").parquet(output_data)
+
+    with open(os.path.join(output_data, SOURCE_NAME), "w") as f:
+        json.dump(fingerprint(temperature_fname), f)
+    print("temperature table written to {}".format(output_data))
+    return True
+
+
+def read_temperature_dim(spark, input_data, years=None):
+    '''
+    Reads the prebuilt temperature table, keeping only the given years (partition pruned)
+    '''
+    df = spark.read.parquet(input_data)
+    if years:
+        df = df.filter(col("year").isin(list(years)))
+    return df.select("year", "month", "city_code", "avg_temperature", "lat", "long")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the monthly city temperature table")
+    parser.add_argument("--source", default="../../data2/GlobalLandTemperaturesByCity.csv")
+    parser.add_argument("--output", default="monthly_city_temperatures_dim")
+    parser.add_argument("--force", action="store_true", help="rebuild even if the source is unchanged")
+    args = parser.parse_args()
+
+    spark = create_spark_session()
+    build_temperature_dim(spark, args.source, args.output, force=args.force)
+
+
+if __name__ == "__main__":
+    main()
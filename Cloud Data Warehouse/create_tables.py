@@ -1,7 +1,11 @@
 import configparser
-import psycopg2
+import os
+import sys
 from sql_queries import create_table_queries, drop_table_queries
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from sparkify import db
+
 """droping database tables from drop_table_queries"""
 
 def drop_tables(cur, conn):
@@ -24,7 +28,7 @@ def main():
     config.read('dwh.cfg')
     
     print('Connecting to redshift')
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    conn = db.connect(db.config_dsn(config['CLUSTER']))
     print('Connected to redshift')
     cur = conn.cursor()
     
@@ -1,18 +1,36 @@
 import configparser
-import psycopg2
+import os
+import re
+import sys
+import maintenance
 from sql_queries import copy_table_queries, insert_table_queries
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from sparkify import db, metrics
+
+"""name of the table loaded by a COPY or INSERT statement"""
+TABLE_PATTERN = re.compile(r"(?:COPY|INSERT\s+INTO)\s+(\w+)", re.IGNORECASE)
+
+def table_name(query):
+    match = TABLE_PATTERN.search(query)
+    return match.group(1) if match else "unknown"
+
 """Loading data from S3 bucket to Redshift"""
 def load_staging_tables(cur, conn):
     for query in copy_table_queries:
-        cur.execute(query)
-        conn.commit()
+        with metrics.stage("redshift.copy", table=table_name(query)) as record:
+            cur.execute(query)
+            cur.execute("SELECT pg_last_copy_count()")
+            record.rows += cur.fetchone()[0]
+            conn.commit()
 
 """INSERT data from staging table to FACT AND DIMENSION TABLE"""
 def insert_tables(cur, conn):
     for query in insert_table_queries:
-        cur.execute(query)
-        conn.commit()
+        with metrics.stage("redshift.insert", table=table_name(query)) as record:
+            cur.execute(query)
+            record.rows += max(cur.rowcount, 0)
+            conn.commit()
 
 
 def main():
@@ -20,7 +38,7 @@ def main():
     config.read('dwh.cfg')
     
     print('Connecting to redshift')
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    conn = db.connect(db.config_dsn(config['CLUSTER']))
     print('Connected to redshift')
     cur = conn.cursor()
     
@@ -29,6 +47,9 @@ def main():
     
     print('INSERTING from staging')
     insert_tables(cur, conn)
+
+    print('Maintaining fact and dimension tables')
+    maintenance.print_report(maintenance.maintain(conn))
     
     print('ETL Process Completed')
     conn.close()
@@ -0,0 +1,199 @@
+"""
+Post-load maintenance of the star schema, run by etl.py after insert_tables.
+
+- reads the per-table statistics of SVV_TABLE_INFO: rows, size, % unsorted, % stale statistics
+- for tables stored without encodings, runs ANALYZE COMPRESSION and writes the
+  recommended encodings to encodings.json, which sql_queries.py adds to the
+  CREATE TABLE statements of the next create_tables.py run
+- runs VACUUM SORT ONLY on the tables more unsorted than --unsorted-threshold and
+  ANALYZE on those with more stale statistics than --stale-threshold
+- times a scan of every table before and after, and reports the storage, sort,
+  statistics and scan-time deltas
+
+The system views and commands are those of Redshift; standin.py fakes them in Postgres.
+
+    python maintenance.py --unsorted-threshold 5 --stale-threshold 10
+"""
+import argparse
+import configparser
+import json
+import os
+import re
+import statistics
+import sys
+import time
+
+from sql_queries import ENCODINGS_FILE, create_table_queries, read_encodings
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from sparkify import db, metrics
+
+FACT_AND_DIMENSION_TABLES = ['songplay', 'users', 'songs', 'artists', 'time']
+
+table_info_select = ("""
+SELECT "table", tbl_rows, size, unsorted, stats_off, encoded
+FROM svv_table_info
+WHERE "schema" = 'public' AND "table" IN %s
+""")
+
+"""Maintenance commands of Redshift"""
+REDSHIFT = {
+    "session": ["SET enable_result_cache_for_session TO off"],
+    "compression": "ANALYZE COMPRESSION {table}",
+    "vacuum": "VACUUM SORT ONLY {table} TO 100 PERCENT",
+    "analyze": "ANALYZE {table}"
+}
+
+
+def sort_keys():
+    """sort key column of each table, from the sortkey attribute of its CREATE TABLE"""
+    keys = {}
+    for query in create_table_queries:
+        table = re.search(r"CREATE TABLE IF NOT EXISTS (\w+)", query).group(1)
+        for line in query.splitlines():
+            if re.search(r"\bsortkey\b", line, re.IGNORECASE):
+                keys[table] = line.split()[0]
+    return keys
+
+
+def table_info(cur, tables):
+    """rows, size in MB, % unsorted, % stale statistics and whether columns are encoded, per table"""
+    cur.execute(table_info_select, (tuple(tables),))
+    return {table: {"rows": rows, "size_mb": size, "unsorted": float(unsorted) if unsorted is not None else None,
+                    "stats_off": float(stats_off) if stats_off is not None else None, "encoded": encoded}
+            for table, rows, size, unsorted, stats_off, encoded in cur.fetchall()}
+
+
+def scan_query(cur, table, sort_key):
+    """
+    A count over the first tenth of the sort key range, which sorting lets Redshift
+    answer from few blocks, or over the whole table without a sort key
+    """
+    if not sort_key:
+        return "SELECT count(*) FROM {}".format(table), None
+    cur.execute("SELECT min({0}), max({0}) FROM {1}".format(sort_key, table))
+    low, high = cur.fetchone()
+    if low is None:
+        return "SELECT count(*) FROM {}".format(table), None
+    return "SELECT count(*) FROM {} WHERE {} >= %s AND {} <= %s".format(table, sort_key, sort_key), \
+        (low, low + (high - low) / 10)
+
+
+def time_scans(cur, tables, keys, repeat):
+    """median milliseconds of the scan query of every table"""
+    timings = {}
+    for table in tables:
+        query, params = scan_query(cur, table, keys.get(table))
+        runs = []
+        for _ in range(repeat):
+            start = time.time()
+            cur.execute(query, params)
+            cur.fetchall()
+            runs.append((time.time() - start) * 1000)
+        timings[table] = statistics.median(runs)
+    return timings
+
+
+def recommend_encodings(cur, tables, commands):
+    """encodings recommended by ANALYZE COMPRESSION, table -> column -> encoding"""
+    encodings = {}
+    for table in tables:
+        cur.execute(commands["compression"].format(table=table))
+        for table_name, column, encoding, reduction in cur.fetchall():
+            encodings.setdefault(table_name, {})[column] = encoding
+            print("    {}.{}: {} ({}% smaller)".format(table_name, column, encoding, reduction))
+    return encodings
+
+
+def maintain(conn, unsorted_threshold=5.0, stale_threshold=10.0, repeat=3, commands=REDSHIFT,
+             tables=FACT_AND_DIMENSION_TABLES, encodings_file=ENCODINGS_FILE):
+    """
+    Vacuums, analyzes and recommends encodings for the tables, see the module docstring
+    Returns per table the statistics and scan times before and after, and the actions taken
+    """
+    autocommit = conn.autocommit
+    # VACUUM cannot run inside a transaction block
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        for statement in commands["session"]:
+            cur.execute(statement)
+
+        keys = sort_keys()
+        before = table_info(cur, tables)
+        scans_before = time_scans(cur, tables, keys, repeat)
+
+        unencoded = [table for table in tables if before.get(table, {}).get("encoded", "Y").startswith("N")]
+        if unencoded:
+            print("Recommending encodings for {}".format(", ".join(unencoded)))
+            encodings = read_encodings(encodings_file)
+            encodings.update(recommend_encodings(cur, unencoded, commands))
+            with open(encodings_file, "w") as f:
+                json.dump(encodings, f, indent=4, sort_keys=True)
+            print("Encodings written to {}, run create_tables.py and etl.py to apply them".format(encodings_file))
+
+        actions = {}
+        for table in tables:
+            info = before.get(table)
+            if info is None:
+                continue
+            actions[table] = []
+            with metrics.stage("redshift.maintenance", table=table) as record:
+                if keys.get(table) and (info["unsorted"] or 0) > unsorted_threshold:
+                    cur.execute(commands["vacuum"].format(table=table))
+                    actions[table].append("vacuum sort")
+                if info["stats_off"] is None or info["stats_off"] > stale_threshold:
+                    cur.execute(commands["analyze"].format(table=table))
+                    actions[table].append("analyze")
+                record.extra["actions"] = actions[table]
+
+        after = table_info(cur, tables)
+        scans_after = time_scans(cur, tables, keys, repeat)
+    finally:
+        conn.autocommit = autocommit
+
+    return {table: {"before": before[table], "after": after.get(table, {}), "actions": actions[table],
+                    "scan_ms_before": scans_before[table], "scan_ms_after": scans_after[table]}
+            for table in actions}
+
+
+def print_report(report):
+    def change(before, after, unit=""):
+        if before is None or after is None:
+            return "{} -> {}".format(before, after)
+        return "{:.1f}{unit} -> {:.1f}{unit}".format(float(before), float(after), unit=unit)
+
+    for table, result in report.items():
+        before, after = result["before"], result["after"]
+        print("{}: {} ({} rows)".format(table, ", ".join(result["actions"]) or "nothing to do", before["rows"]))
+        print("    size      {}".format(change(before["size_mb"], after.get("size_mb"), " MB")))
+        print("    unsorted  {}".format(change(before["unsorted"], after.get("unsorted"), "%")))
+        print("    stats off {}".format(change(before["stats_off"], after.get("stats_off"), "%")))
+        print("    scan      {}".format(change(result["scan_ms_before"], result["scan_ms_after"], " ms")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vacuum, analyze and recommend encodings after a load")
+    parser.add_argument("--unsorted-threshold", type=float, default=5.0, help="% unsorted rows that triggers VACUUM SORT")
+    parser.add_argument("--stale-threshold", type=float, default=10.0, help="% stale statistics that triggers ANALYZE")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each scan query")
+    parser.add_argument("--standin", metavar="DSN", help="run against the Postgres stand-in of standin.py")
+    args = parser.parse_args()
+
+    if args.standin:
+        import standin
+        conn = db.connect(args.standin)
+        commands = standin.STANDIN
+    else:
+        config = configparser.ConfigParser()
+        config.read('dwh.cfg')
+        conn = db.connect(db.config_dsn(config['CLUSTER']))
+        commands = REDSHIFT
+
+    report = maintain(conn, args.unsorted_threshold, args.stale_threshold, args.repeat, commands)
+    print_report(report)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
 import configparser
+import json
+import os
+import re
 
 
 # CONFIG
@@ -6,9 +9,8 @@ config = configparser.ConfigParser()
 config.read('dwh.cfg')
 
 IAM_ROLE        = config.get('IAM_ROLE', 'ARN')
-LOG_DATA        = config.get('S3', 'LOG_DATA')
-LOG_PATH        = config.get('S3', 'LOG_JSONPATH')
-SONG_DATA       = config.get('S3', 'SONG_DATA')
+LOG_PARQUET     = config.get('S3', 'LOG_PARQUET')
+SONG_PARQUET    = config.get('S3', 'SONG_PARQUET')
 
 # DROP TABLES
 
@@ -124,23 +126,26 @@ weekday       INTEGER
 
 
 # STAGING TABLES
+# parquet written by sparkify/prestage.py from LOG_DATA and SONG_DATA, typed like the
+# staging tables, columns in table order (the IDENTITY event_id is left out)
 
 staging_events_copy = ("""
-    COPY staging_events FROM {}
+    COPY staging_events (artist, auth, firstName, gender, itemInSession, lastName, length, level, location,
+                         method, page, registration, sessionId, song, status, ts, userAgent, userId)
+    FROM {}
     CREDENTIALS 'aws_iam_role={}'
     COMPUPDATE OFF region 'us-west-2'
-    TIMEFORMAT as 'epochmillisecs'
     STATUPDATE ON
-    FORMAT AS JSON {};
-""").format(LOG_DATA, IAM_ROLE, LOG_PATH)
+    FORMAT AS PARQUET;
+""").format(LOG_PARQUET, IAM_ROLE)
 
 staging_songs_copy = ("""
     COPY staging_songs FROM {}
     CREDENTIALS 'aws_iam_role={}'
     COMPUPDATE OFF region 'us-west-2'
     STATUPDATE ON
-    FORMAT AS JSON 'auto' ;
-""").format(SONG_DATA, IAM_ROLE)
+    FORMAT AS PARQUET;
+""").format(SONG_PARQUET, IAM_ROLE)
 
 # FINAL TABLES
 
@@ -204,9 +209,31 @@ FROM staging_events
 WHERE ts IS NOT NULL;
 """)
 
+# COLUMN ENCODINGS
+# table -> column -> encoding, written by maintenance.py from ANALYZE COMPRESSION
+
+ENCODINGS_FILE = 'encodings.json'
+
+def read_encodings(path=ENCODINGS_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def encode_columns(create_query, encodings):
+    """Adds ENCODE <encoding> after the type (and IDENTITY) of the columns that have an encoding"""
+    table = re.search(r"CREATE TABLE IF NOT EXISTS (\w+)", create_query).group(1)
+    columns = encodings.get(table, {})
+    def encode(match):
+        encoding = columns.get(match.group(2).lower())
+        return "{} ENCODE {}".format(match.group(1), encoding) if encoding else match.group(1)
+    return re.sub(r"^((\w+)\s+\w+(?:\([^)]*\))?(?:\s+IDENTITY\([^)]*\))?)", encode, create_query, flags=re.MULTILINE)
+
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
+ENCODINGS = read_encodings()
+
+create_table_queries = [encode_columns(query, ENCODINGS) for query in [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]]
 drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
 insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
@@ -0,0 +1,267 @@
+"""
+Postgres stand-in for the Redshift system views and commands used by maintenance.py,
+to try the maintenance step without a cluster.
+
+create_standin creates the redshift_standin database with the fact and dimension
+tables of sql_queries.py (without the Redshift attributes), fills them with
+synthetic rows in random order and fakes:
+
+- svv_table_info: rows, size in 1 MB blocks, % of rows out of sort key order,
+  % of rows changed since the last ANALYZE (100 when never analyzed) and whether
+  the columns were created with encodings. Rows and changes are counted by
+  triggers in standin_stats, in the transaction of the change, rather than read
+  from pg_stat_user_tables, whose counters are updated asynchronously.
+- ANALYZE COMPRESSION, as standin_analyze_compression(table): raw for the sort key,
+  az64 for numbers and timestamps, zstd otherwise
+- VACUUM SORT ONLY, as CLUSTER on an index of the sort key followed by ANALYZE
+
+    python standin.py --rows 200000
+    python maintenance.py --standin "host=127.0.0.1 dbname=redshift_standin user=student password=student"
+
+--check runs the maintenance step on the stand-in and verifies its decisions.
+"""
+import argparse
+import os
+import re
+import tempfile
+
+import psycopg2
+
+import maintenance
+from sql_queries import create_table_queries
+
+STANDIN_DSN = "host=127.0.0.1 dbname=redshift_standin user=student password=student"
+
+"""Maintenance commands of the stand-in, see maintenance.REDSHIFT"""
+STANDIN = {
+    "session": [],
+    # like ANALYZE COMPRESSION, sample the table before estimating
+    "compression": "ANALYZE {table}; SELECT * FROM standin_analyze_compression('{table}')",
+    "vacuum": "CLUSTER {table} USING {table}_sortkey; ANALYZE {table}; SELECT standin_analyzed('{table}')",
+    "analyze": "ANALYZE {table}; SELECT standin_analyzed('{table}')"
+}
+
+standin_tables_create = ("""
+CREATE TABLE standin_sortkeys (table_name name PRIMARY KEY, column_name name NOT NULL);
+CREATE TABLE standin_encodings (table_name name, column_name name, encoding varchar,
+                                PRIMARY KEY (table_name, column_name));
+CREATE TABLE standin_stats (table_name name PRIMARY KEY, tbl_rows bigint NOT NULL DEFAULT 0,
+                            mod_since_analyze bigint NOT NULL DEFAULT 0, analyzed boolean NOT NULL DEFAULT false);
+""")
+
+# rows inserted, updated or deleted by a statement, counted from its transition tables
+stats_functions_create = ("""
+CREATE FUNCTION standin_count_changes() RETURNS trigger AS $$
+DECLARE
+    added bigint := 0;
+    removed bigint := 0;
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT count(*) INTO added FROM new_rows;
+    END IF;
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        SELECT count(*) INTO removed FROM old_rows;
+    END IF;
+    UPDATE standin_stats
+    SET tbl_rows = tbl_rows + added - removed,
+        mod_since_analyze = mod_since_analyze + CASE WHEN TG_OP = 'UPDATE' THEN added ELSE added + removed END
+    WHERE table_name = TG_TABLE_NAME;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION standin_analyzed(tbl name) RETURNS void AS $$
+UPDATE standin_stats SET mod_since_analyze = 0, analyzed = true WHERE table_name = tbl;
+$$ LANGUAGE sql;
+""")
+
+stats_triggers_create = ("""
+INSERT INTO standin_stats (table_name) VALUES ('{table}');
+CREATE TRIGGER {table}_inserted AFTER INSERT ON {table} REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION standin_count_changes();
+CREATE TRIGGER {table}_updated AFTER UPDATE ON {table} REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION standin_count_changes();
+CREATE TRIGGER {table}_deleted AFTER DELETE ON {table} REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION standin_count_changes();
+""")
+
+unsorted_function_create = ("""
+CREATE FUNCTION standin_unsorted(tbl name, col name) RETURNS numeric AS $$
+DECLARE
+    unsorted numeric;
+BEGIN
+    EXECUTE format('SELECT round(coalesce(100.0 * count(*) FILTER (WHERE k < previous) / nullif(count(*), 0), 0), 2) '
+                   'FROM (SELECT %I AS k, lag(%I) OVER (ORDER BY ctid) AS previous FROM %I) rows',
+                   col, col, tbl) INTO unsorted;
+    RETURN unsorted;
+END
+$$ LANGUAGE plpgsql;
+""")
+
+table_info_view_create = ("""
+CREATE VIEW svv_table_info AS
+SELECT n.nspname::text AS "schema",
+       c.relname::text AS "table",
+       c.oid AS table_id,
+       CASE WHEN EXISTS (SELECT 1 FROM standin_encodings e WHERE e.table_name = c.relname) THEN 'Y' ELSE 'N' END
+           AS encoded,
+       k.column_name::text AS sortkey1,
+       ceil(pg_total_relation_size(c.oid) / 1048576.0)::bigint AS size,
+       s.tbl_rows::numeric AS tbl_rows,
+       CASE WHEN k.column_name IS NULL THEN NULL ELSE standin_unsorted(c.relname, k.column_name) END AS unsorted,
+       CASE WHEN NOT s.analyzed THEN 100.00
+            ELSE round(least(100, s.mod_since_analyze * 100.0 / greatest(s.tbl_rows, 1)), 2) END AS stats_off
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+JOIN standin_stats s ON s.table_name = c.relname
+LEFT JOIN standin_sortkeys k ON k.table_name = c.relname
+WHERE c.relkind = 'r' AND c.relname NOT LIKE 'standin\\_%'
+""")
+
+compression_function_create = ("""
+CREATE FUNCTION standin_analyze_compression(tbl text)
+RETURNS TABLE ("Table" text, "Column" text, "Encoding" text, "Est_reduction_pct" numeric) AS $$
+SELECT tbl, a.attname::text,
+       CASE WHEN a.attname = k.column_name THEN 'raw'
+            WHEN t.typname IN ('int2', 'int4', 'int8', 'numeric', 'date', 'timestamp', 'timestamptz') THEN 'az64'
+            ELSE 'zstd' END,
+       CASE WHEN a.attname = k.column_name THEN 0.00
+            ELSE round((100 * (1 - least(1, CASE WHEN st.n_distinct < 0 THEN -st.n_distinct
+                                                 ELSE st.n_distinct / greatest(c.reltuples, 1) END)))::numeric, 2)
+       END
+FROM pg_attribute a
+JOIN pg_class c ON c.oid = a.attrelid
+JOIN pg_type t ON t.oid = a.atttypid
+LEFT JOIN standin_sortkeys k ON k.table_name = c.relname
+LEFT JOIN pg_stats st ON st.tablename = c.relname AND st.attname = a.attname
+WHERE c.relname = tbl AND a.attnum > 0 AND NOT a.attisdropped
+ORDER BY a.attnum
+$$ LANGUAGE sql;
+""")
+
+# synthetic rows, inserted in random order so that the tables with a sort key start unsorted
+FILL_QUERIES = {
+    "songplay": ("""
+        INSERT INTO songplay (songplay_id, start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+        SELECT g, timestamp '2018-11-01' + g * interval '10 seconds', (random() * 100)::int,
+               CASE WHEN random() < 0.7 THEN 'paid' ELSE 'free' END, 'SO' || (random() * 1000)::int,
+               'AR' || (random() * 300)::int, (random() * 1000)::int, 'San Francisco-Oakland-Hayward, CA',
+               'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4)'
+        FROM generate_series(0, %(rows)s - 1) g ORDER BY random()
+    """),
+    "users": ("""
+        INSERT INTO users SELECT g, 'First' || g, 'Last' || g, CASE WHEN mod(g, 2) = 0 THEN 'F' ELSE 'M' END,
+                                 CASE WHEN random() < 0.7 THEN 'paid' ELSE 'free' END
+        FROM generate_series(1, 100) g
+    """),
+    "songs": ("""
+        INSERT INTO songs SELECT 'SO' || g, 'Song ' || g, 'AR' || mod(g, 300), 1990 + mod(g, 30), 120 + random() * 200
+        FROM generate_series(0, 1000) g
+    """),
+    "artists": ("""
+        INSERT INTO artists SELECT 'AR' || g, 'Artist ' || g, 'Chicago, IL', 41.88, -87.63
+        FROM generate_series(0, 300) g
+    """),
+    "time": ("""
+        INSERT INTO time SELECT start_time, extract(hour FROM start_time), extract(day FROM start_time),
+                                extract(week FROM start_time), extract(month FROM start_time),
+                                extract(year FROM start_time), extract(dow FROM start_time)
+        FROM (SELECT DISTINCT start_time FROM songplay) s ORDER BY random()
+    """)
+}
+
+
+def postgres_ddl(create_query):
+    """The CREATE TABLE of sql_queries.py without the Redshift attributes, and the encodings it declares"""
+    table = re.search(r"CREATE TABLE IF NOT EXISTS (\w+)", create_query).group(1)
+    encodings = [(table, column.lower(), encoding)
+                 for column, encoding in re.findall(r"^(\w+)\s.*\bENCODE\s+(\w+)", create_query, re.MULTILINE)]
+    query = re.sub(r"IDENTITY\((\d+),(\d+)\)",
+                   r"GENERATED BY DEFAULT AS IDENTITY (START WITH \1 INCREMENT BY \2 MINVALUE \1)", create_query)
+    query = re.sub(r"\s+ENCODE\s+\w+|\s+PRIMARY KEY|\s+(sortkey|distkey)\b", "", query, flags=re.IGNORECASE)
+    return query, encodings
+
+
+def create_standin(rows=200000, admin_dsn="host=127.0.0.1 dbname=studentdb user=student password=student"):
+    """
+    (Re)creates the redshift_standin database and returns a connection to it
+    """
+    conn = psycopg2.connect(admin_dsn)
+    conn.set_session(autocommit=True)
+    conn.cursor().execute("DROP DATABASE IF EXISTS redshift_standin")
+    conn.cursor().execute("CREATE DATABASE redshift_standin WITH ENCODING 'utf8' TEMPLATE template0")
+    conn.close()
+
+    conn = psycopg2.connect(STANDIN_DSN)
+    cur = conn.cursor()
+    cur.execute(standin_tables_create)
+    cur.execute(unsorted_function_create)
+    cur.execute(stats_functions_create)
+    cur.execute(table_info_view_create)
+    cur.execute(compression_function_create)
+
+    keys = maintenance.sort_keys()
+    for query in create_table_queries:
+        query, encodings = postgres_ddl(query)
+        table = re.search(r"CREATE TABLE IF NOT EXISTS (\w+)", query).group(1)
+        if table not in maintenance.FACT_AND_DIMENSION_TABLES:
+            continue
+        cur.execute(query)
+        cur.execute(stats_triggers_create.format(table=table))
+        for encoding in encodings:
+            cur.execute("INSERT INTO standin_encodings VALUES (%s, %s, %s)", encoding)
+        if table in keys:
+            cur.execute("INSERT INTO standin_sortkeys VALUES (%s, %s)", (table, keys[table]))
+            cur.execute("CREATE INDEX {0}_sortkey ON {0} ({1})".format(table, keys[table]))
+
+    for table in maintenance.FACT_AND_DIMENSION_TABLES:
+        cur.execute(FILL_QUERIES[table], {"rows": rows})
+    conn.commit()
+    return conn
+
+
+def check(conn, unsorted_threshold=5.0, stale_threshold=10.0):
+    """
+    Runs the maintenance step on a new stand-in and checks that it recommended encodings
+    for every table, vacuumed the unsorted tables and analyzed the never analyzed ones
+    """
+    encodings_file = os.path.join(tempfile.mkdtemp(prefix="standin-"), "encodings.json")
+    report = maintenance.maintain(conn, unsorted_threshold, stale_threshold, repeat=1, commands=STANDIN,
+                                  encodings_file=encodings_file)
+    maintenance.print_report(report)
+
+    problems = []
+    encodings = maintenance.read_encodings(encodings_file)
+    for table, result in report.items():
+        before, after = result["before"], result["after"]
+        if before["encoded"] == "N" and table not in encodings:
+            problems.append("no encodings recommended for {}".format(table))
+        vacuumed = "vacuum sort" in result["actions"]
+        if vacuumed != (before["unsorted"] is not None and before["unsorted"] > unsorted_threshold):
+            problems.append("{} vacuumed with {}% unsorted".format(table, before["unsorted"]))
+        if vacuumed and after["unsorted"] > unsorted_threshold:
+            problems.append("{} still {}% unsorted after VACUUM".format(table, after["unsorted"]))
+        if ("analyze" in result["actions"]) != (before["stats_off"] > stale_threshold):
+            problems.append("{} analyzed with {}% stale statistics".format(table, before["stats_off"]))
+        if after["stats_off"] > stale_threshold:
+            problems.append("{} still {}% stale after ANALYZE".format(table, after["stats_off"]))
+    if problems:
+        raise ValueError("Maintenance check failed: {}".format("; ".join(problems)))
+    print("Maintenance check passed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create a Postgres stand-in of the Redshift star schema")
+    parser.add_argument("--rows", type=int, default=200000, help="songplay rows")
+    parser.add_argument("--check", action="store_true", help="run the maintenance step and verify its decisions")
+    args = parser.parse_args()
+
+    conn = create_standin(args.rows)
+    print("Stand-in created: {}".format(STANDIN_DSN))
+    if args.check:
+        check(conn)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
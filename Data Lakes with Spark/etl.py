@@ -1,25 +1,153 @@
+import argparse
 import configparser
 from datetime import datetime
+import glob
+import math
 import os
+import re
+import sys
+import pyspark
 from pyspark.sql import SparkSession
 from pyspark.sql.functions import udf, col, to_timestamp, monotonically_increasing_id
 from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format,dayofweek
 
 
 config = configparser.ConfigParser()
+# Spark property names are case sensitive
+config.optionxform = str
 config.read('dl.cfg')
 
 os.environ['AWS_ACCESS_KEY_ID']=config.get('AWS','AWS_ACCESS_KEY_ID')
 os.environ['AWS_SECRET_ACCESS_KEY']=config.get('AWS','AWS_SECRET_ACCESS_KEY')
 
-def create_spark_session():
-    spark = SparkSession \
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from sparkify import metrics, profiling
+
+def hadoop_version():
+    '''
+    Returns the Hadoop version of the Spark build, from the name of its hadoop-client jar
+    '''
+    spark_home = os.environ.get('SPARK_HOME', os.path.dirname(pyspark.__file__))
+    for jar in glob.glob(os.path.join(spark_home, 'jars', 'hadoop-client-api-*.jar')):
+        match = re.search(r'hadoop-client-api-([\d.]+)\.jar$', jar)
+        if match:
+            return match.group(1)
+    # the Hadoop of the Spark 3.3-3.5 builds
+    return '3.3.4'
+
+
+def session_settings(session_profile=None):
+    '''
+    Returns the name and the Spark properties of a session profile of dl.cfg,
+    by default the one named by PROFILE in the SPARK section
+    '''
+    name = session_profile or config.get('SPARK', 'PROFILE', fallback='local')
+    section = 'PROFILE {}'.format(name)
+    if not config.has_section(section):
+        raise ValueError("No session profile {} in dl.cfg, there are: {}".format(name, ", ".join(
+            s[len('PROFILE '):] for s in config.sections() if s.startswith('PROFILE '))))
+    # Spark 4 is built for Scala 2.13, Spark 3 for Scala 2.12
+    scala_version = '2.13' if int(pyspark.__version__.split('.')[0]) >= 4 else '2.12'
+    return name, {key: value.format(spark_version=pyspark.__version__, scala_version=scala_version,
+                                    hadoop_version=hadoop_version())
+                  for key, value in config.items(section)}
+
+
+def create_spark_session(profile=False, session_profile=None, overrides=None):
+    '''
+    Creates the SparkSession with the properties of a session profile of dl.cfg
+    Parameters:
+        - profile          : cProfile the python workers
+        - session_profile  : name of the session profile, default from dl.cfg
+        - overrides        : properties that replace those of the profile, None removes one
+    '''
+    name, settings = session_settings(session_profile)
+    settings.update(overrides or {})
+    builder = SparkSession \
         .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.5") \
-        .getOrCreate()
+        .appName("sparkify-etl")
+    for key, value in settings.items():
+        if value is not None:
+            builder = builder.config(key, value)
+    if profile:
+        # cProfile the python workers that run the timestamp udfs
+        builder = builder.config("spark.python.profile", "true")
+    spark = builder.getOrCreate()
+
+    print("Spark session profile {}:".format(name))
+    for key in sorted(key for key, value in settings.items() if value is not None):
+        print("    {}={}".format(key, settings[key]))
     return spark
 
 
+def path_size(spark, path):
+    '''
+    Returns the total size in bytes of the files matching path (local or s3a)
+    '''
+    hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    fs = hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration())
+    statuses = fs.globStatus(hadoop_path) or []
+    # the glob already returns the length of files, only directories need another call
+    return sum(status.getLen() if status.isFile() else fs.getContentSummary(status.getPath()).getLength()
+               for status in statuses)
+
+
+def size_shuffle_partitions(spark, *paths):
+    '''
+    Sets spark.sql.shuffle.partitions to one partition per spark.sparkify.shuffle.bytesPerPartition
+    of input, within spark.sparkify.shuffle.minPartitions and maxPartitions. Does nothing when the
+    session profile does not set bytesPerPartition.
+    Returns the number of shuffle partitions
+    '''
+    per_partition = spark.conf.get("spark.sparkify.shuffle.bytesPerPartition", None)
+    if not per_partition:
+        return int(spark.conf.get("spark.sql.shuffle.partitions"))
+
+    input_bytes = sum(path_size(spark, path) for path in paths)
+    per_partition = spark._jvm.org.apache.spark.network.util.JavaUtils.byteStringAsBytes(per_partition)
+    partitions = min(max(math.ceil(input_bytes / per_partition),
+                         int(spark.conf.get("spark.sparkify.shuffle.minPartitions", "1"))),
+                     int(spark.conf.get("spark.sparkify.shuffle.maxPartitions", "2000")))
+    spark.conf.set("spark.sql.shuffle.partitions", partitions)
+    print("{} shuffle partitions for {:.1f} MB of input".format(partitions, input_bytes / 2 ** 20))
+    return partitions
+
+
+def write_table(spark, table, output_data, name, *partition_columns):
+    '''
+    Writes a table to parquet and reports the write to the metrics sinks
+    Parameters:
+        - spark             : SparkSession
+        - table             : DataFrame to write
+        - output_data       : path to store results
+        - name              : name of the parquet output, e.g. songs.parquet
+        - partition_columns : columns to partition the output by
+    '''
+    path = os.path.join(output_data, name)
+    with metrics.stage("spark.write", table=name) as record:
+        writer = table.write
+        if partition_columns:
+            writer = writer.partitionBy(*partition_columns)
+        writer.parquet(path, 'overwrite')
+
+        # counting from the parquet footers and listing the output are only worth it when reported
+        if metrics.enabled():
+            record.rows += spark.read.parquet(path).count()
+            record.bytes_written += path_size(spark, path)
+    print("{} completed".format(name))
+
+
+def read_json(spark, path):
+    '''
+    Reads JSON input and reports the bytes read to the metrics sinks
+    '''
+    with metrics.stage("spark.read", path=path) as record:
+        df = spark.read.json(path)
+        if metrics.enabled():
+            record.bytes_read += path_size(spark, path)
+    return df
+
+
 def process_song_data(spark, input_data, output_data):
     '''
     Processes song data and creates the song and artist tables
@@ -31,9 +159,10 @@ def process_song_data(spark, input_data, output_data):
     # get filepath to song data file
     song_data = input_data + 'song-data/*/*/*/*.json'
     #song_data = os.path.join(input_data, "song-data/*/*/*/*.json")
+    size_shuffle_partitions(spark, song_data)
     
     # read song data file
-    df = spark.read.json(song_data).dropDuplicates()
+    df = read_json(spark, song_data).dropDuplicates()
     
     # extract columns to create songs table
     songs_table = df.select(
@@ -47,8 +176,7 @@ def process_song_data(spark, input_data, output_data):
 
     
     # write songs table to parquet files partitioned by year and artist
-    songs_table.write.partitionBy('year', 'artist_id').parquet(os.path.join(output_data, 'songs.parquet'), 'overwrite')
-    print("songs.parquet completed")
+    write_table(spark, songs_table, output_data, 'songs.parquet', 'year', 'artist_id')
 
     # extract columns to create artists table
     artists_table = df.select(
@@ -61,25 +189,18 @@ def process_song_data(spark, input_data, output_data):
     artists_table.createOrReplaceTempView('artists')
     
     # write artists table to parquet files
-    artists_table.write.parquet(os.path.join(output_data, 'artists.parquet'), 'overwrite')
-    print("artists.parquet completed")
+    write_table(spark, artists_table, output_data, 'artists.parquet')
 
 
-def process_log_data(spark, input_data, output_data):
+def log_tables(df, song_df):
     '''
-    Process log data and creates the user, time, and songsplay tables
+    Builds the user, time and songplays tables from log events
     Parameters:
-        - spark        : SparkSession
-        - input_data   : path to input files
-        - output_data  : path to store results
-    '''    
-    # get filepath to log data file
-    log_data = input_data + 'log_data/*.json'
-    #log_data = os.path.join(input_data,'log_data/*.json')
-
-    # read log data file
-    df = spark.read.json(log_data).dropDuplicates()
-    
+        - df           : DataFrame of log events
+        - song_df      : DataFrame of song data
+    Returns the users, time and songplays DataFrames, and the songplays whose
+    song is not in song_df with their (title, artist, duration) key
+    '''
     # filter by actions for song plays
     df = df.filter(df.page == 'NextSong')
     
@@ -91,11 +212,6 @@ def process_log_data(spark, input_data, output_data):
         col('gender'), 
         col('level')
     ).distinct()
-    users_table.createOrReplaceTempView('users')
-    
-    # write users table to parquet files
-    users_table.write.parquet(os.path.join(output_data, 'users.parquet'), 'overwrite')
-    print("users.parquet completed")
     
     # create timestamp column from original timestamp column
     get_timestamp = udf(lambda x: str(int(int(x)/1000)))
@@ -122,21 +238,14 @@ def process_log_data(spark, input_data, output_data):
         col('year'), 
         col('weekday')
     ).distinct()
-    time_table.createOrReplaceTempView('time_table')
-       
-    # write time table to parquet files partitioned by year and month
-    time_table.write.partitionBy('year', 'month').parquet(os.path.join(output_data, 'time.parquet'), 'overwrite')
-    print("time.parquet completed")                                               
 
-    # read in song data to use for songplays table
-    song_data = os.path.join(input_data, "song-data/*/*/*/*.json")
-    song_df = spark.read.json(song_data)
-
-    # extract columns from joined song and log datasets to create songplays table 
+    # extract columns from joined song and log datasets to create songplays table,
+    # keeping the songplays of songs not loaded yet for reconcile.py
     df = df.alias('log_df')
-    song_df = song_df.alias('song_df')
-    joined_df = df.join(song_df, col('log_df.artist') == col(
-        'song_df.artist_name'), 'inner')
+    song_df = song_df.dropDuplicates(['title', 'artist_name', 'duration']).alias('song_df')
+    joined_df = df.join(song_df, (col('log_df.song') == col('song_df.title')) &
+                        (col('log_df.artist') == col('song_df.artist_name')) &
+                        (col('log_df.length') == col('song_df.duration')), 'left')
     songplays_table = joined_df.select(
         col('log_df.start_time').alias('start_time'),
         col('log_df.userId').alias('user_id'),
@@ -149,22 +258,81 @@ def process_log_data(spark, input_data, output_data):
         year('log_df.start_time').alias('year'),
         month('log_df.start_time').alias('month')) \
         .withColumn('songplay_id', monotonically_increasing_id()) 
+
+    unresolved_table = joined_df.filter(col('song_df.song_id').isNull() & col('log_df.song').isNotNull()).select(
+        col('log_df.start_time').alias('start_time'),
+        col('log_df.userId').alias('user_id'),
+        col('log_df.sessionId').alias('session_id'),
+        col('log_df.song').alias('title'),
+        col('log_df.artist').alias('artist'),
+        col('log_df.length').alias('duration'),
+        year('log_df.start_time').alias('year'),
+        month('log_df.start_time').alias('month'))
+
+    return users_table, time_table, songplays_table, unresolved_table
+
+
+def process_log_data(spark, input_data, output_data):
+    '''
+    Process log data and creates the user, time, and songsplay tables
+    Parameters:
+        - spark        : SparkSession
+        - input_data   : path to input files
+        - output_data  : path to store results
+    '''    
+    # get filepath to log data file
+    log_data = input_data + 'log_data/*.json'
+    #log_data = os.path.join(input_data,'log_data/*.json')
+
+    # read in song data to use for songplays table
+    song_data = os.path.join(input_data, "song-data/*/*/*/*.json")
+    size_shuffle_partitions(spark, log_data, song_data)
+
+    # read log data file
+    df = read_json(spark, log_data).dropDuplicates()
+    song_df = read_json(spark, song_data)
+
+    users_table, time_table, songplays_table, unresolved_table = log_tables(df, song_df)
+    users_table.createOrReplaceTempView('users')
+    time_table.createOrReplaceTempView('time_table')
     
+    # write users table to parquet files
+    write_table(spark, users_table, output_data, 'users.parquet')
+       
+    # write time table to parquet files partitioned by year and month
+    write_table(spark, time_table, output_data, 'time.parquet', 'year', 'month')
                                                                
     # write songplays table to parquet files partitioned by year and month
-    songplays_table.write.partitionBy('year', 'month').parquet(os.path.join(output_data, 'songplays.parquet'), 'overwrite')
-    print("songplays.parquet completed")                                           
+    write_table(spark, songplays_table, output_data, 'songplays.parquet', 'year', 'month')
+
+    # write the keys of the songplays without a song, partitioned like songplays
+    write_table(spark, unresolved_table, output_data, 'unresolved_songplays.parquet', 'year', 'month')
 
 
 def main():
-    spark = create_spark_session()
+    parser = argparse.ArgumentParser(description='Build the Sparkify data lake tables')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='profile each stage of the driver and the python udf workers, write the results to DIR')
+    parser.add_argument('--session-profile', help='session profile of dl.cfg: local, small-cluster, large-cluster')
+    args = parser.parse_args()
+
+    if args.profile:
+        profiling.enable(args.profile)
+
+    spark = create_spark_session(profile=bool(args.profile), session_profile=args.session_profile)
     input_data = "s3a://udacity-dend/"
     #input_data = 'data/'
     output_data = "s3a://data-lake-project-out-swapnil/"
     #output_data = 'data/output/'
     
-    process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+    with profiling.stage('process_song_data'):
+        process_song_data(spark, input_data, output_data)
+    with profiling.stage('process_log_data'):
+        process_log_data(spark, input_data, output_data)
+
+    if args.profile:
+        spark.sparkContext.dump_profiles(os.path.join(args.profile, 'python_workers'))
+        profiling.close()
 
 
 if __name__ == "__main__":
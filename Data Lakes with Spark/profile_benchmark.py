@@ -0,0 +1,121 @@
+"""
+Compares the session profiles of dl.cfg on local data.
+
+Every profile runs in its own python process, since properties such as the
+serializer and the packages only apply to a new JVM. Each run builds the
+users, time and songplays tables of the log data with etl.log_tables, writes
+them to a temporary directory and reports the wall time, the shuffle
+partitions chosen for the input and the number of parquet files written.
+When the input has no song-data/ (like the sample in Data/), the songplays
+are built against an empty song table.
+
+    python profile_benchmark.py --input Data/ --profiles local small-cluster large-cluster --offline
+
+--offline runs without spark.jars.packages and the S3A committer classes,
+which need the hadoop-aws and spark-hadoop-cloud jars to be downloaded.
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import etl
+
+
+SONG_SCHEMA = 'song_id string, title string, artist_id string, artist_name string, duration double'
+
+# properties that need jars that are not bundled with pyspark
+OFFLINE_OVERRIDES = {
+    "spark.jars.packages": None,
+    "spark.sql.sources.commitProtocolClass": None,
+    "spark.sql.parquet.output.committer.class": None
+}
+
+
+def parquet_files(path):
+    return len(glob.glob(os.path.join(path, '**', '*.parquet'), recursive=True))
+
+
+def run_profile(name, input_data, offline):
+    '''
+    Child process: runs the log stage with one session profile, prints its measurements as JSON
+    '''
+    overrides = {"spark.master": "local[*]"}
+    if offline:
+        overrides.update(OFFLINE_OVERRIDES)
+
+    start = time.time()
+    spark = etl.create_spark_session(session_profile=name, overrides=overrides)
+    startup = time.time() - start
+
+    output_data = tempfile.mkdtemp(prefix='sparkify-profile-')
+    try:
+        start = time.time()
+        log_data = os.path.join(input_data, 'log_data/*.json')
+        song_data = os.path.join(input_data, 'song-data/*/*/*/*.json')
+        if glob.glob(os.path.join(input_data, 'song-data')):
+            partitions = etl.size_shuffle_partitions(spark, log_data, song_data)
+            song_df = spark.read.json(song_data)
+        else:
+            partitions = etl.size_shuffle_partitions(spark, log_data)
+            song_df = spark.createDataFrame([], SONG_SCHEMA)
+
+        df = spark.read.json(log_data).dropDuplicates()
+        users_table, time_table, songplays_table, _ = etl.log_tables(df, song_df)
+        etl.write_table(spark, users_table, output_data, 'users.parquet')
+        etl.write_table(spark, time_table, output_data, 'time.parquet', 'year', 'month')
+        etl.write_table(spark, songplays_table, output_data, 'songplays.parquet', 'year', 'month')
+        seconds = time.time() - start
+
+        print(json.dumps({
+            "profile": name,
+            "startup_seconds": startup,
+            "seconds": seconds,
+            "shuffle_partitions": partitions,
+            "files_written": parquet_files(output_data),
+            "songplays": spark.read.parquet(os.path.join(output_data, 'songplays.parquet')).count()
+        }))
+    finally:
+        spark.stop()
+        shutil.rmtree(output_data, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the session profiles of dl.cfg on local data')
+    parser.add_argument('--input', default='Data/', help='directory with log_data/ and optionally song-data/')
+    parser.add_argument('--profiles', nargs='+', default=['local', 'small-cluster', 'large-cluster'])
+    parser.add_argument('--offline', action='store_true',
+                        help='leave out the properties that need jars downloaded from Maven')
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        run_profile(args.run_one, args.input, args.offline)
+        return
+
+    results = []
+    for name in args.profiles:
+        print('running {} ...'.format(name))
+        command = [sys.executable, os.path.abspath(__file__), '--run-one', name, '--input', args.input]
+        if args.offline:
+            command.append('--offline')
+        completed = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+        if completed.returncode != 0:
+            print('{} failed with exit code {}'.format(name, completed.returncode))
+            continue
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    print('{:<16}{:>10}{:>10}{:>12}{:>8}{:>11}'.format('profile', 'startup', 'seconds', 'partitions', 'files',
+                                                      'songplays'))
+    for result in results:
+        print('{profile:<16}{startup_seconds:>10.1f}{seconds:>10.1f}{shuffle_partitions:>12}'
+              '{files_written:>8}{songplays:>11}'.format(**result))
+
+
+if __name__ == "__main__":
+    main()
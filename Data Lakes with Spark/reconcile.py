@@ -0,0 +1,163 @@
+"""
+Reconciliation of lake songplays loaded before their song.
+
+etl.py keeps the songplays whose song was not in the song data, with song_id
+and artist_id null, and writes their (title, artist, duration) key to
+unresolved_songplays.parquet, partitioned by year and month like songplays.
+After new song files are loaded, this job matches the new songs against that
+index and rewrites only the year/month partitions of songplays and of the
+index that contain resolved songplays. A songplay is identified by start_time,
+user_id and session_id.
+
+The affected partitions are first written to a staging directory, since Spark
+cannot overwrite the files it is reading, and then copied over the originals
+with dynamic partition overwrite.
+
+The tables of stream.py have a batch_id=<id> directory above year and month;
+with --output pointing at the stream output, batch_id is one more partition
+column of the rewrite.
+
+    python reconcile.py --songs s3a://udacity-dend/song-data/A/*/*/*.json
+"""
+import argparse
+import os
+from functools import reduce
+
+from pyspark.sql.functions import col, coalesce
+
+import etl  # also puts the repository root on sys.path
+from sparkify import metrics
+
+
+PARTITION_COLUMNS = ['year', 'month']
+SONGPLAY_KEY = ['start_time', 'user_id', 'session_id']
+
+# the S3A committers of the cluster session profiles do not support dynamic partition overwrite
+RENAME_COMMITTER = {
+    "spark.sql.sources.commitProtocolClass":
+        "org.apache.spark.sql.execution.datasources.SQLHadoopMapReduceCommitProtocol",
+    "spark.sql.parquet.output.committer.class": "org.apache.parquet.hadoop.ParquetOutputCommitter"
+}
+
+
+def partition_columns(df):
+    '''
+    year and month, below the batch_id of the tables written by stream.py
+    '''
+    return (['batch_id'] if 'batch_id' in df.columns else []) + PARTITION_COLUMNS
+
+
+def overwrite_partitions(spark, df, path, columns=PARTITION_COLUMNS):
+    '''
+    Replaces the partitions of path, on columns, that are present in df
+    '''
+    settings = dict(RENAME_COMMITTER, **{"spark.sql.sources.partitionOverwriteMode": "dynamic"})
+    previous = {key: spark.conf.get(key, None) for key in settings}
+    for key, value in settings.items():
+        spark.conf.set(key, value)
+    try:
+        df.write.mode("overwrite").partitionBy(*columns).parquet(path)
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                spark.conf.unset(key)
+            else:
+                spark.conf.set(key, value)
+
+
+def delete_partition(spark, path, columns, values):
+    partition = spark._jvm.org.apache.hadoop.fs.Path(
+        os.path.join(path, *['{}={}'.format(column, value) for column, value in zip(columns, values)]))
+    partition.getFileSystem(spark._jsc.hadoopConfiguration()).delete(partition, True)
+
+
+def reconcile_songplays(spark, song_df, output_data):
+    '''
+    Fills in song_id and artist_id of the songplays that the songs resolve
+    Parameters:
+        - spark        : SparkSession
+        - song_df      : DataFrame of the new song data
+        - output_data  : path of the lake tables
+    Returns the number of songplays resolved and the number still unresolved
+    '''
+    songplays_path = os.path.join(output_data, 'songplays.parquet')
+    unresolved_path = os.path.join(output_data, 'unresolved_songplays.parquet')
+    staging_path = os.path.join(output_data, '_reconcile')
+
+    with metrics.stage("spark.reconcile") as record:
+        songs = song_df.select(
+            col('title'),
+            col('artist_name').alias('artist'),
+            col('duration'),
+            col('song_id'),
+            col('artist_id')
+        ).dropDuplicates(['title', 'artist', 'duration'])
+
+        unresolved = spark.read.parquet(unresolved_path)
+        columns = partition_columns(unresolved)
+        key = columns + SONGPLAY_KEY
+        matches = unresolved.join(songs, ['title', 'artist', 'duration']) \
+            .select(*key + ['song_id', 'artist_id']).persist()
+        # counted before the unresolved files it reads from are overwritten
+        resolved = matches.count()
+        partitions = [tuple(row) for row in matches.select(*columns).distinct().collect()]
+
+        if partitions:
+            in_partitions = reduce(lambda a, b: a | b, [
+                reduce(lambda a, b: a & b, [col(column) == value for column, value in zip(columns, partition)])
+                for partition in partitions])
+
+            # songplays of the affected partitions, with the ids of the matched songs filled in
+            songplays = spark.read.parquet(songplays_path).filter(in_partitions).alias('sp')
+            on_key = reduce(lambda a, b: a & b, [col('sp.' + c).eqNullSafe(col('m.' + c)) for c in key])
+            fixed = songplays.join(matches.alias('m'), on_key, 'left').select(*[
+                coalesce(col('sp.' + c), col('m.' + c)).alias(c) if c in ('song_id', 'artist_id') else col('sp.' + c)
+                for c in songplays.columns])
+
+            # unresolved keys of the affected partitions that are still unresolved
+            remaining = unresolved.filter(in_partitions).alias('u').join(
+                matches.alias('m'),
+                reduce(lambda a, b: a & b, [col('u.' + c).eqNullSafe(col('m.' + c)) for c in key]),
+                'left_anti')
+
+            fixed.write.mode('overwrite').partitionBy(*columns).parquet(os.path.join(staging_path, 'songplays'))
+            remaining.write.mode('overwrite').partitionBy(*columns).parquet(os.path.join(staging_path, 'unresolved'))
+
+            # with the schema given, a staging directory without rows reads as empty
+            overwrite_partitions(spark, spark.read.schema(songplays.schema).parquet(
+                os.path.join(staging_path, 'songplays')), songplays_path, columns)
+            staged_unresolved = spark.read.schema(unresolved.schema).parquet(os.path.join(staging_path, 'unresolved'))
+            overwrite_partitions(spark, staged_unresolved, unresolved_path, columns)
+
+            # a partition without unresolved songplays left has nothing to overwrite it with
+            left = {tuple(row) for row in staged_unresolved.select(*columns).distinct().collect()}
+            for partition in set(partitions) - left:
+                delete_partition(spark, unresolved_path, columns, partition)
+
+            staging = spark._jvm.org.apache.hadoop.fs.Path(staging_path)
+            staging.getFileSystem(spark._jsc.hadoopConfiguration()).delete(staging, True)
+
+        matches.unpersist()
+        still_unresolved = spark.read.schema(unresolved.schema).parquet(unresolved_path).count()
+        record.rows += resolved
+        record.extra["partitions"] = len(partitions)
+        record.extra["unresolved"] = still_unresolved
+
+    print('{} songplays resolved in {} partitions, {} still unresolved'.format(
+        resolved, len(partitions), still_unresolved))
+    return resolved, still_unresolved
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resolve lake songplays against newly loaded songs')
+    parser.add_argument('--songs', required=True, help='path of the new song files')
+    parser.add_argument('--output', default='s3a://data-lake-project-out-swapnil/', help='path of the lake tables')
+    parser.add_argument('--session-profile', help='session profile of dl.cfg: local, small-cluster, large-cluster')
+    args = parser.parse_args()
+
+    spark = etl.create_spark_session(session_profile=args.session_profile)
+    reconcile_songplays(spark, spark.read.json(args.songs), args.output)
+
+
+if __name__ == "__main__":
+    main()
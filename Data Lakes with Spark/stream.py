@@ -0,0 +1,160 @@
+"""
+Streaming mode of the data lake ETL.
+
+Reads new log files with Structured Streaming's file source and builds the
+users, time and songplays tables of every micro-batch with etl.log_tables,
+and the index of its songplays whose song is not loaded yet, which
+reconcile.py --output <stream output> resolves later.
+The checkpoint records which files each batch id covers before the batch runs,
+and each batch writes to a batch_id=<id> directory of its tables with mode
+overwrite, so a batch replayed after a failure replaces its own output and
+every event lands exactly once. Readers see batch_id as one more partition
+column (users may repeat across batches, the last batch has the current level).
+
+After each batch the delay between the modification time of its files and the
+moment its rows became visible is reported to the metrics sinks as
+latency_seconds_p50/latency_seconds_max (see sparkify.metrics).
+
+    python stream.py --input data/ --output data/stream/ --trigger 30
+"""
+import argparse
+import os
+import statistics
+import time
+
+from pyspark.sql.functions import input_file_name
+from pyspark.sql.types import StructType, StructField, StringType, LongType, DoubleType, IntegerType
+
+import etl  # also puts the repository root on sys.path
+from sparkify import metrics
+
+
+LOG_SCHEMA = StructType([
+    StructField('artist', StringType()),
+    StructField('auth', StringType()),
+    StructField('firstName', StringType()),
+    StructField('gender', StringType()),
+    StructField('itemInSession', LongType()),
+    StructField('lastName', StringType()),
+    StructField('length', DoubleType()),
+    StructField('level', StringType()),
+    StructField('location', StringType()),
+    StructField('method', StringType()),
+    StructField('page', StringType()),
+    StructField('registration', DoubleType()),
+    StructField('sessionId', LongType()),
+    StructField('song', StringType()),
+    StructField('status', IntegerType()),
+    StructField('ts', LongType()),
+    StructField('userAgent', StringType()),
+    StructField('userId', StringType())
+])
+
+
+def arrival_times(spark, paths):
+    '''
+    Returns the modification time in seconds of each file, as the time it arrived
+    '''
+    conf = spark._jsc.hadoopConfiguration()
+    times = []
+    for path in paths:
+        hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+        times.append(hadoop_path.getFileSystem(conf).getFileStatus(hadoop_path).getModificationTime() / 1000.0)
+    return times
+
+
+def batch_writer(spark, song_df, output_data):
+    '''
+    Returns the foreachBatch function that writes the tables of one micro-batch
+    Parameters:
+        - spark        : SparkSession
+        - song_df      : DataFrame of song data to join the events with
+        - output_data  : path to store results
+    '''
+    def write_batch(batch_df, batch_id):
+        with metrics.stage("spark.stream_batch") as record:
+            batch_df = batch_df.withColumn('input_file', input_file_name()).persist()
+            files = [row.input_file for row in batch_df.select('input_file').distinct().collect()]
+            record.extra["batch_id"] = batch_id
+            record.extra["files"] = len(files)
+            if not files:
+                batch_df.unpersist()
+                return
+
+            users_table, time_table, songplays_table, unresolved_table = etl.log_tables(
+                batch_df.drop('input_file').dropDuplicates(), song_df)
+            batch_dir = 'batch_id={}'.format(batch_id)
+            for table, name, partition_columns in [(users_table, 'users.parquet', []),
+                                                   (time_table, 'time.parquet', ['year', 'month']),
+                                                   (songplays_table, 'songplays.parquet', ['year', 'month']),
+                                                   (unresolved_table, 'unresolved_songplays.parquet',
+                                                    ['year', 'month'])]:
+                writer = table.write
+                if partition_columns:
+                    writer = writer.partitionBy(*partition_columns)
+                writer.parquet(os.path.join(output_data, name, batch_dir), 'overwrite')
+            visible = time.time()
+
+            latencies = [visible - arrived for arrived in arrival_times(spark, files)]
+            record.rows += batch_df.count()
+            record.extra["latency_seconds_p50"] = round(statistics.median(latencies), 3)
+            record.extra["latency_seconds_max"] = round(max(latencies), 3)
+            batch_df.unpersist()
+
+        print('batch {}: {} files, {} events, latency p50 {:.1f}s max {:.1f}s'.format(
+            batch_id, len(files), record.rows, record.extra["latency_seconds_p50"],
+            record.extra["latency_seconds_max"]))
+
+    return write_batch
+
+
+def start_stream(spark, input_data, output_data, checkpoint, trigger=30, max_files=100, once=False):
+    '''
+    Starts streaming the log files of input_data + 'log_data/' into output_data
+    Parameters:
+        - spark        : SparkSession
+        - input_data   : path to input files
+        - output_data  : path to store results
+        - checkpoint   : path of the checkpoint with the offsets of every batch
+        - trigger      : seconds between micro-batches
+        - max_files    : maximum number of new files per micro-batch
+        - once         : process the files present now in one batch and stop
+    Returns the StreamingQuery
+    '''
+    song_df = spark.read.json(os.path.join(input_data, 'song-data/*/*/*/*.json')) \
+        .select('song_id', 'title', 'artist_id', 'artist_name', 'duration').persist()
+
+    logs = spark.readStream \
+        .schema(LOG_SCHEMA) \
+        .option('maxFilesPerTrigger', max_files) \
+        .json(os.path.join(input_data, 'log_data'))
+
+    writer = logs.writeStream \
+        .foreachBatch(batch_writer(spark, song_df, output_data)) \
+        .option('checkpointLocation', checkpoint)
+    if once:
+        writer = writer.trigger(once=True)
+    else:
+        writer = writer.trigger(processingTime='{} seconds'.format(trigger))
+    return writer.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream new Sparkify log files into the data lake tables')
+    parser.add_argument('--input', default='s3a://udacity-dend/', help='path with song-data/ and log_data/')
+    parser.add_argument('--output', default='s3a://data-lake-project-out-swapnil/stream/')
+    parser.add_argument('--checkpoint', help='defaults to <output>/_checkpoint')
+    parser.add_argument('--trigger', type=int, default=30, help='seconds between micro-batches')
+    parser.add_argument('--max-files', type=int, default=100, help='maximum number of new files per micro-batch')
+    parser.add_argument('--once', action='store_true', help='process the available files and stop')
+    parser.add_argument('--session-profile', help='session profile of dl.cfg: local, small-cluster, large-cluster')
+    args = parser.parse_args()
+
+    spark = etl.create_spark_session(session_profile=args.session_profile)
+    query = start_stream(spark, args.input, args.output, args.checkpoint or os.path.join(args.output, '_checkpoint'),
+                         trigger=args.trigger, max_files=args.max_files, once=args.once)
+    query.awaitTermination()
+
+
+if __name__ == "__main__":
+    main()
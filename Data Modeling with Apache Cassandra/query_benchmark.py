@@ -0,0 +1,303 @@
+"""
+p50/p99 latency of the three queries of the notebook, run three ways:
+
+- literal: blocking session.execute of the CQL string, as in the notebook
+- prepared: QueryService without cache, prepared statements run with execute_async
+- cached: QueryService with a ResultCache
+
+The workload draws its parameters from the events of event_datafile_new.csv, so
+popular songs and long sessions come up as often as they are played. With
+--write-ratio, that share of the operations are loader writes of a new event
+through QueryService.write_event, which invalidate the cached results they change.
+
+Without --hosts the queries run on MockSession, which keeps the three tables in
+memory and delivers every page after a simulated round trip (--latency) plus a
+cost per row; with --hosts they run on the udacity keyspace of that cluster.
+
+    python query_benchmark.py --requests 20000 --concurrency 8 --write-ratio 0.01
+    python query_benchmark.py --hosts 127.0.0.1 --load
+"""
+import argparse
+import collections
+import heapq
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future
+
+from query_service import QUERIES, TABLE_CREATES, QueryService, ResultCache, create_tables, load_events, \
+    read_events
+
+
+def primary_keys():
+    '''
+    Partition and clustering columns of each table, from the PRIMARY KEY of TABLE_CREATES
+    '''
+    keys = {}
+    for table, query in TABLE_CREATES.items():
+        key = re.search(r"PRIMARY KEY\s*\((.*)\)\)", query, re.DOTALL).group(1).lower()
+        if key.startswith('('):
+            partition, clustering = key[1:].split(')', 1)
+        else:
+            partition, _, clustering = key.partition(',')
+        keys[table] = ([c.strip() for c in partition.split(',') if c.strip()],
+                       [c.strip() for c in clustering.split(',') if c.strip()])
+    return keys
+
+
+class MockStatement:
+    """Prepared or bound statement of MockSession"""
+
+    def __init__(self, cql, values=None, fetch_size=5000):
+        self.cql = cql
+        self.values = values
+        self.fetch_size = fetch_size
+        insert = re.match(r"\s*INSERT INTO (\w+) \(([^)]*)\)", cql, re.IGNORECASE)
+        if re.match(r"\s*CREATE", cql, re.IGNORECASE):
+            # the tables of TABLE_CREATES always exist
+            self.kind = "ddl"
+        elif insert:
+            self.kind, self.table = "insert", insert.group(1)
+            self.columns = [c.strip().lower() for c in insert.group(2).split(',')]
+        else:
+            select = re.match(r"\s*SELECT (.*) FROM (\w+) WHERE (.*?)(?: ORDER BY.*)?$", cql, re.IGNORECASE)
+            self.kind, self.table = "select", select.group(2)
+            self.columns = [c.strip().lower() for c in select.group(1).split(',')]
+            self.where = [c.lower() for c in re.findall(r"(\w+)\s*=", select.group(3))]
+
+    def bind(self, values):
+        return MockStatement(self.cql, list(values))
+
+
+class MockResponseFuture:
+    """The paging part of cassandra.cluster.ResponseFuture"""
+
+    def __init__(self, session, rows, fetch_size, extra_delay=0.0):
+        self.session = session
+        self.rows = rows
+        self.fetch_size = fetch_size
+        self.position = 0
+        self.has_more_pages = False
+        self.callback = self.errback = None
+        self.extra_delay = extra_delay
+        self.done = Future()
+
+    def add_callbacks(self, callback, errback=None):
+        self.callback, self.errback = callback, errback
+        self._schedule()
+
+    def start_fetching_next_page(self):
+        self._schedule()
+
+    def result(self):
+        if self.callback is None:
+            self.add_callbacks(self._collect)
+        return self.done.result()
+
+    def _collect(self, page):
+        self.collected = getattr(self, 'collected', []) + page
+        if self.has_more_pages:
+            self.start_fetching_next_page()
+        else:
+            self.done.set_result(self.collected)
+
+    def _schedule(self):
+        page = self.rows[self.position:self.position + self.fetch_size]
+        self.position += len(page)
+        delay = self.session.latency + self.extra_delay + len(page) * self.session.row_cost
+        self.extra_delay = 0.0
+        self.session.deliver(delay, self, page)
+
+
+class MockSession:
+    """
+    In-memory stand-in for a cassandra Session with the tables of TABLE_CREATES.
+    A single network thread delivers the pages in the order they are due.
+    """
+
+    def __init__(self, latency=0.0005, row_cost=0.000002, parse_cost=0.0002):
+        self.latency = latency
+        self.row_cost = row_cost
+        self.parse_cost = parse_cost
+        self.keys = primary_keys()
+        self.tables = {table: collections.defaultdict(dict) for table in self.keys}
+        self.queue = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+        threading.Thread(target=self._network, daemon=True).start()
+
+    def prepare(self, cql):
+        return MockStatement(cql)
+
+    def execute(self, statement, parameters=None):
+        return self.execute_async(statement, parameters).result()
+
+    def execute_async(self, statement, parameters=None):
+        extra_delay = 0.0
+        if isinstance(statement, str):
+            # a simple statement is parsed by the server on every execution
+            statement = MockStatement(statement.replace('%s', '?'), list(parameters or []))
+            extra_delay = self.parse_cost
+        elif statement.values is None:
+            statement = statement.bind(parameters or [])
+        rows = []
+        if statement.kind == "insert":
+            self._insert(statement)
+        elif statement.kind == "select":
+            rows = self._select(statement)
+        return MockResponseFuture(self, rows, statement.fetch_size, extra_delay)
+
+    def _insert(self, statement):
+        partition, clustering = self.keys[statement.table]
+        row = dict(zip(statement.columns, statement.values))
+        with self.condition:
+            self.tables[statement.table][tuple(row[c] for c in partition)][tuple(row[c] for c in clustering)] = row
+
+    def _select(self, statement):
+        partition, clustering = self.keys[statement.table]
+        where = dict(zip(statement.where, statement.values))
+        Row = collections.namedtuple('Row', statement.columns)
+        with self.condition:
+            rows = self.tables[statement.table].get(tuple(where[c] for c in partition), {})
+            selected = [Row(*(row[c] for c in statement.columns))
+                        for key, row in sorted(rows.items())
+                        if all(where.get(c, value) == value for c, value in zip(clustering, key))]
+        return selected
+
+    def deliver(self, delay, response, page):
+        with self.condition:
+            self.sequence += 1
+            heapq.heappush(self.queue, (time.perf_counter() + delay, self.sequence, response, page))
+            self.condition.notify()
+
+    def _network(self):
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > time.perf_counter():
+                    self.condition.wait(self.queue[0][0] - time.perf_counter() if self.queue else None)
+                _, _, response, page = heapq.heappop(self.queue)
+            response.has_more_pages = response.position < len(response.rows)
+            response.callback(page)
+
+
+def workload(events, requests, write_ratio, seed=0):
+    '''
+    The operations of the run: ("read", query, params) or ("write", event)
+    '''
+    rng = random.Random(seed)
+    names = list(QUERIES)
+    next_item = collections.Counter()
+    for event in events:
+        next_item[event["sessionId"]] = max(next_item[event["sessionId"]], event["itemInSession"] + 1)
+    operations = []
+    for _ in range(requests):
+        event = rng.choice(events)
+        if rng.random() < write_ratio:
+            # the user plays the song again in the same session
+            event = dict(event, itemInSession=next_item[event["sessionId"]])
+            next_item[event["sessionId"]] += 1
+            operations.append(("write", event))
+        else:
+            name = rng.choice(names)
+            operations.append(("read", name, tuple(event[field] for field in QUERIES[name]["params"])))
+    return operations
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else float('nan')
+
+
+def run(mode, service, session, operations, concurrency):
+    '''
+    Runs the operations with at most concurrency reads in flight.
+    Returns the latencies of the reads by query, the wall time and the number of writes
+    '''
+    latencies = collections.defaultdict(list)
+    slots = threading.Semaphore(concurrency)
+    lock = threading.Lock()
+    writes = 0
+
+    def record(name, start):
+        def done(future):
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies[name].append(elapsed * 1000)
+            slots.release()
+        return done
+
+    start = time.perf_counter()
+    for operation in operations:
+        if operation[0] == "write":
+            service.write_event(operation[1])
+            writes += 1
+            continue
+        _, name, params = operation
+        if mode == "literal":
+            begin = time.perf_counter()
+            session.execute(QUERIES[name]["cql"].replace('?', '%s'), params)
+            latencies[name].append((time.perf_counter() - begin) * 1000)
+            continue
+        slots.acquire()
+        service.query_async(name, *params).add_done_callback(record(name, time.perf_counter()))
+    for _ in range(concurrency):
+        slots.acquire()
+    return latencies, time.perf_counter() - start, writes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='p50/p99 latency of the Sparkify Cassandra queries')
+    parser.add_argument('--csv', default='event_datafile_new.csv')
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=8, help='reads in flight in the prepared and cached modes')
+    parser.add_argument('--write-ratio', type=float, default=0.0, help='share of operations that are loader writes')
+    parser.add_argument('--modes', nargs='+', default=['literal', 'prepared', 'cached'])
+    parser.add_argument('--cache-size', type=int, default=10000)
+    parser.add_argument('--ttl', type=float, default=60.0, help='seconds a cached result is served')
+    parser.add_argument('--fetch-size', type=int, default=100, help='rows per page')
+    parser.add_argument('--latency', type=float, default=0.0005, help='mock round trip in seconds')
+    parser.add_argument('--hosts', nargs='+', help='run on this cluster instead of the mock session')
+    parser.add_argument('--load', action='store_true', help='create the tables and load the CSV on the cluster')
+    args = parser.parse_args()
+
+    events = list(read_events(args.csv))
+    if args.hosts:
+        from cassandra.cluster import Cluster
+        cluster = Cluster(args.hosts)
+        session = cluster.connect('udacity')
+        if args.load:
+            create_tables(session)
+            print('loaded {} events'.format(load_events(QueryService(session), args.csv)))
+    else:
+        cluster = None
+        # load without the simulated round trip
+        session = MockSession(latency=0.0)
+        create_tables(session)
+        load_events(QueryService(session), args.csv)
+        session.latency = args.latency
+        print('mock session with {} events, {:.1f} ms round trip'.format(len(events), args.latency * 1000))
+
+    operations = workload(events, args.requests, args.write_ratio)
+    print('{:<10}{:<24}{:>9}{:>10}{:>10}'.format('mode', 'query', 'reads', 'p50 ms', 'p99 ms'))
+    for mode in args.modes:
+        cache = ResultCache(args.cache_size, args.ttl) if mode == 'cached' else None
+        service = QueryService(session, cache, fetch_size=args.fetch_size)
+        latencies, seconds, writes = run(mode, service, session, operations, args.concurrency)
+        for name in QUERIES:
+            print('{:<10}{:<24}{:>9}{:>10.3f}{:>10.3f}'.format(mode, name, len(latencies[name]),
+                                                                percentile(latencies[name], 50),
+                                                                percentile(latencies[name], 99)))
+        reads = [value for values in latencies.values() for value in values]
+        summary = '{:<10}{:<24}{:>9}{:>10.3f}{:>10.3f}   {:.0f} reads/s, {} writes'.format(
+            mode, 'all', len(reads), percentile(reads, 50), percentile(reads, 99), len(reads) / seconds, writes)
+        if cache is not None:
+            summary += ', {:.1%} cache hits'.format(cache.hits / max(1, cache.hits + cache.misses))
+        print(summary)
+
+    if cluster is not None:
+        cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
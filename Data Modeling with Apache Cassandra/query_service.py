@@ -0,0 +1,262 @@
+"""
+Read service for the three queries of the Sparkify Cassandra model.
+
+The notebook answers each question with a blocking session.execute of a literal
+CQL string. QueryService prepares the three statements once, runs them with
+execute_async and pages through large partitions (a popular song in
+user_songs) fetch_size rows at a time, and keeps results in a ResultCache,
+an LRU cache whose entries also expire after ttl seconds. The loader writes
+through the service (write_event), which invalidates the cached results of
+the keys it wrote, so a cached answer is never older than the last write.
+
+    cluster = Cluster(['127.0.0.1'])
+    service = QueryService(cluster.connect('udacity'), ResultCache(maxsize=10000, ttl=60))
+    service.query('session_item', 338, 4)
+    service.query_async('song_listeners', 'All Hands Against His Own').add_done_callback(...)
+
+query_benchmark.py measures the latency of the service against an in-memory mock
+session or a local cluster.
+"""
+import collections
+import csv
+import threading
+import time
+from concurrent.futures import Future
+
+
+"""Tables of the notebook, one per query"""
+TABLE_CREATES = {
+    "session_songs": ("""
+        CREATE TABLE IF NOT EXISTS session_songs
+        (sessionId int, itemInSession int, artist text, song_title text, song_length float,
+        PRIMARY KEY(sessionId, itemInSession))
+    """),
+    "artist_info": ("""
+        CREATE TABLE IF NOT EXISTS artist_info
+        (userId int, sessionId int, itemInSession int, artist text, song text, first_name text, last_name text,
+        PRIMARY KEY((userId, sessionId), itemInSession))
+    """),
+    "user_songs": ("""
+        CREATE TABLE IF NOT EXISTS user_songs
+        (song text, user_id int, first_name text, last_name text, PRIMARY KEY (song, user_id))
+    """)
+}
+
+"""
+The three questions: the prepared SELECT, the table it reads and the event
+fields that are its parameters, in order
+"""
+QUERIES = {
+    # 1. artist, song title and length of an item of a session
+    "session_item": {
+        "cql": "SELECT artist, song_title, song_length FROM session_songs WHERE sessionId = ? AND itemInSession = ?",
+        "table": "session_songs",
+        "params": ["sessionId", "itemInSession"]
+    },
+    # 2. artist, song and user name of the items of a user's session, by itemInSession
+    "user_session_playlist": {
+        "cql": "SELECT artist, song, first_name, last_name FROM artist_info WHERE userId = ? AND sessionId = ? "
+               "ORDER BY itemInSession",
+        "table": "artist_info",
+        "params": ["userId", "sessionId"]
+    },
+    # 3. users who listened to a song
+    "song_listeners": {
+        "cql": "SELECT first_name, last_name FROM user_songs WHERE song = ?",
+        "table": "user_songs",
+        "params": ["song"]
+    }
+}
+
+"""The INSERT of each table and the event fields of its values"""
+INSERTS = {
+    "session_songs": ("INSERT INTO session_songs (sessionId, itemInSession, artist, song_title, song_length) "
+                      "VALUES (?, ?, ?, ?, ?)",
+                      ["sessionId", "itemInSession", "artist", "song", "length"]),
+    "artist_info": ("INSERT INTO artist_info (userId, sessionId, itemInSession, artist, song, first_name, last_name) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    ["userId", "sessionId", "itemInSession", "artist", "song", "firstName", "lastName"]),
+    "user_songs": ("INSERT INTO user_songs (song, user_id, first_name, last_name) VALUES (?, ?, ?, ?)",
+                   ["song", "userId", "firstName", "lastName"])
+}
+
+
+def read_events(path='event_datafile_new.csv'):
+    '''
+    Yields the events of the denormalized CSV written by the notebook, with typed values
+    '''
+    with open(path, encoding='utf8') as f:
+        for event in csv.DictReader(f):
+            event['itemInSession'] = int(event['itemInSession'])
+            event['sessionId'] = int(event['sessionId'])
+            event['userId'] = int(event['userId'])
+            event['length'] = float(event['length'])
+            yield event
+
+
+class ResultCache:
+    """
+    LRU cache of query results that also expire ttl seconds after they were stored.
+    Entries are indexed by query so that the results of one query can be invalidated
+    without touching the others.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.keys_by_query = collections.defaultdict(set)
+        self.versions = collections.Counter()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, query, params):
+        '''
+        The cached rows, None when they are missing or expired
+        '''
+        key = (query, params)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > self.clock():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def version(self, query):
+        with self.lock:
+            return self.versions[query]
+
+    def put(self, query, params, rows, version=None):
+        '''
+        Stores rows, unless the query was invalidated since version was read
+        '''
+        key = (query, params)
+        with self.lock:
+            if version is not None and version != self.versions[query]:
+                return
+            self.entries[key] = (self.clock() + self.ttl, rows)
+            self.entries.move_to_end(key)
+            self.keys_by_query[query].add(params)
+            while len(self.entries) > self.maxsize:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, query, params=None):
+        '''
+        Drops the cached results of query for params, or all of them without params
+        '''
+        with self.lock:
+            self.versions[query] += 1
+            keys = [params] if params is not None else list(self.keys_by_query[query])
+            for key_params in keys:
+                self._remove((query, key_params))
+
+    def _remove(self, key):
+        if self.entries.pop(key, None) is not None:
+            self.keys_by_query[key[0]].discard(key[1])
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class QueryService:
+    """
+    Prepared, asynchronous and cached execution of the QUERIES on a cassandra Session
+    """
+
+    def __init__(self, session, cache=None, fetch_size=500):
+        self.session = session
+        self.cache = cache
+        self.fetch_size = fetch_size
+        self.statements = {name: session.prepare(query["cql"]) for name, query in QUERIES.items()}
+        self.inserts = {table: session.prepare(cql) for table, (cql, _) in INSERTS.items()}
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def query_async(self, name, *params, max_rows=None):
+        '''
+        Runs one of the QUERIES, returns a concurrent.futures.Future of its list of rows.
+        Pages are fetched until the partition is exhausted or max_rows rows were read.
+        Concurrent requests for the same key share one execution.
+        '''
+        if self.cache is not None:
+            rows = self.cache.get(name, params)
+            if rows is not None:
+                future = Future()
+                future.set_result(rows[:max_rows] if max_rows else rows)
+                return future
+
+        key = (name, params, max_rows)
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is not None:
+                return future
+            future = self.inflight[key] = Future()
+
+        version = self.cache.version(name) if self.cache is not None else None
+        bound = self.statements[name].bind(params)
+        bound.fetch_size = self.fetch_size
+        response = self.session.execute_async(bound)
+        rows = []
+
+        def finish(result=None, error=None):
+            with self.lock:
+                self.inflight.pop(key, None)
+            if error is not None:
+                future.set_exception(error)
+                return
+            # a result cut at max_rows is not the whole answer and is not cached
+            complete = not response.has_more_pages
+            if self.cache is not None and complete:
+                self.cache.put(name, params, result, version)
+            future.set_result(result[:max_rows] if max_rows else result)
+
+        def on_page(page):
+            try:
+                rows.extend(page)
+                if response.has_more_pages and (max_rows is None or len(rows) < max_rows):
+                    response.start_fetching_next_page()
+                else:
+                    finish(rows)
+            except Exception as error:
+                finish(error=error)
+
+        response.add_callbacks(callback=on_page, errback=lambda error: finish(error=error))
+        return future
+
+    def query(self, name, *params, max_rows=None, timeout=None):
+        '''
+        Blocking version of query_async, returns the list of rows
+        '''
+        return self.query_async(name, *params, max_rows=max_rows).result(timeout)
+
+    def write_event(self, event):
+        '''
+        Writes an event to the three tables and invalidates the cached results it changes
+        '''
+        for table, (_, fields) in INSERTS.items():
+            self.session.execute(self.inserts[table], [event[field] for field in fields])
+        if self.cache is not None:
+            for name, query in QUERIES.items():
+                self.cache.invalidate(name, tuple(event[field] for field in query["params"]))
+
+
+def create_tables(session):
+    for query in TABLE_CREATES.values():
+        session.execute(query)
+
+
+def load_events(service, path='event_datafile_new.csv'):
+    '''
+    Loads the events of the CSV into the three tables, returns the number of events
+    '''
+    events = 0
+    for event in read_events(path):
+        service.write_event(event)
+        events += 1
+    return events
@@ -0,0 +1,224 @@
+"""
+Bulk reader for the song and log JSON files.
+
+Every song file holds a single record and a log file a few hundred, so building
+one DataFrame per file with pd.read_json costs far more than parsing. This reader
+takes the whole file list, reads chunks of files on worker threads, parses each
+chunk in one call (pyarrow's JSON reader with an explicit schema, or orjson/json
+line by line without pyarrow) and yields one DataFrame per chunk with compact
+dtypes: categoricals for level, gender and page and 32-bit integer IDs.
+
+    python bulk_reader.py --benchmark data/song_data
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    from pyarrow import json as pa_json
+except ImportError:
+    pa = None
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+
+BATCH_SIZE = 2000
+
+SONG_DTYPES = {
+    "num_songs": "int32",
+    "artist_id": "object",
+    "artist_latitude": "float64",
+    "artist_longitude": "float64",
+    "artist_location": "object",
+    "artist_name": "object",
+    "song_id": "object",
+    "title": "object",
+    "duration": "float64",
+    "year": "int32"
+}
+
+LOG_DTYPES = {
+    "artist": "object",
+    "auth": "category",
+    "firstName": "object",
+    "gender": "category",
+    "itemInSession": "int32",
+    "lastName": "object",
+    "length": "float64",
+    "level": "category",
+    "location": "object",
+    "method": "category",
+    "page": "category",
+    "registration": "float64",
+    "sessionId": "int32",
+    "song": "object",
+    "status": "int16",
+    "ts": "int64",
+    "userAgent": "object",
+    "userId": "Int32"
+}
+
+# how the fields are parsed, before conversion to the dtypes above
+ARROW_TYPES = {
+    "int32": "int64",
+    "int16": "int64",
+    "int64": "int64",
+    "float64": "float64",
+    "object": "string",
+    "category": "string"
+}
+
+
+def arrow_schema(dtypes):
+    # userId is "" for logged out users, parse it as a string and convert it after
+    return pa.schema([(name, pa.string() if dtype == "Int32" else getattr(pa, ARROW_TYPES[dtype])())
+                      for name, dtype in dtypes.items()])
+
+
+def find_files(filepath):
+    '''
+    All the .json files below filepath, sorted within each directory
+    '''
+    all_files = []
+    for root, dirs, files in os.walk(filepath):
+        all_files.extend(os.path.abspath(os.path.join(root, f)) for f in sorted(files) if f.endswith(".json"))
+    return all_files
+
+
+def read_file(fname):
+    with open(fname, "rb") as f:
+        return f.read().strip()
+
+
+def parse_chunk(blobs, dtypes):
+    '''
+    Parses the newline delimited records of a chunk of files into one DataFrame
+    '''
+    buffer = b"\n".join(blob for blob in blobs if blob)
+    if not buffer:
+        return pd.DataFrame({name: pd.Series(dtype=dtype) for name, dtype in dtypes.items()})
+
+    if pa is not None:
+        table = pa_json.read_json(
+            pa.py_buffer(buffer),
+            read_options=pa_json.ReadOptions(use_threads=False, block_size=len(buffer) + 1),
+            parse_options=pa_json.ParseOptions(explicit_schema=arrow_schema(dtypes),
+                                               unexpected_field_behavior="ignore"))
+        df = table.to_pandas()
+    else:
+        records = [loads(line) for line in buffer.splitlines() if line.strip()]
+        df = pd.DataFrame.from_records(records, columns=list(dtypes))
+
+    if "userId" in dtypes:
+        df["userId"] = pd.to_numeric(df["userId"], errors="coerce")
+    return df.astype(dtypes)
+
+
+def read_chunk(files, dtypes):
+    return parse_chunk([read_file(fname) for fname in files], dtypes)
+
+
+def read_batches(files, dtypes, batch_size=BATCH_SIZE, workers=None, chunk_reader=read_chunk):
+    '''
+    Yields (files, DataFrame) for every batch_size files, in file order.
+    Chunks are read and parsed with chunk_reader(files, dtypes) on `workers` threads,
+    with at most two chunks per worker in flight so memory stays bounded on large trees.
+    '''
+    workers = workers or min(8, os.cpu_count() or 1)
+    chunks = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for chunk in chunks:
+            pending.append((chunk, executor.submit(chunk_reader, chunk, dtypes)))
+            if len(pending) >= 2 * workers:
+                chunk, future = pending.pop(0)
+                yield chunk, future.result()
+        for chunk, future in pending:
+            yield chunk, future.result()
+
+
+def read_song_batches(files, **kwargs):
+    return read_batches(files, SONG_DTYPES, **kwargs)
+
+
+def read_log_batches(files, **kwargs):
+    return read_batches(files, LOG_DTYPES, **kwargs)
+
+
+# BENCHMARK
+
+def peak_memory_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def read_per_file(files):
+    '''
+    Baseline: one pd.read_json call per file, as process_song_file/process_log_file do
+    '''
+    return pd.concat([pd.read_json(fname, lines=True) for fname in files], ignore_index=True)
+
+
+def benchmark(filepath, batch_size=BATCH_SIZE, workers=None, limit=None):
+    '''
+    Reads every file below filepath per file and in batches, and reports files/sec
+    and the memory taken by the records. Peak RSS is for the whole process.
+    '''
+    files = find_files(filepath)[:limit]
+    dtypes = LOG_DTYPES if os.path.basename(os.path.normpath(filepath)).startswith("log") else SONG_DTYPES
+    print("{} files found in {}".format(len(files), filepath))
+
+    start = time.time()
+    batch_files = 0
+    batch_rows = 0
+    batch_bytes = 0
+    for chunk, df in read_batches(files, dtypes, batch_size=batch_size, workers=workers):
+        batch_files += len(chunk)
+        batch_rows += len(df)
+        batch_bytes += df.memory_usage(deep=True).sum()
+    bulk_seconds = time.time() - start
+    bulk_peak = peak_memory_mb()
+
+    start = time.time()
+    df = read_per_file(files)
+    per_file_seconds = time.time() - start
+
+    rows = [
+        ("per file", len(files), len(df), per_file_seconds, df.memory_usage(deep=True).sum()),
+        ("bulk", batch_files, batch_rows, bulk_seconds, batch_bytes)
+    ]
+    print("{:<10} {:>8} {:>10} {:>10} {:>12} {:>12}".format("reader", "files", "rows", "seconds", "files/sec",
+                                                          "records MB"))
+    for name, num_files, num_rows, seconds, size in rows:
+        print("{:<10} {:>8} {:>10} {:>10.2f} {:>12.0f} {:>12.1f}".format(
+            name, num_files, num_rows, seconds, num_files / seconds if seconds else 0, size / 2 ** 20))
+    print("peak RSS after bulk read {:.0f} MB, after both {:.0f} MB".format(bulk_peak, peak_memory_mb()))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk reader for the Sparkify song and log JSON files")
+    parser.add_argument("--benchmark", metavar="DIR", required=True,
+                        help="song_data or log_data directory to read, e.g. one written by sparkify.generator")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--limit", type=int, help="read only the first LIMIT files")
+    args = parser.parse_args()
+
+    benchmark(args.benchmark, batch_size=args.batch_size, workers=args.workers, limit=args.limit)
+
+
+if __name__ == "__main__":
+    main()
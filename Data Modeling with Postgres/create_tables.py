@@ -1,5 +1,11 @@
-import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+import argparse
+import os
+import sys
+import rollups
+from sql_queries import create_table_queries, create_table_queries_partitioned, create_index_queries, drop_table_queries
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from sparkify import db
 
 
 def create_database():
@@ -9,7 +15,7 @@ def create_database():
     """
     
     # connect to default database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=studentdb user=student password=student")
+    conn = db.connect("host=127.0.0.1 dbname=studentdb user=student password=student")
     conn.set_session(autocommit=True)
     cur = conn.cursor()
     
@@ -21,7 +27,7 @@ def create_database():
     conn.close()    
     
     # connect to sparkify database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    conn = db.connect(db.POSTGRES_DSN)
     cur = conn.cursor()
     
     return cur, conn
@@ -29,21 +35,30 @@ def create_database():
 
 def drop_tables(cur, conn):
     """
-    Drops each table using the queries in `drop_table_queries` list.
+    Drops each table using the queries in `drop_table_queries` list, and the
+    songplays rollups with their watermarks.
     """
     for query in drop_table_queries:
         cur.execute(query)
         conn.commit()
+    rollups.drop_rollups(cur, conn)
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, partitioned=False):
     """
     Creates each table using the queries in `create_table_queries` list. 
+    With partitioned, songplays is partitioned by month of start_time and the
+    indexes in `create_index_queries` are created as well.
     """
-    for query in create_table_queries:
+    for query in create_table_queries_partitioned if partitioned else create_table_queries:
         cur.execute(query)
         conn.commit()
 
+    if partitioned:
+        for query in create_index_queries:
+            cur.execute(query)
+            conn.commit()
+
 
 def main():
     """
@@ -58,10 +73,19 @@ def main():
     
     - Finally, closes the connection. 
     """
+    parser = argparse.ArgumentParser(description='Create the sparkifydb tables')
+    parser.add_argument('--partitioned', action='store_true',
+                        help='partition songplays by month and create BRIN and B-tree indexes')
+    parser.add_argument('--rollups', action='store_true',
+                        help='create the songplays rollups maintained by etl.py')
+    args = parser.parse_args()
+
     cur, conn = create_database()
     
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    create_tables(cur, conn, partitioned=args.partitioned)
+    if args.rollups:
+        rollups.create_rollups(cur, conn)
 
     conn.close()
 
@@ -0,0 +1,142 @@
+"""
+Times typical dashboard queries on the plain and the partitioned schema.
+
+For each schema the database is recreated with create_tables.py, the data
+directory is loaded with etl.py and every query runs `--repeat` times after
+ANALYZE; the median time per query is reported.
+
+    python -m sparkify.generator --output data/generated --scale 10
+    python dashboard_benchmark.py --data data/generated
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import create_tables
+import etl
+from sql_queries import song_select
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from sparkify import db
+
+
+DASHBOARD_QUERIES = {
+    "plays per day of a month": ("""
+        SELECT date_trunc('day', start_time) AS day, count(*) FROM songplays
+        WHERE start_time >= %(month_start)s AND start_time < %(month_end)s
+        GROUP BY 1 ORDER BY 1
+    """),
+    "top songs of a week": ("""
+        SELECT songs.title, count(*) AS plays FROM songplays
+        JOIN songs ON songs.song_id = songplays.song_id
+        WHERE start_time >= %(week_start)s AND start_time < %(week_end)s
+        GROUP BY songs.title ORDER BY plays DESC LIMIT 10
+    """),
+    "paid plays by hour of a day": ("""
+        SELECT extract(hour FROM start_time) AS hour, count(*) FROM songplays
+        WHERE level = 'paid' AND start_time >= %(day_start)s AND start_time < %(day_end)s
+        GROUP BY 1 ORDER BY 1
+    """),
+    "history of a user": ("""
+        SELECT start_time, song_id, artist_id, session_id FROM songplays
+        WHERE user_id = %(user_id)s ORDER BY start_time DESC LIMIT 50
+    """),
+    "free users by plays": ("""
+        SELECT users.user_id, count(*) AS plays FROM users
+        JOIN songplays ON songplays.user_id = users.user_id::varchar
+        WHERE users.level = 'free'
+        GROUP BY users.user_id ORDER BY plays DESC LIMIT 10
+    """)
+}
+
+
+def query_parameters(cur):
+    '''
+    Picks the busiest month, week, day and user of the loaded data as query parameters
+    '''
+    cur.execute("SELECT date_trunc('month', start_time) FROM songplays GROUP BY 1 ORDER BY count(*) DESC LIMIT 1")
+    month_start, = cur.fetchone()
+    cur.execute("SELECT date_trunc('week', start_time) FROM songplays GROUP BY 1 ORDER BY count(*) DESC LIMIT 1")
+    week_start, = cur.fetchone()
+    cur.execute("SELECT date_trunc('day', start_time) FROM songplays GROUP BY 1 ORDER BY count(*) DESC LIMIT 1")
+    day_start, = cur.fetchone()
+    cur.execute("SELECT user_id FROM songplays GROUP BY 1 ORDER BY count(*) DESC LIMIT 1")
+    user_id, = cur.fetchone()
+    cur.execute("SELECT %s::timestamp + interval '1 month', %s::timestamp + interval '1 week', "
+                "%s::timestamp + interval '1 day'", (month_start, week_start, day_start))
+    month_end, week_end, day_end = cur.fetchone()
+    return {"month_start": month_start, "month_end": month_end, "week_start": week_start, "week_end": week_end,
+            "day_start": day_start, "day_end": day_end, "user_id": user_id}
+
+
+def song_keys(cur, limit):
+    cur.execute("SELECT songs.title, artists.name, songs.duration FROM songs "
+                "JOIN artists ON songs.artist_id = artists.artist_id ORDER BY random() LIMIT %s", (limit,))
+    return cur.fetchall()
+
+
+def time_query(cur, query, parameters, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cur.execute(query, parameters)
+        cur.fetchall()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def run_schema(data, partitioned, repeat, lookups):
+    '''
+    Recreates sparkifydb with the given schema, loads data and times the queries.
+    Returns a dict of name -> seconds, including the load.
+    '''
+    cur, conn = create_tables.create_database()
+    create_tables.create_tables(cur, conn, partitioned=partitioned)
+
+    start = time.perf_counter()
+    pool = db.ConnectionPool(db.POSTGRES_DSN, maxconn=1)
+    etl.process_data(pool, filepath=os.path.join(data, "song_data"), func=etl.process_song_batch)
+    etl.process_data(pool, filepath=os.path.join(data, "log_data"), func=etl.process_log_batch)
+    pool.closeall()
+    timings = {"load": time.perf_counter() - start}
+
+    conn.autocommit = True
+    cur.execute("ANALYZE")
+
+    parameters = query_parameters(cur)
+    for name, query in DASHBOARD_QUERIES.items():
+        timings[name] = time_query(cur, query, parameters, repeat)
+
+    keys = song_keys(cur, lookups)
+    start = time.perf_counter()
+    for key in keys:
+        cur.execute(song_select, key)
+        cur.fetchone()
+    timings["song_select x {}".format(len(keys))] = time.perf_counter() - start
+
+    conn.close()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time dashboard queries on the plain and the partitioned schema")
+    parser.add_argument("--data", default="data", help="directory with song_data and log_data")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--lookups", type=int, default=1000, help="number of song_select lookups")
+    args = parser.parse_args()
+
+    results = {}
+    for schema, partitioned in [("plain", False), ("partitioned", True)]:
+        print("loading {} schema ...".format(schema))
+        results[schema] = run_schema(args.data, partitioned, args.repeat, args.lookups)
+
+    print("{:<30} {:>12} {:>12}".format("query (median ms)", "plain", "partitioned"))
+    for name in results["plain"]:
+        print("{:<30} {:>12.1f} {:>12.1f}".format(name, results["plain"][name] * 1000,
+                                                 results["partitioned"][name] * 1000))
+
+
+if __name__ == "__main__":
+    main()
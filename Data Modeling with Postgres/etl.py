@@ -1,9 +1,38 @@
 import os
+import sys
 import glob
-import psycopg2
+import argparse
+from psycopg2.extras import execute_batch
 import pandas as pd
+import bulk_reader
+import reconcile
+import rollups
 from sql_queries import *
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from sparkify import db, metrics, profiling
+
+
+def create_partitions(cur, start_times):
+    """
+        Creates the monthly songplays partitions that start_times fall in, when songplays
+        is partitioned (create_tables.py --partitioned)
+        Arguments:
+        cur: psycopg2 Cursor
+        start_times: Series of songplay start times
+    """
+    cur.execute(songplay_partitioned_select)
+    if not cur.fetchone()[0]:
+        return
+
+    cur.execute(songplay_partition_select)
+    existing = {name for name, in cur.fetchall()}
+    for month in start_times.dt.to_period('M').unique():
+        name = 'songplays_{}_{:02d}'.format(month.year, month.month)
+        if name not in existing:
+            cur.execute(songplay_partition_create.format(name),
+                        (month.start_time.to_pydatetime(), (month + 1).start_time.to_pydatetime()))
+
 
 def process_song_file(cur, filepath):
     """
@@ -11,6 +40,7 @@ def process_song_file(cur, filepath):
         Arguments:
         cur: psycopg2 Cursor
         filepath: location of song_data JSON file
+        Returns the number of records read
     """
     # open song file
     df = pd.read_json(filepath,lines=True)
@@ -23,6 +53,11 @@ def process_song_file(cur, filepath):
     artist_data = df[["artist_id", "artist_name", "artist_location","artist_latitude","artist_longitude"]].values[0]
     cur.execute(artist_table_insert, artist_data)
 
+    # resolve the songplays loaded before this song
+    reconcile.resolve_songs(cur, [song_data[0]])
+
+    return len(df)
+
 
 def process_log_file(cur, filepath):
     """
@@ -30,10 +65,12 @@ def process_log_file(cur, filepath):
         Arguments:
         cur: psycopg2 Cursor
         filepath: location of log_data JSON file
+        Returns the number of records read
     """
  
     # open log file
     df = pd.read_json(filepath,lines=True)
+    num_records = len(df)
 
     # filter by NextSong action
     df = df[df['page'] == 'NextSong'] 
@@ -47,7 +84,7 @@ def process_log_file(cur, filepath):
     time_df = pd.DataFrame(data=time_data.values, columns=column_labels)
 
     for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
+        db.execute_prepared(cur, "time_insert", time_table_insert, list(row))
 
     # load user table
     user_df = df[["userId", "firstName", "lastName", "gender", "level"]]
@@ -57,6 +94,7 @@ def process_log_file(cur, filepath):
         cur.execute(user_table_insert, row)
 
     # insert songplay records
+    create_partitions(cur, t)
     for index, row in df.iterrows():
         
         # get songid and artistid from song and artist tables
@@ -67,13 +105,118 @@ def process_log_file(cur, filepath):
             songid, artistid = results
         else:
             songid, artistid = None, None
+            if row.song and row.artist and pd.notna(row.length):
+                cur.execute(unresolved_table_insert, (pd.to_datetime(row.ts, unit='ms'), row.userId, row.sessionId,
+                                                      row.song, row.artist, row.length))
 
         # insert songplay record
         songplay_data = (pd.to_datetime(row.ts, unit='ms'),row.userId, row.level, songid, artistid, row.sessionId,       row.location, row.userAgent)
-        cur.execute(songplay_table_insert, songplay_data)
+        db.execute_prepared(cur, "songplay_insert", songplay_table_insert, songplay_data)
+
+    return num_records
+
+
+def process_song_batch(cur, df):
+    """
+        This function loads a batch of song records from bulk_reader to song and artist table
+        Arguments:
+        cur: psycopg2 Cursor
+        df: DataFrame of song records
+        Returns the number of records read
+    """
+    song_data = df[["song_id", "title", "artist_id", "year", "duration"]]
+    execute_batch(cur, song_table_insert, list(song_data.itertuples(index=False, name=None)))
 
+    artist_data = df[["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]]
+    execute_batch(cur, artist_table_insert, list(artist_data.itertuples(index=False, name=None)))
 
-def process_data(cur, conn, filepath, func):
+    # resolve the songplays loaded before these songs
+    reconcile.resolve_songs(cur, df["song_id"].tolist())
+
+    return len(df)
+
+
+def lookup_songs(cur, df):
+    """
+        Finds the song and artist ids of every (song, artist, length) of the log records
+        with one query per batch instead of one per record
+        Returns a dict of (title, artist name, duration) -> (song_id, artist_id)
+    """
+    keys = set(df[["song", "artist", "length"]].dropna().itertuples(index=False, name=None))
+    if not keys:
+        return {}
+    cur.execute(song_batch_select, (tuple(keys),))
+    return {(title, name, duration): (song_id, artist_id) for title, name, duration, song_id, artist_id
+            in cur.fetchall()}
+
+
+def process_log_batch(cur, df):
+    """
+        This function loads a batch of log records from bulk_reader to postgre
+        Arguments:
+        cur: psycopg2 Cursor
+        df: DataFrame of log records
+        Returns the number of records read
+    """
+    num_records = len(df)
+
+    # filter by NextSong action
+    df = df[df['page'] == 'NextSong']
+    t = pd.to_datetime(df['ts'], unit='ms')
+
+    # insert time data records
+    time_df = pd.DataFrame({'start_time': t, 'hour': t.dt.hour, 'day': t.dt.day,
+                            'week': t.dt.isocalendar().week.astype('int32'), 'month': t.dt.month,
+                            'year': t.dt.year, 'weekday': t.dt.weekday}).drop_duplicates('start_time')
+    # the time and songplay inserts run once per record, prepared they are planned once per session
+    db.execute_batch_prepared(cur, "time_insert", time_table_insert, list(time_df.itertuples(index=False, name=None)))
+
+    # insert user records, the last record of a user has its current level
+    user_df = df[["userId", "firstName", "lastName", "gender", "level"]].drop_duplicates("userId", keep="last")
+    execute_batch(cur, user_table_insert, list(user_df.astype({"userId": "int64"}).itertuples(index=False, name=None)))
+
+    # insert songplay records
+    create_partitions(cur, t)
+    song_ids = lookup_songs(cur, df)
+    songplay_data = []
+    unresolved_data = []
+    for start_time, row in zip(t, df.itertuples(index=False)):
+        key = (row.song, row.artist, row.length)
+        songid, artistid = song_ids.get(key, (None, None))
+        songplay_data.append((start_time, int(row.userId), row.level, songid, artistid,
+                              row.sessionId, row.location, row.userAgent))
+        if songid is None and row.song and row.artist and pd.notna(row.length):
+            unresolved_data.append((start_time, int(row.userId), row.sessionId) + key)
+    db.execute_batch_prepared(cur, "songplay_insert", songplay_table_insert, songplay_data)
+    execute_batch(cur, unresolved_table_insert, unresolved_data)
+
+    return num_records
+
+
+def record_offsets(cur, files, stats=None):
+    """
+        Records log files as loaded in stream_offsets, by absolute path, so that
+        stream.py does not load them again
+        Arguments:
+        cur: psycopg2 Cursor
+        files: list of log files
+        stats: os.stat results of the files, taken before they were read
+    """
+    stats = stats or [os.stat(datafile) for datafile in files]
+    execute_batch(cur, stream_offset_insert, [(os.path.abspath(datafile), stat.st_size, stat.st_mtime)
+                                              for datafile, stat in zip(files, stats)])
+
+
+# loaders of log files, whose files are recorded in stream_offsets
+LOG_LOADERS = {process_log_file, process_log_batch}
+
+BATCH_READERS = {
+    process_song_batch: bulk_reader.read_song_batches,
+    process_log_batch: bulk_reader.read_log_batches
+}
+
+
+def process_data(pool, filepath, func):
     # get all files matching extension from directory
     all_files = []
     for root, dirs, files in os.walk(filepath):
@@ -85,21 +228,84 @@ def process_data(cur, conn, filepath, func):
     num_files = len(all_files)
     print('{} files found in {}'.format(num_files, filepath))
 
+    # batch loaders get their records from the bulk reader
+    if func in BATCH_READERS:
+        return process_batches(pool, all_files, func)
+
     # iterate over files and process
     for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
-        conn.commit()
+        with metrics.stage("postgres." + func.__name__) as record:
+            record.extra["file"] = datafile
+            record.bytes_read += os.path.getsize(datafile)
+            record.rows += pool.run(load, func, datafile, [datafile], record=record)
         print('{}/{} files processed.'.format(i, num_files))
 
 
+def load(cur, func, data, files):
+    """
+        Loads a file or a batch of files with func, updates the rollups and records
+        log files in stream_offsets, in the transaction that ConnectionPool.run commits
+        Returns the number of records read
+    """
+    with profiling.stage(func.__name__):
+        rows = func(cur, data) or 0
+    rollups.update_rollups(cur)
+    if func in LOG_LOADERS:
+        record_offsets(cur, files)
+    return rows
+
+
+def profiled_reader(name):
+    """
+        bulk_reader.read_chunk run as the profiling stage name, on the reader's worker thread
+    """
+    def read_chunk(files, dtypes):
+        with profiling.stage(name):
+            return bulk_reader.read_chunk(files, dtypes)
+    return read_chunk
+
+
+def process_batches(pool, all_files, func):
+    """
+        Reads all_files in batches with the bulk reader and loads every batch with func,
+        committing once per batch
+    """
+    num_files = len(all_files)
+    processed = 0
+    reader = BATCH_READERS[func](all_files, chunk_reader=profiled_reader('read_' + func.__name__))
+    for files, df in reader:
+        with metrics.stage("postgres." + func.__name__) as record:
+            record.extra["files"] = len(files)
+            record.bytes_read += sum(os.path.getsize(datafile) for datafile in files)
+            # a batch that fails on a transient error is rolled back and loaded again,
+            # on a new connection when the connection was lost
+            record.rows += pool.run(load, func, df, files, record=record)
+        processed += len(files)
+        print('{}/{} files processed.'.format(processed, num_files))
+
+
 def main():
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
-    cur = conn.cursor()
+    parser = argparse.ArgumentParser(description='Load the song and log data into sparkifydb')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='profile each stage (stacks and allocations) and write the results to DIR')
+    parser.add_argument('--statement-timeout', type=int, metavar='MS',
+                        help='cancel any statement that runs longer than MS milliseconds')
+    args = parser.parse_args()
+
+    if args.profile:
+        profiling.enable(args.profile, trace_memory=True)
+
+    # one connection at a time, replaced by a new one if it is lost during a load
+    pool = db.ConnectionPool(db.POSTGRES_DSN, maxconn=1, statement_timeout=args.statement_timeout)
+
+    process_data(pool, filepath='data/song_data', func=process_song_batch)
+    process_data(pool, filepath='data/log_data', func=process_log_batch)
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    songplays, keys = pool.run(reconcile.unresolved)
+    print('{} songplays unresolved, {} distinct songs'.format(songplays, keys))
 
-    conn.close()
+    pool.closeall()
+    profiling.close()
 
 
 if __name__ == "__main__":
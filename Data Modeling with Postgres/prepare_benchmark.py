@@ -0,0 +1,105 @@
+"""
+Statements per second of the songplay and time inserts of etl.py, with and
+without server-side prepared statements.
+
+Every mode inserts the same synthetic rows into the sparkifydb tables (created
+with create_tables.py) inside a transaction that is rolled back afterwards, so
+the database is left unchanged:
+
+    execute         one cur.execute per row, the server parses and plans each INSERT
+    prepared        one EXECUTE of the PREPAREd INSERT per row
+    batch           execute_batch, --page-size INSERTs per round trip (etl.py before)
+    batch-prepared  execute_batch of the EXECUTEs (etl.py now)
+
+    python create_tables.py
+    python prepare_benchmark.py --rows 20000 --repeat 3
+"""
+import argparse
+import datetime
+import os
+import statistics
+import sys
+import time
+
+import pandas as pd
+from psycopg2.extras import execute_batch
+
+import etl
+from sql_queries import songplay_table_insert, time_table_insert
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from sparkify import db
+
+LEVELS = ["free", "paid"]
+
+
+def synthetic_rows(rows, start=datetime.datetime(2018, 11, 1)):
+    '''
+    Time and songplay rows of rows distinct start times, one second apart
+    '''
+    times = [start + datetime.timedelta(seconds=i) for i in range(rows)]
+    time_rows = [(t, t.hour, t.day, t.isocalendar()[1], t.month, t.year, t.weekday()) for t in times]
+    songplay_rows = [(t, i % 100, LEVELS[i % 2], None, None, i % 1000, "San Francisco-Oakland-Hayward, CA",
+                      "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4)") for i, t in enumerate(times)]
+    return time_rows, songplay_rows
+
+
+def insert_rows(cur, mode, time_rows, songplay_rows, page_size):
+    if mode == "execute":
+        for row in time_rows:
+            cur.execute(time_table_insert, row)
+        for row in songplay_rows:
+            cur.execute(songplay_table_insert, row)
+    elif mode == "prepared":
+        for row in time_rows:
+            db.execute_prepared(cur, "time_insert", time_table_insert, row)
+        for row in songplay_rows:
+            db.execute_prepared(cur, "songplay_insert", songplay_table_insert, row)
+    elif mode == "batch":
+        execute_batch(cur, time_table_insert, time_rows, page_size=page_size)
+        execute_batch(cur, songplay_table_insert, songplay_rows, page_size=page_size)
+    else:
+        db.execute_batch_prepared(cur, "time_insert", time_table_insert, time_rows, page_size=page_size)
+        db.execute_batch_prepared(cur, "songplay_insert", songplay_table_insert, songplay_rows, page_size=page_size)
+
+
+def time_mode(conn, mode, time_rows, songplay_rows, page_size):
+    '''
+    Seconds to insert the rows in mode, rolled back afterwards
+    '''
+    cur = conn.cursor()
+    # partitions of a partitioned songplays are created outside the timing
+    etl.create_partitions(cur, pd.Series([row[0] for row in songplay_rows]))
+    start = time.perf_counter()
+    insert_rows(cur, mode, time_rows, songplay_rows, page_size)
+    seconds = time.perf_counter() - start
+    conn.rollback()
+    return seconds
+
+
+MODES = ["execute", "prepared", "batch", "batch-prepared"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Statements/sec of the songplay and time inserts, prepared or not")
+    parser.add_argument("--dsn", default=db.POSTGRES_DSN)
+    parser.add_argument("--rows", type=int, default=20000, help="rows inserted in each table")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each mode, the median is reported")
+    parser.add_argument("--page-size", type=int, default=100, help="statements per round trip of execute_batch")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    args = parser.parse_args()
+
+    conn = db.connect(args.dsn)
+    time_rows, songplay_rows = synthetic_rows(args.rows)
+    statements = len(time_rows) + len(songplay_rows)
+
+    print("{:<16}{:>12}{:>16}".format("mode", "seconds", "statements/s"))
+    for mode in args.modes:
+        seconds = statistics.median(time_mode(conn, mode, time_rows, songplay_rows, args.page_size)
+                                    for _ in range(args.repeat))
+        print("{:<16}{:>12.2f}{:>16.0f}".format(mode, seconds, statements / seconds))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Reconciliation of songplays loaded before their song.
+
+When song_select finds no song for a NextSong event, the songplay is loaded
+with song_id and artist_id NULL and etl.py records its (title, artist, duration)
+key in unresolved_songplays, together with start_time, user_id and session_id,
+which identify the songplay (a user plays one song at a time in a session).
+
+After every song load etl.py calls `resolve_songs` with the ids of the songs it
+just loaded: the unresolved songplays of only those songs get their ids in one
+set-based UPDATE, their keys leave the index, and the song and artist rollups
+count them.
+
+    python reconcile.py --top 20
+"""
+import argparse
+import os
+import sys
+
+import rollups
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from sparkify import db
+
+
+# unresolved songplays that the given songs resolve
+matches_select = ("""
+SELECT unresolved_songplays.start_time, unresolved_songplays.user_id, unresolved_songplays.session_id,
+       songs.song_id, songs.artist_id
+FROM unresolved_songplays
+JOIN songs ON songs.title = unresolved_songplays.title AND songs.duration = unresolved_songplays.duration
+JOIN artists ON artists.artist_id = songs.artist_id AND artists.name = unresolved_songplays.artist
+WHERE songs.song_id = ANY(%s)
+""")
+
+songplay_resolve = ("""
+UPDATE songplays SET song_id = matches.song_id, artist_id = matches.artist_id
+FROM ({}) AS matches
+WHERE songplays.start_time = matches.start_time
+AND songplays.user_id = matches.user_id
+AND songplays.session_id IS NOT DISTINCT FROM matches.session_id
+AND songplays.song_id IS NULL
+RETURNING songplays.songplay_id
+""").format(matches_select)
+
+unresolved_delete = ("""
+DELETE FROM unresolved_songplays USING songs, artists
+WHERE songs.title = unresolved_songplays.title AND songs.duration = unresolved_songplays.duration
+AND artists.artist_id = songs.artist_id AND artists.name = unresolved_songplays.artist
+AND songs.song_id = ANY(%s)
+""")
+
+unresolved_summary = ("""
+SELECT count(*), count(DISTINCT (title, artist, duration)) FROM unresolved_songplays
+""")
+
+unresolved_top_keys = ("""
+SELECT title, artist, duration, count(*) AS plays FROM unresolved_songplays
+GROUP BY title, artist, duration ORDER BY plays DESC LIMIT %s
+""")
+
+
+def resolve_songs(cur, song_ids):
+    """
+        Fills in song_id and artist_id of the unresolved songplays of the given songs
+        Arguments:
+        cur: psycopg2 Cursor
+        song_ids: ids of the songs just loaded
+        Returns the number of songplays resolved
+    """
+    song_ids = list(song_ids)
+    cur.execute("SELECT EXISTS ({} LIMIT 1)".format(matches_select), (song_ids,))
+    if not cur.fetchone()[0]:
+        return 0
+
+    cur.execute(songplay_resolve, (song_ids,))
+    songplay_ids = [songplay_id for songplay_id, in cur.fetchall()]
+    cur.execute(unresolved_delete, (song_ids,))
+    rollups.add_resolved(cur, songplay_ids)
+    return len(songplay_ids)
+
+
+def unresolved(cur):
+    """
+        Returns the number of unresolved songplays and of distinct unresolved keys
+    """
+    cur.execute(unresolved_summary)
+    return cur.fetchone()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the songplays whose song is not loaded yet')
+    parser.add_argument('--top', type=int, default=10, metavar='N', help='list the N most played unresolved songs')
+    parser.add_argument('--statement-timeout', type=int, metavar='MS',
+                        help='cancel any statement that runs longer than MS milliseconds')
+    args = parser.parse_args()
+
+    conn = db.connect(db.POSTGRES_DSN, statement_timeout=args.statement_timeout)
+    cur = conn.cursor()
+
+    songplays, keys = unresolved(cur)
+    print('{} songplays unresolved, {} distinct (title, artist, duration) keys'.format(songplays, keys))
+    cur.execute(unresolved_top_keys, (args.top,))
+    for title, artist, duration, plays in cur.fetchall():
+        print('{:>8}  {} - {} ({})'.format(plays, artist, title, duration))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
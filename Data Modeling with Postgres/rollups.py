@@ -0,0 +1,296 @@
+"""
+Incrementally maintained rollups of the songplays fact.
+
+Each rollup in ROLLUPS counts songplays grouped by a few key columns. The
+`rollup_watermark` table records the last songplay_id counted; `update_rollups`
+adds the songplays inserted since then to every rollup and moves the
+watermark, and etl.py calls it before each commit so the rollups change in the
+same transaction as the fact rows. It assumes a single loader: songplay ids
+must become visible in increasing order.
+
+`query_plays` answers plays-per-key questions from the smallest rollup that
+has the requested keys and counts every songplay the question does, and falls
+back to scanning songplays otherwise.
+
+    python create_tables.py --rollups
+    python etl.py
+    python rollups.py --verify
+"""
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from sparkify import db
+
+
+# name -> key columns as (column, type, expression over songplays), an optional filter
+# and the key columns whose NULL values the filter leaves out
+ROLLUPS = {
+    "plays_by_hour_level": {
+        "keys": [("hour", "timestamp", "date_trunc('hour', start_time)"), ("level", "varchar", "level")],
+        "where": "level IS NOT NULL",
+        "filtered": ["level"]
+    },
+    "plays_by_song": {
+        "keys": [("song_id", "varchar", "song_id")],
+        "where": "song_id IS NOT NULL",
+        "filtered": ["song_id"]
+    },
+    "plays_by_artist": {
+        "keys": [("artist_id", "varchar", "artist_id")],
+        "where": "artist_id IS NOT NULL",
+        "filtered": ["artist_id"]
+    },
+    "plays_by_user_day": {
+        "keys": [("user_id", "varchar", "user_id"), ("day", "date", "start_time::date")],
+        "where": None,
+        "filtered": []
+    }
+}
+
+# expressions of the rollup keys, used when a question has to be answered from songplays
+KEY_EXPRESSIONS = {column: expression for rollup in ROLLUPS.values() for column, _, expression in rollup["keys"]}
+
+watermark_table_create = ("""
+    CREATE TABLE IF NOT EXISTS rollup_watermark (
+        name varchar PRIMARY KEY,
+        songplay_id bigint NOT NULL
+    )
+""")
+
+watermark_insert = ("""
+INSERT INTO rollup_watermark (name, songplay_id) VALUES (%s, 0)
+ON CONFLICT (name) DO NOTHING
+""")
+
+watermark_select = "SELECT songplay_id FROM rollup_watermark WHERE name = %s FOR UPDATE"
+
+watermark_update = "UPDATE rollup_watermark SET songplay_id = %s WHERE name = %s"
+
+watermark_exists = "SELECT to_regclass('rollup_watermark') IS NOT NULL"
+
+watermark_table_drop = "DROP TABLE IF EXISTS rollup_watermark"
+
+
+def rollup_table_create(name):
+    rollup = ROLLUPS[name]
+    columns = ",\n".join("        {} {} NOT NULL".format(column, type_) for column, type_, _ in rollup["keys"])
+    return """
+    CREATE TABLE IF NOT EXISTS {name} (
+{columns},
+        plays bigint NOT NULL,
+        PRIMARY KEY ({keys})
+    )
+""".format(name=name, columns=columns, keys=", ".join(column for column, _, _ in rollup["keys"]))
+
+
+def rollup_select(name, incremental=False):
+    '''
+    Plays per key of a rollup over all of songplays or, with incremental, over the
+    songplay_ids between the two query parameters (exclusive, inclusive)
+    '''
+    rollup = ROLLUPS[name]
+    conditions = [rollup["where"]] if rollup["where"] else []
+    if incremental:
+        conditions.append("songplay_id > %s AND songplay_id <= %s")
+    return "SELECT {}, count(*) FROM songplays {} GROUP BY {}".format(
+        ", ".join("{} AS {}".format(expression, column) for column, _, expression in rollup["keys"]),
+        "WHERE " + " AND ".join(conditions) if conditions else "",
+        ", ".join(str(i) for i in range(1, len(rollup["keys"]) + 1)))
+
+
+def rollup_upsert(name):
+    keys = ", ".join(column for column, _, _ in ROLLUPS[name]["keys"])
+    return """
+INSERT INTO {name} ({keys}, plays)
+{select}
+ON CONFLICT ({keys}) DO UPDATE SET plays = {name}.plays + EXCLUDED.plays
+""".format(name=name, keys=keys, select=rollup_select(name, incremental=True))
+
+
+def create_rollups(cur, conn):
+    """
+    Creates the rollup tables and their watermarks, and counts the songplays already loaded
+    """
+    cur.execute(watermark_table_create)
+    for name in ROLLUPS:
+        cur.execute(rollup_table_create(name))
+        cur.execute(watermark_insert, (name,))
+    update_rollups(cur)
+    conn.commit()
+
+
+def drop_rollups(cur, conn):
+    """
+    Drops the rollup tables and their watermarks, so that rollups created after
+    songplays is recreated start counting from its first songplay_id again
+    """
+    for name in ROLLUPS:
+        cur.execute("DROP TABLE IF EXISTS {}".format(name))
+    cur.execute(watermark_table_drop)
+    conn.commit()
+
+
+def update_rollups(cur):
+    """
+    Adds the songplays inserted since each rollup's watermark to the rollup and moves
+    the watermark. Does not commit, so it is part of the caller's transaction.
+    Does nothing when the rollups have not been created.
+    Returns the number of songplays added per rollup.
+    """
+    cur.execute(watermark_exists)
+    if not cur.fetchone()[0]:
+        return {}
+
+    cur.execute("SELECT coalesce(max(songplay_id), 0) FROM songplays")
+    last_id, = cur.fetchone()
+
+    added = {}
+    for name in ROLLUPS:
+        cur.execute(watermark_select, (name,))
+        watermark, = cur.fetchone()
+        if watermark < last_id:
+            cur.execute(rollup_upsert(name), (watermark, last_id))
+            cur.execute(watermark_update, (last_id, name))
+        added[name] = last_id - watermark
+    return added
+
+
+def add_resolved(cur, songplay_ids):
+    """
+    Counts songplays whose song_id and artist_id were filled in after they were loaded
+    (see reconcile.py) in the rollups keyed by song or artist. Songplays above the
+    watermark are left to update_rollups.
+    """
+    cur.execute(watermark_exists)
+    if not cur.fetchone()[0] or not songplay_ids:
+        return
+
+    for name, rollup in ROLLUPS.items():
+        if not {"song_id", "artist_id"} & {column for column, _, _ in rollup["keys"]}:
+            continue
+        cur.execute(watermark_select, (name,))
+        watermark, = cur.fetchone()
+        keys = ", ".join(column for column, _, _ in rollup["keys"])
+        cur.execute("""
+            INSERT INTO {name} ({keys}, plays)
+            SELECT {keys}, count(*) FROM songplays
+            WHERE songplay_id = ANY(%s) AND songplay_id <= %s AND {where}
+            GROUP BY {keys}
+            ON CONFLICT ({keys}) DO UPDATE SET plays = {name}.plays + EXCLUDED.plays
+        """.format(name=name, keys=keys, where=rollup["where"]), (list(songplay_ids), watermark))
+
+
+def verify_rollups(cur):
+    """
+    Compares every rollup with a full recomputation from songplays, and the plays
+    query_plays counts without keys with the number of songplays
+    Returns a dict of rollup name (or query_plays) -> number of differing rows, empty when all match
+    """
+    differences = {}
+    for name, rollup in ROLLUPS.items():
+        columns = ", ".join(column for column, _, _ in rollup["keys"]) + ", plays"
+        cur.execute("""
+            SELECT count(*) FROM (
+                (SELECT {columns} FROM {name} EXCEPT ALL SELECT * FROM ({full}) AS full_{name} ({columns}))
+                UNION ALL
+                (SELECT * FROM ({full}) AS full_{name} ({columns}) EXCEPT ALL SELECT {columns} FROM {name})
+            ) AS differences
+        """.format(name=name, columns=columns, full=rollup_select(name)))
+        count, = cur.fetchone()
+        if count:
+            differences[name] = count
+
+    # a question without keys must count every songplay, whichever table answers it
+    (plays,), = query_plays(cur, [])[0]
+    cur.execute("SELECT count(*) FROM songplays")
+    total, = cur.fetchone()
+    if plays != total:
+        differences["query_plays"] = abs(total - plays)
+    return differences
+
+
+def covering_rollup(columns):
+    '''
+    Smallest rollup whose keys include all the columns, None if there is none.
+    A rollup that leaves out the NULL values of a key only covers questions on that
+    key, which leave them out too: plays_by_song cannot count all songplays.
+    '''
+    candidates = [name for name, rollup in ROLLUPS.items()
+                  if set(columns) <= {column for column, _, _ in rollup["keys"]}
+                  and set(rollup["filtered"]) <= set(columns)]
+    return min(candidates, key=lambda name: len(ROLLUPS[name]["keys"]), default=None)
+
+
+def query_plays(cur, group_by, filters=None, order_by_plays=True, limit=None):
+    """
+    Plays per group_by key, e.g. query_plays(cur, ["song_id"], limit=10) for the top songs
+    or query_plays(cur, ["level"], {"hour": datetime(2018, 11, 5, 20)}) for free vs paid.
+    Arguments:
+    cur: psycopg2 Cursor
+    group_by: list of rollup key columns (hour, level, song_id, artist_id, user_id, day),
+        songplays with a NULL group_by key are left out
+    filters: dict of key column -> value that the rows must equal
+    Returns the rows and the table they were computed from
+    """
+    filters = filters or {}
+    unknown = (set(group_by) | set(filters)) - set(KEY_EXPRESSIONS)
+    if unknown:
+        raise ValueError("Unknown rollup columns: {}".format(", ".join(sorted(unknown))))
+
+    source = covering_rollup(list(group_by) + list(filters))
+    if source is not None:
+        expressions = {column: column for column in KEY_EXPRESSIONS}
+        measure = "coalesce(sum(plays), 0)::bigint"
+        conditions = []
+    else:
+        source = "songplays"
+        expressions = KEY_EXPRESSIONS
+        measure = "count(*)"
+        # like the rollups, leave out songplays without the key
+        conditions = ["{} IS NOT NULL".format(expressions[column]) for column in group_by]
+
+    conditions += ["{} = %s".format(expressions[column]) for column in filters]
+    query = "SELECT {keys}{comma}{measure} AS plays FROM {source}{where}{group}{order}{limit}".format(
+        keys=", ".join("{} AS {}".format(expressions[column], column) for column in group_by),
+        comma=", " if group_by else "",
+        measure=measure,
+        source=source,
+        where=" WHERE " + " AND ".join(conditions) if conditions else "",
+        group=" GROUP BY " + ", ".join(expressions[column] for column in group_by) if group_by else "",
+        order=" ORDER BY plays DESC" if order_by_plays else "",
+        limit=" LIMIT {:d}".format(limit) if limit else "")
+    cur.execute(query, list(filters.values()))
+    return cur.fetchall(), source
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain and check the songplays rollups")
+    parser.add_argument("--create", action="store_true", help="create the rollups and count the loaded songplays")
+    parser.add_argument("--update", action="store_true", help="add the songplays loaded since the watermark")
+    parser.add_argument("--verify", action="store_true", help="compare the rollups with a full recomputation")
+    parser.add_argument("--statement-timeout", type=int, metavar="MS",
+                        help="cancel any statement that runs longer than MS milliseconds")
+    args = parser.parse_args()
+
+    conn = db.connect(db.POSTGRES_DSN, statement_timeout=args.statement_timeout)
+    cur = conn.cursor()
+
+    if args.create:
+        create_rollups(cur, conn)
+    if args.update:
+        print(update_rollups(cur))
+        conn.commit()
+    if args.verify:
+        differences = verify_rollups(cur)
+        for name in list(ROLLUPS) + ["query_plays"]:
+            print("{}: {}".format(name, "{} rows differ".format(differences[name]) if name in differences else "ok"))
+        if differences:
+            raise ValueError("Rollups differ from songplays: {}".format(", ".join(sorted(differences))))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
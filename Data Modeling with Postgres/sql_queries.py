@@ -5,6 +5,8 @@ user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS time;"
+unresolved_table_drop = "DROP TABLE IF EXISTS unresolved_songplays;"
+stream_offset_table_drop = "DROP TABLE IF EXISTS stream_offsets;"
 
 # CREATE TABLES
 
@@ -22,6 +24,24 @@ songplay_table_create = ("""
     )
 """)
 
+# songplays partitioned by month of start_time, the partitions are created by etl.py
+# as the load reaches new months. The primary key of a partitioned table has to
+# include the partition key.
+songplay_table_create_partitioned = ("""
+    CREATE TABLE IF NOT EXISTS songplays (
+        songplay_id serial,
+        start_time timestamp NOT NULL,
+        user_id varchar NOT NULL,
+        level varchar,
+        song_id varchar,
+        artist_id varchar,
+        session_id int,
+        location varchar,
+        user_agent text,
+        PRIMARY KEY (songplay_id, start_time)
+    ) PARTITION BY RANGE (start_time)
+""")
+
 user_table_create = ("""
     CREATE TABLE IF NOT EXISTS users (
         user_id int PRIMARY KEY,
@@ -64,6 +84,67 @@ time_table_create = ("""
     )
 """)
 
+# songplays whose song was not found when they were loaded, by the key of song_select.
+# A songplay is identified by start_time, user_id and session_id, see reconcile.py
+unresolved_table_create = ("""
+    CREATE TABLE IF NOT EXISTS unresolved_songplays (
+        start_time timestamp NOT NULL,
+        user_id varchar NOT NULL,
+        session_id int,
+        title varchar NOT NULL,
+        artist varchar NOT NULL,
+        duration float NOT NULL
+    )
+""")
+
+unresolved_key_index = ("""
+CREATE INDEX IF NOT EXISTS unresolved_songplays_key_idx ON unresolved_songplays (title, artist, duration)
+""")
+
+# log files already loaded, by etl.py or stream.py, by absolute path
+stream_offset_table_create = ("""
+    CREATE TABLE IF NOT EXISTS stream_offsets (
+        path varchar PRIMARY KEY,
+        size bigint NOT NULL,
+        modified timestamp NOT NULL,
+        loaded_at timestamp NOT NULL DEFAULT now()
+    )
+""")
+
+# INDEXES
+
+# songplays and time are loaded in start_time order, so block ranges make small BRIN indexes
+songplay_start_time_index = "CREATE INDEX IF NOT EXISTS songplays_start_time_brin ON songplays USING brin (start_time)"
+time_year_month_index = "CREATE INDEX IF NOT EXISTS time_year_month_brin ON time USING brin (year, month)"
+
+# song_select: songs by title and duration, artists by name
+song_title_index = "CREATE INDEX IF NOT EXISTS songs_title_duration_idx ON songs (title, duration)"
+artist_name_index = "CREATE INDEX IF NOT EXISTS artists_name_idx ON artists (name)"
+
+# analytic filters
+songplay_user_index = "CREATE INDEX IF NOT EXISTS songplays_user_id_idx ON songplays (user_id)"
+songplay_level_index = "CREATE INDEX IF NOT EXISTS songplays_level_start_time_idx ON songplays (level, start_time)"
+songplay_song_index = "CREATE INDEX IF NOT EXISTS songplays_song_id_idx ON songplays (song_id)"
+user_level_index = "CREATE INDEX IF NOT EXISTS users_level_idx ON users (level)"
+
+# PARTITIONS
+
+songplay_partitioned_select = ("""
+SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'songplays'::regclass)
+""")
+
+songplay_partition_select = ("""
+SELECT child.relname FROM pg_inherits
+JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+WHERE pg_inherits.inhparent = 'songplays'::regclass
+""")
+
+# format with the partition name, e.g. songplays_2018_11, then pass the month start and end
+songplay_partition_create = ("""
+CREATE TABLE IF NOT EXISTS {} PARTITION OF songplays
+FOR VALUES FROM (%s) TO (%s)
+""")
+
 # INSERT RECORDS
 
 songplay_table_insert = ("""
@@ -130,6 +211,27 @@ VALUES(%s, %s, %s, %s, %s, %s, %s)
 ON CONFLICT (start_time) DO NOTHING
 """)
 
+unresolved_table_insert = ("""
+INSERT INTO unresolved_songplays (
+    start_time,
+    user_id,
+    session_id,
+    title,
+    artist,
+    duration
+)
+VALUES(%s, %s, %s, %s, %s, %s)
+""")
+
+# a file loaded again by etl.py is recorded again
+stream_offset_insert = ("""
+INSERT INTO stream_offsets (path, size, modified)
+VALUES (%s, %s, to_timestamp(%s) AT TIME ZONE 'UTC')
+ON CONFLICT (path) DO UPDATE SET size = EXCLUDED.size, modified = EXCLUDED.modified, loaded_at = now()
+""")
+
+stream_offset_select = "SELECT path FROM stream_offsets"
+
 # FIND SONGS
 
 song_select = ("""
@@ -141,7 +243,18 @@ AND songs.duration = %s
 ;
 """)
 
+# song and artist ids of a batch of (title, artist name, duration) keys
+song_batch_select = ("""
+SELECT songs.title, artists.name, songs.duration, songs.song_id, songs.artist_id FROM songs
+JOIN artists on songs.artist_id = artists.artist_id
+WHERE (songs.title, artists.name, songs.duration) IN %s
+;
+""")
+
 # QUERY LISTS
 
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, unresolved_table_create, unresolved_key_index, stream_offset_table_create]
+create_table_queries_partitioned = [songplay_table_create_partitioned, user_table_create, song_table_create, artist_table_create, time_table_create, unresolved_table_create, unresolved_key_index, stream_offset_table_create]
+create_index_queries = [songplay_start_time_index, time_year_month_index, song_title_index,
+                        artist_name_index, songplay_user_index, songplay_level_index, songplay_song_index, user_level_index]
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, unresolved_table_drop, stream_offset_table_drop]
\ No newline at end of file
@@ -0,0 +1,129 @@
+"""
+Micro-batch streaming mode of the Postgres ETL.
+
+Polls the log_data directory every --trigger seconds and loads the files that
+appeared since the last micro-batch with etl.process_log_batch. The files of a
+batch are recorded in the stream_offsets table in the same transaction as their
+songplays, time and users rows (and the rollups), so after a crash a file is
+either fully loaded and skipped or not loaded at all: every file is loaded
+exactly once. etl.py records the log files it loads in the same way, so a
+stream started after a batch load only loads the files added since. Paths are
+recorded as absolute paths. Files modified in the last --settle seconds are
+left for the next batch, as they may still be written.
+
+Each batch reports to the metrics sinks (see sparkify.metrics) the delay
+between the modification time of its files and the commit that made their
+rows visible, as latency_seconds_p50 and latency_seconds_max.
+
+    python stream.py --input data/log_data --trigger 10
+"""
+import argparse
+import os
+import statistics
+import time
+
+import bulk_reader
+import etl  # also puts the repository root on sys.path
+import rollups
+from sparkify import db, metrics
+from sql_queries import stream_offset_table_create, stream_offset_select
+
+
+def new_files(log_dir, loaded, settle):
+    '''
+    The files below log_dir that are not loaded yet and were not modified in the last settle seconds
+    '''
+    cutoff = time.time() - settle
+    # find_files returns absolute paths, like those recorded in stream_offsets
+    return [datafile for datafile in bulk_reader.find_files(log_dir)
+            if datafile not in loaded and os.path.getmtime(datafile) <= cutoff]
+
+
+def load_batch(cur, conn, files):
+    """
+        Loads the files of one micro-batch and records them as loaded, in one transaction
+        Arguments:
+        cur: psycopg2 Cursor
+        conn: psycopg2 Connection
+        files: list of log files
+        Returns the number of records loaded and the latency of every file in seconds
+    """
+    stats = [os.stat(datafile) for datafile in files]
+    with metrics.stage("postgres.stream_batch") as record:
+        record.extra["files"] = len(files)
+        record.bytes_read += sum(stat.st_size for stat in stats)
+        try:
+            df = bulk_reader.read_chunk(files, bulk_reader.LOG_DTYPES)
+            record.rows += etl.process_log_batch(cur, df)
+            rollups.update_rollups(cur)
+            etl.record_offsets(cur, files, stats)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        visible = time.time()
+        latencies = [visible - stat.st_mtime for stat in stats]
+        record.extra["latency_seconds_p50"] = round(statistics.median(latencies), 3)
+        record.extra["latency_seconds_max"] = round(max(latencies), 3)
+    return record.rows, latencies
+
+
+def run(conn, log_dir, trigger=10, settle=1.0, max_files=100, once=False):
+    """
+        Loads new files from log_dir every trigger seconds until interrupted
+        Arguments:
+        conn: psycopg2 Connection
+        log_dir: directory to watch
+        trigger: seconds between micro-batches
+        settle: seconds since the last modification before a file is loaded
+        max_files: maximum number of files per micro-batch
+        once: load the files present now and stop
+    """
+    cur = conn.cursor()
+    cur.execute(stream_offset_table_create)
+    cur.execute(stream_offset_select)
+    loaded = {os.path.abspath(path) for path, in cur.fetchall()}
+    conn.commit()
+    print('{} files already loaded from {}'.format(len(loaded), log_dir))
+
+    batch = 0
+    while True:
+        started = time.time()
+        files = new_files(log_dir, loaded, settle)
+        for i in range(0, len(files), max_files):
+            batch_files = files[i:i + max_files]
+            records, latencies = load_batch(cur, conn, batch_files)
+            loaded.update(batch_files)
+            batch += 1
+            print('batch {}: {} files, {} records, latency p50 {:.1f}s max {:.1f}s'.format(
+                batch, len(batch_files), records, statistics.median(latencies), max(latencies)))
+
+        if once:
+            break
+        time.sleep(max(0.0, trigger - (time.time() - started)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load new log files into sparkifydb in micro-batches')
+    parser.add_argument('--input', default='data/log_data', help='log directory to watch')
+    parser.add_argument('--trigger', type=float, default=10, help='seconds between micro-batches')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='seconds since the last modification before a file is loaded')
+    parser.add_argument('--max-files', type=int, default=100, help='maximum number of files per micro-batch')
+    parser.add_argument('--once', action='store_true', help='load the files present now and stop')
+    parser.add_argument('--statement-timeout', type=int, metavar='MS',
+                        help='cancel any statement that runs longer than MS milliseconds')
+    args = parser.parse_args()
+
+    conn = db.connect(db.POSTGRES_DSN, statement_timeout=args.statement_timeout)
+    try:
+        run(conn, args.input, trigger=args.trigger, settle=args.settle, max_files=args.max_files, once=args.once)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
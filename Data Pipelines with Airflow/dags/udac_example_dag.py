@@ -32,14 +32,16 @@ start_operator = DummyOperator(task_id='Begin_execution',  dag=dag)
 #    sql="create_tables.sql"
 #)
 
+# sparkify-prestaged is a placeholder bucket for the parquet of `python -m sparkify.prestage --project airflow`;
+# to stage the JSON instead, use s3_bucket='udacity-dend', the log_data/song_data keys and file_format='json'
 stage_events_to_redshift = StageToRedshiftOperator(
     task_id="stage_events",
     redshift_conn_id="redshift",
     aws_credentials_id="aws_credentials",
     table="staging_events",
-    s3_bucket='udacity-dend',
-    s3_key="log_data/", 
-    json_path='s3://udacity-dend/log_json_path.json',
+    s3_bucket='sparkify-prestaged',
+    s3_key="prestaged/airflow/staging_events/part-",
+    file_format='parquet',
     region='us-west-2',
     dag=dag
 )
@@ -49,9 +51,9 @@ stage_songs_to_redshift = StageToRedshiftOperator(
     redshift_conn_id="redshift",
     aws_credentials_id="aws_credentials",
     table="staging_songs",
-    s3_bucket='udacity-dend',
-    s3_key="log_data/", 
-    json_path='auto',
+    s3_bucket='sparkify-prestaged',
+    s3_key="prestaged/airflow/staging_songs/part-",
+    file_format='parquet',
     region='us-west-2',
     dag=dag
 )
@@ -1,6 +1,7 @@
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from sparkify import metrics
 
 class DataQualityOperator(BaseOperator):
 
@@ -20,7 +21,7 @@ class DataQualityOperator(BaseOperator):
 
     def execute(self, context):
                 
-        if len(self.checks)<0:
+        if not self.checks:
             self.log.info("No data quality checks provided")
             return
         
@@ -32,11 +33,14 @@ class DataQualityOperator(BaseOperator):
             sql = check.get('check_sql')
             exp_result = check.get('expected_result')
 
-            records = redshift.get_records(sql)[0]
+            with metrics.stage("airflow.data_quality") as record:
+                record.extra.update(task_id=self.task_id, check_sql=sql)
+                records = redshift_hook.get_records(sql)[0]
+                record.rows += 1
 
             if exp_result != records[0]:
                 error_count += 1
-                failing_tests.append(sql)   
+                failing_tests.append(sql)
         
         if error_count > 0:
             raise ValueError('Data quality check failed')
@@ -1,6 +1,7 @@
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from sparkify import metrics
 
 class LoadDimensionOperator(BaseOperator):
 
@@ -28,13 +29,15 @@ class LoadDimensionOperator(BaseOperator):
 
     def execute(self, context):
         redshift_hook = PostgresHook(postgres_conn_id = self.redshift_conn_id)
-        if self.delete_load:
-            self.log.info("Running delete statement ")
-            redshift_hook.run("DELETE FROM {}".format(self.table_name))
-            
-        formatted_sql = LoadDimensionOperator.insert_sql.format(
-            self.table_name,
-            self.sql_squery
-        )
-        self.log.info(f"Executing {formatted_sql} ...")
-        redshift.run(formatted_sql)
\ No newline at end of file
+        with metrics.stage("airflow.load_dimension", table=self.table_name) as record:
+            record.extra["task_id"] = self.task_id
+            if self.delete_load:
+                self.log.info("Running delete statement ")
+                redshift_hook.run("DELETE FROM {}".format(self.table_name))
+
+            formatted_sql = LoadDimensionOperator.insert_sql.format(
+                self.table_name,
+                self.sql_query
+            )
+            self.log.info(f"Executing {formatted_sql} ...")
+            redshift_hook.run(formatted_sql)
\ No newline at end of file
@@ -1,6 +1,8 @@
+from airflow.contrib.hooks.aws_hook import AwsHook
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from sparkify import metrics
 
 class StageToRedshiftOperator(BaseOperator):
     ui_color = '#358140'
@@ -10,7 +12,7 @@ class StageToRedshiftOperator(BaseOperator):
     ACCESS_KEY_ID '{}' \
     SECRET_ACCESS_KEY '{}' \
     REGION AS '{}' \
-    FORMAT AS json '{}'; \
+    {}; \
     "    
 
     @apply_defaults
@@ -21,6 +23,7 @@ class StageToRedshiftOperator(BaseOperator):
                  s3_bucket="",
                  s3_key="",
                  json_path="auto",
+                 file_format="json",
                  region="",
                  *args, **kwargs):
 
@@ -31,28 +34,44 @@ class StageToRedshiftOperator(BaseOperator):
         self.s3_bucket = s3_bucket
         self.s3_key = s3_key
         self.json_path = json_path
+        # "parquet" for the files written by sparkify/prestage.py, json_path is not used then
+        self.file_format = file_format
         self.region = region
         self.execution_date = kwargs.get('execution_date')        
 
 
+    def format_clause(self):
+        if self.file_format.lower() == "parquet":
+            return "FORMAT AS PARQUET"
+        return "FORMAT AS json '{}'".format(self.json_path)
+
     def execute(self, context):
         aws_hook = AwsHook(self.aws_credentials_id)
         credentials = aws_hook.get_credentials()
         redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
 
-        self.log.info("Clearing data from destination Redshift table")
-        redshift.run("DELETE FROM {}".format(self.table))
-
-        self.log.info("Copying data from S3 to Redshift")
-        rendered_key = self.s3_key.format(**context)
-        s3_path = "s3://{}/{}".format(self.s3_bucket, rendered_key)
-        formatted_sql = StageToRedshiftOperator.copy_sql.format(
-            self.table,
-            s3_path,
-            credentials.access_key,
-            credentials.secret_key,
-            self.json_path,
-            self.region
-        )
-        self.log.info(f"Executing {formatted_sql} ...")
-        redshift.run(formatted_sql)
\ No newline at end of file
+        with metrics.stage("airflow.stage_to_redshift", table=self.table) as record:
+            record.extra["task_id"] = self.task_id
+            self.log.info("Clearing data from destination Redshift table")
+            redshift.run("DELETE FROM {}".format(self.table))
+
+            self.log.info("Copying data from S3 to Redshift")
+            rendered_key = self.s3_key.format(**context)
+            s3_path = "s3://{}/{}".format(self.s3_bucket, rendered_key)
+            formatted_sql = StageToRedshiftOperator.copy_query.format(
+                self.table,
+                s3_path,
+                credentials.access_key,
+                credentials.secret_key,
+                self.region,
+                self.format_clause()
+            )
+            self.log.info(f"Executing COPY into {self.table} from {s3_path} ...")
+            # pg_last_copy_count() only sees the COPY of its own session
+            conn = redshift.get_conn()
+            cur = conn.cursor()
+            cur.execute(formatted_sql)
+            cur.execute("SELECT pg_last_copy_count()")
+            record.rows += cur.fetchone()[0]
+            conn.commit()
+            conn.close()
\ No newline at end of file
@@ -0,0 +1,358 @@
+"""
+Concurrent fetcher for the WeRateDogs tweet statuses.
+
+Replaces the serial `api.get_status` loop of wrangle_act.ipynb: requests run on a
+thread pool, share a token bucket sized to the Twitter rate-limit window, and the
+completed / failed tweet ids are checkpointed so an interrupted run resumes where
+it stopped. Statuses are appended to tweet_json.txt as JSON lines, in batches.
+
+Run offline against the fake API, which replays statuses built from the archive
+with injected latency and 429 responses. Its statuses go to tweet_json.fake.txt
+unless --output is given, so a trial run leaves tweet_json.txt and its checkpoint alone:
+
+    python tweet_fetcher.py --fake
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+# statuses/show allows 900 requests per 15 minute window with user auth
+RATE_LIMIT_REQUESTS = 900
+RATE_LIMIT_WINDOW = 15 * 60
+
+# Twitter error codes for tweets that will never be available
+PERMANENT_ERROR_CODES = {34, 63, 144, 179, 421, 422}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: `capacity` requests can be made in a burst, after which
+    tokens are refilled at `rate` per second. `pause_until` empties the bucket until
+    the given time, which is used when the API answers 429. `acquire` gives up and
+    returns False once the optional `stop` event is set.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def pause_until(self, until):
+        with self.lock:
+            self.paused_until = max(self.paused_until, until)
+            self.tokens = 0
+
+    def acquire(self, stop=None):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return True
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.updated = self.paused_until
+                    wait = self.paused_until - now
+            if stop is None:
+                time.sleep(wait)
+            elif stop.wait(wait):
+                return False
+
+
+def error_status(exc):
+    """
+    Returns (HTTP status, Twitter error code) of an API exception, None when unknown
+    """
+    response = getattr(exc, "response", None)
+    status = getattr(exc, "status_code", None) or getattr(response, "status_code", None)
+    code = getattr(exc, "api_code", None)
+    return status, code
+
+
+def rate_limit_reset(exc, default_wait):
+    """
+    Returns the monotonic time at which the rate-limit window resets
+    """
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    reset = headers.get("x-rate-limit-reset")
+    if reset:
+        return time.monotonic() + max(0.0, float(reset) - time.time())
+    return time.monotonic() + default_wait
+
+
+class Checkpoint:
+    """
+    Ids that were fetched or permanently failed, persisted next to the output file.
+    The output file itself is also scanned on load so that statuses written just
+    before a crash are never fetched twice.
+    """
+
+    def __init__(self, fname, output_fname):
+        self.fname = fname
+        self.done = set()
+        self.failed = {}
+
+        if os.path.exists(fname):
+            with open(fname) as f:
+                state = json.load(f)
+            self.done.update(state.get("done", []))
+            self.failed.update(state.get("failed", {}))
+
+        if os.path.exists(output_fname):
+            with open(output_fname, encoding="utf8") as f:
+                for line in f:
+                    try:
+                        self.done.add(str(json.loads(line)["id"]))
+                    except (ValueError, KeyError):
+                        continue
+
+    def pending(self, tweet_ids, retry_failed=False):
+        skip = self.done if retry_failed else self.done | set(self.failed)
+        return [tweet_id for tweet_id in tweet_ids if tweet_id not in skip]
+
+    def save(self):
+        tmp_fname = self.fname + ".tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump({"done": sorted(self.done), "failed": self.failed}, f)
+        os.replace(tmp_fname, self.fname)
+
+
+class TweetFetcher:
+    """
+    Fetches statuses concurrently from any object with a tweepy-like
+    `get_status(tweet_id, tweet_mode=...)` method.
+    """
+
+    def __init__(self, api, output_fname="tweet_json.txt", checkpoint_fname=None,
+                 workers=8, batch_size=100, max_retries=5, rate_limit_wait=RATE_LIMIT_WINDOW,
+                 bucket=None):
+        self.api = api
+        self.output_fname = output_fname
+        self.checkpoint = Checkpoint(checkpoint_fname or output_fname + ".checkpoint.json", output_fname)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.rate_limit_wait = rate_limit_wait
+        self.bucket = bucket or TokenBucket(RATE_LIMIT_REQUESTS / RATE_LIMIT_WINDOW, RATE_LIMIT_REQUESTS)
+        self.stats = {"fetched": 0, "failed": 0, "rate_limited": 0, "retried": 0}
+        self.stats_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def fetch_one(self, tweet_id):
+        """
+        Returns (tweet_id, status json, None) or (tweet_id, None, error message),
+        or (tweet_id, None, None) when the run was stopped before the tweet was fetched
+        """
+        for attempt in range(self.max_retries + 1):
+            if not self.bucket.acquire(self.stopped):
+                return tweet_id, None, None
+            try:
+                tweet = self.api.get_status(tweet_id, tweet_mode="extended")
+                return tweet_id, tweet._json, None
+            except Exception as e:
+                status, code = error_status(e)
+                if status == 429 or code == 88:
+                    self.count("rate_limited")
+                    self.bucket.pause_until(rate_limit_reset(e, self.rate_limit_wait))
+                elif code in PERMANENT_ERROR_CODES or status in (403, 404):
+                    return tweet_id, None, str(e)
+                else:
+                    # transient error, exponential backoff with jitter
+                    if self.stopped.wait(min(60, 2 ** attempt) * random.uniform(0.5, 1.0)):
+                        return tweet_id, None, None
+                if attempt < self.max_retries:
+                    self.count("retried")
+        return tweet_id, None, "gave up after {} retries".format(self.max_retries)
+
+    def flush(self, batch):
+        if batch:
+            with open(self.output_fname, "a", encoding="utf8") as f:
+                f.write("".join(json.dumps(status) + "\n" for status in batch))
+        self.checkpoint.save()
+
+    def record(self, batch, tweet_id, status, error):
+        if status is not None:
+            batch.append(status)
+            self.checkpoint.done.add(tweet_id)
+            self.checkpoint.failed.pop(tweet_id, None)
+            self.count("fetched")
+        elif error is not None:
+            self.checkpoint.failed[tweet_id] = error
+            self.count("failed")
+
+    def run(self, tweet_ids, retry_failed=False):
+        """
+        Fetches every tweet id that is not already checkpointed
+        Returns the fetch statistics
+        """
+        tweet_ids = [str(tweet_id) for tweet_id in tweet_ids]
+        pending = self.checkpoint.pending(tweet_ids, retry_failed)
+        print("{} tweets to fetch, {} already done, {} failed previously".format(
+            len(pending), len(self.checkpoint.done), len(self.checkpoint.failed)))
+
+        start = time.time()
+        batch = []
+        processed = 0
+        ids = iter(pending)
+        self.stopped.clear()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            # only a window of ids is submitted ahead of the workers, so an interrupted
+            # run stops after the requests in progress instead of draining every id
+            in_flight = {executor.submit(self.fetch_one, tweet_id)
+                         for tweet_id in itertools.islice(ids, self.workers * 2)}
+            while in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.record(batch, *future.result())
+                    processed += 1
+                    for tweet_id in itertools.islice(ids, 1):
+                        in_flight.add(executor.submit(self.fetch_one, tweet_id))
+
+                if len(batch) >= self.batch_size:
+                    self.flush(batch)
+                    batch = []
+                    print("{}/{} tweets processed.".format(processed, len(pending)))
+        finally:
+            # completed statuses are kept even when the run is interrupted
+            self.stopped.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.flush(batch)
+            print("{}/{} tweets processed.".format(processed, len(pending)))
+
+        self.stats["elapsed"] = time.time() - start
+        print(self.stats)
+        return self.stats
+
+
+class FakeAPIError(Exception):
+
+    def __init__(self, status_code, api_code=None, message=""):
+        super(FakeAPIError, self).__init__(message or "HTTP {}".format(status_code))
+        self.status_code = status_code
+        self.api_code = api_code
+
+
+class FakeStatus:
+
+    def __init__(self, status):
+        self._json = status
+
+
+class FakeTwitterAPI:
+    """
+    Offline stand-in for tweepy.API: replays sample statuses with random latency,
+    answers 404 (code 144) for unknown ids and injects 429 responses.
+    """
+
+    def __init__(self, statuses, latency=0.05, jitter=0.05, rate_limit_probability=0.01, seed=None):
+        self.statuses = {str(status["id"]): status for status in statuses}
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_probability = rate_limit_probability
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def get_status(self, tweet_id, tweet_mode="extended"):
+        with self.lock:
+            self.calls += 1
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            rate_limited = self.random.random() < self.rate_limit_probability
+        time.sleep(delay)
+        if rate_limited:
+            raise FakeAPIError(429, 88, "Rate limit exceeded")
+        status = self.statuses.get(str(tweet_id))
+        if status is None:
+            raise FakeAPIError(404, 144, "No status found with that ID.")
+        return FakeStatus(status)
+
+
+def load_tweet_ids(archive_fname):
+    with open(archive_fname, encoding="utf8") as f:
+        return [row["tweet_id"] for row in csv.DictReader(f)]
+
+
+def sample_statuses(archive_fname, missing_fraction=0.01, seed=0):
+    """
+    Builds fake statuses from the archive, dropping a fraction of them to simulate deleted tweets
+    """
+    rnd = random.Random(seed)
+    statuses = []
+    with open(archive_fname, encoding="utf8") as f:
+        for row in csv.DictReader(f):
+            if rnd.random() < missing_fraction:
+                continue
+            statuses.append({
+                "id": int(row["tweet_id"]),
+                "id_str": row["tweet_id"],
+                "created_at": row["timestamp"],
+                "full_text": row["text"],
+                "retweet_count": rnd.randint(0, 20000),
+                "favorite_count": rnd.randint(0, 80000)
+            })
+    return statuses
+
+
+def create_api(config_fname):
+    import configparser
+    import tweepy
+
+    config = configparser.ConfigParser()
+    config.read(config_fname)
+    auth = tweepy.OAuthHandler(config.get("TWITTER", "CONSUMER_KEY"), config.get("TWITTER", "CONSUMER_SECRET"))
+    auth.set_access_token(config.get("TWITTER", "ACCESS_TOKEN"), config.get("TWITTER", "ACCESS_SECRET"))
+    # rate limits are handled by the fetcher's token bucket
+    return tweepy.API(auth, wait_on_rate_limit=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch tweet statuses for the WeRateDogs archive")
+    parser.add_argument("--archive", default="twitter-archive-enhanced.csv")
+    parser.add_argument("--output", help="defaults to tweet_json.txt, or tweet_json.fake.txt with --fake")
+    parser.add_argument("--config", default="twitter.cfg", help="config file with a [TWITTER] section")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--retry-failed", action="store_true", help="retry ids that failed in a previous run")
+    parser.add_argument("--fake", action="store_true", help="use the offline fake API")
+    parser.add_argument("--fake-latency", type=float, default=0.05)
+    parser.add_argument("--fake-rate-limit", type=float, default=0.01, help="probability of a 429 per request")
+    args = parser.parse_args()
+
+    if args.output is None:
+        args.output = "tweet_json.fake.txt" if args.fake else "tweet_json.txt"
+    tweet_ids = load_tweet_ids(args.archive)
+
+    if args.fake:
+        api = FakeTwitterAPI(sample_statuses(args.archive), latency=args.fake_latency,
+                             rate_limit_probability=args.fake_rate_limit)
+        # short window so injected 429s only pause the run for a moment
+        fetcher = TweetFetcher(api, args.output, workers=args.workers, batch_size=args.batch_size,
+                               rate_limit_wait=1, bucket=TokenBucket(rate=200, capacity=200))
+    else:
+        fetcher = TweetFetcher(create_api(args.config), args.output, workers=args.workers,
+                               batch_size=args.batch_size)
+
+    fetcher.run(tweet_ids, retry_failed=args.retry_failed)
+
+
+if __name__ == "__main__":
+    main()
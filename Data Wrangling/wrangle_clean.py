@@ -0,0 +1,268 @@
+"""
+Vectorized cleaning pipeline for the WeRateDogs data.
+
+Produces twitter_archive_master.csv from twitter-archive-enhanced.csv,
+image-predictions.tsv and tweet_json.txt in one pass, applying the same fixes
+as the Clean section of wrangle_act.ipynb as column operations instead of
+per-value replace calls. --benchmark times both and checks that they produce
+the same table.
+
+    python wrangle_clean.py
+    python wrangle_clean.py --benchmark
+"""
+import argparse
+import json
+import re
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+
+STAGE_COLUMNS = ["doggo", "floofer", "pupper", "puppo"]
+
+STATUS_COLUMNS = ["tweet_id", "retweet_count", "favorite_count"]
+
+RETWEET_COLUMNS = ["retweeted_status_id", "retweeted_status_user_id", "retweeted_status_timestamp"]
+
+# words picked up as a name by the archive's extraction, e.g. "This is a ...",
+# that the notebook replaces; other lowercase words such as 'his' are kept like there
+INVALID_NAMES = {"the", "all", "this", "very", "life", "an", "my", "O", "light", "by", "actually", "just",
+                 "mad", "not", "one", "getting", "infuriating", "old", "quite", "such", "a"}
+
+# <a href="..." rel="nofollow">Twitter for iPhone</a> -> Twitter for iPhone
+SOURCE_PATTERN = re.compile(r">(?P<source>[^<]+)<")
+
+# decimal ratings such as 13.5/10 that the archive truncated to 5/10
+DECIMAL_RATING_PATTERN = re.compile(r"(?P<numerator>\d+\.\d+)/(?P<denominator>\d+)")
+
+SOURCE_NAMES = {"Vine - Make a Scene": "Vine"}
+
+
+def load_statuses(fname):
+    '''
+    Reads tweet_id, retweet_count and favorite_count from the JSON lines file.
+    Uses pyarrow's streaming JSON reader with an explicit schema (the rest of the
+    status is never materialised) and falls back to chunked pandas reads.
+    '''
+    try:
+        import pyarrow as pa
+        from pyarrow import json as pa_json
+    except ImportError:
+        pa_json = None
+
+    if pa_json is not None:
+        schema = pa.schema([("id", pa.int64()), ("retweet_count", pa.int32()), ("favorite_count", pa.int32())])
+        table = pa_json.read_json(fname, parse_options=pa_json.ParseOptions(
+            explicit_schema=schema, unexpected_field_behavior="ignore"))
+        status_df = table.to_pandas()
+    else:
+        chunks = pd.read_json(fname, lines=True, chunksize=1000, dtype=False)
+        status_df = pd.concat([chunk[["id", "retweet_count", "favorite_count"]] for chunk in chunks],
+                              ignore_index=True)
+
+    return status_df.rename(columns={"id": "tweet_id"}) \
+        .astype({"retweet_count": "int32", "favorite_count": "int32"})
+
+
+def load_archive(fname):
+    # 'None' is the archive's placeholder for a missing name or dog stage, keep it as a string
+    return pd.read_csv(fname, keep_default_na=False, na_values=[""], dtype={"tweet_id": "int64", "in_reply_to_status_id": "float64",
+                                     "in_reply_to_user_id": "float64", "rating_numerator": "float64",
+                                     "rating_denominator": "float64"})
+
+
+def load_predictions(fname):
+    return pd.read_csv(fname, sep="\t")
+
+
+def clean_names(names):
+    '''
+    Replaces the known faulty names with 'None'
+    '''
+    return names.mask(names.isin(INVALID_NAMES), "None")
+
+
+def dog_stage(stages):
+    '''
+    Melts the doggo/floofer/pupper/puppo columns into one categorical column,
+    multiple stages are joined with a comma (e.g. 'doggo,pupper')
+    '''
+    present = stages[STAGE_COLUMNS].notna() & stages[STAGE_COLUMNS].ne("None")
+    # boolean matrix . stage labels concatenates the present stages row by row
+    merged = present.dot(pd.Index(STAGE_COLUMNS) + ",").str.rstrip(",")
+    return merged.replace("", np.nan).astype("category")
+
+
+def clean_source(source):
+    extracted = source.str.extract(SOURCE_PATTERN, expand=False).fillna(source)
+    return extracted.replace(SOURCE_NAMES).astype("category")
+
+
+def fix_ratings(df):
+    '''
+    Restores decimal numerators (13.5/10) that the archive truncated
+    '''
+    ratings = df["text"].str.extract(DECIMAL_RATING_PATTERN)
+    has_decimal = ratings["numerator"].notna()
+    df.loc[has_decimal, "rating_numerator"] = ratings.loc[has_decimal, "numerator"].astype("float64")
+    df.loc[has_decimal, "rating_denominator"] = ratings.loc[has_decimal, "denominator"].astype("float64")
+    return df
+
+
+def build_master(tac_df, img_df, status_df):
+    '''
+    Produces the twitter_archive_master table from the three raw DataFrames
+    '''
+    # original tweets with a status and an image prediction only
+    df = tac_df[tac_df["retweeted_status_id"].isna()] \
+        .merge(status_df, on="tweet_id", how="inner") \
+        .merge(img_df, on="tweet_id", how="inner")
+
+    df = df.assign(
+        name=clean_names(df["name"]),
+        dog_stage=dog_stage(df),
+        source=clean_source(df["source"]),
+        text=df["text"].str.replace("&amp;", "&", regex=False),
+        timestamp=pd.to_datetime(df["timestamp"]),
+        rating_numerator=df["rating_numerator"].astype("float64"),
+        rating_denominator=df["rating_denominator"].astype("float64")
+    ).drop(columns=STAGE_COLUMNS + RETWEET_COLUMNS)
+
+    df = fix_ratings(df)
+
+    return df.astype({"tweet_id": "str", "in_reply_to_status_id": "str", "in_reply_to_user_id": "str"})
+
+
+def run(archive_fname, predictions_fname, status_fname):
+    return build_master(load_archive(archive_fname), load_predictions(predictions_fname),
+                        load_statuses(status_fname))
+
+
+def notebook_pipeline(archive_fname, predictions_fname, status_fname):
+    '''
+    The cleaning steps as written in wrangle_act.ipynb, kept as the benchmark baseline
+    '''
+    tac_df_clean = pd.read_csv(archive_fname, keep_default_na=False, na_values=[""])
+    img_df_clean = pd.read_csv(predictions_fname, sep="\t")
+
+    df_list = []
+    with open(status_fname, "r") as json_file:
+        for line in json_file:
+            try:
+                status = json.loads(line)
+                df_list.append({"tweet_id": status["id"],
+                                "retweet_count": status["retweet_count"],
+                                "favorite_count": status["favorite_count"]})
+            except (ValueError, KeyError):
+                continue
+    status_df_clean = pd.DataFrame(df_list, columns=STATUS_COLUMNS)
+
+    for name in INVALID_NAMES:
+        tac_df_clean["name"] = tac_df_clean["name"].replace(name, "None")
+
+    for stage in STAGE_COLUMNS:
+        tac_df_clean[stage] = tac_df_clean[stage].replace("None", "")
+    tac_df_clean["dog_stage"] = tac_df_clean.doggo + tac_df_clean.floofer + tac_df_clean.pupper + tac_df_clean.puppo
+    tac_df_clean.loc[tac_df_clean.dog_stage == "doggopupper", "dog_stage"] = "doggo,pupper"
+    tac_df_clean.loc[tac_df_clean.dog_stage == "doggopuppo", "dog_stage"] = "doggo,puppo"
+    tac_df_clean.loc[tac_df_clean.dog_stage == "doggofloofer", "dog_stage"] = "doggo,floofer"
+    tac_df_clean.loc[tac_df_clean.dog_stage == "", "dog_stage"] = np.nan
+    tac_df_clean = tac_df_clean.drop(STAGE_COLUMNS, axis=1)
+
+    tac_df_clean = pd.merge(left=tac_df_clean, right=status_df_clean, left_on="tweet_id", right_on="tweet_id", how="inner")
+    tac_df_clean = tac_df_clean.merge(img_df_clean, on="tweet_id", how="inner")
+    tac_df_clean = tac_df_clean[tac_df_clean.retweeted_status_id.isnull()]
+    tac_df_clean = tac_df_clean.drop(columns=RETWEET_COLUMNS)
+    tac_df_clean = tac_df_clean[tac_df_clean.tweet_id.isin(img_df_clean.tweet_id)]
+
+    tac_df_clean["dog_stage"] = tac_df_clean["dog_stage"].astype("category")
+    tac_df_clean["timestamp"] = pd.to_datetime(tac_df_clean["timestamp"])
+    tac_df_clean["tweet_id"] = tac_df_clean["tweet_id"].astype("str")
+    tac_df_clean["in_reply_to_status_id"] = tac_df_clean["in_reply_to_status_id"].astype("str")
+    tac_df_clean["in_reply_to_user_id"] = tac_df_clean["in_reply_to_user_id"].astype("str")
+
+    for html, source in [('<a href="http://twitter.com/download/iphone" rel="nofollow">Twitter for iPhone</a>', "Twitter for iPhone"),
+                         ('<a href="http://vine.co" rel="nofollow">Vine - Make a Scene</a>', "Vine"),
+                         ('<a href="http://twitter.com" rel="nofollow">Twitter Web Client</a>', "Twitter Web Client"),
+                         ('<a href="https://about.twitter.com/products/tweetdeck" rel="nofollow">TweetDeck</a>', "TweetDeck")]:
+        tac_df_clean["source"] = tac_df_clean["source"].str.replace(html, source, regex=False)
+    tac_df_clean["source"] = tac_df_clean["source"].astype("category")
+    tac_df_clean["text"] = tac_df_clean["text"].str.replace("&amp;", "&", regex=False)
+    tac_df_clean["rating_numerator"] = tac_df_clean["rating_numerator"].astype("float")
+    tac_df_clean["rating_denominator"] = tac_df_clean["rating_denominator"].astype("float")
+
+    # the notebook corrects the truncated decimal ratings one row at a time
+    for tweet_id, rating in [("883482846933004288", [13.50, 10]), ("786709082849828864", [9.75, 10]),
+                             ("778027034220126208", [11.27, 10]), ("680494726643068929", [11.26, 10])]:
+        tac_df_clean.loc[tac_df_clean.tweet_id == tweet_id, ["rating_numerator", "rating_denominator"]] = rating
+    return tac_df_clean
+
+
+def differences(df, other_df):
+    '''
+    Returns the columns whose values differ between two master tables, compared by tweet_id
+    '''
+    if sorted(df.columns) != sorted(other_df.columns) or len(df) != len(other_df):
+        return ["<columns or rows>"]
+    columns = sorted(df.columns)
+    df = df.sort_values("tweet_id")[columns].reset_index(drop=True).astype(str)
+    other_df = other_df.sort_values("tweet_id")[columns].reset_index(drop=True).astype(str)
+    return [column for column in columns if not df[column].equals(other_df[column])]
+
+
+def measure(func, *args, repeat=5):
+    '''
+    Returns (best wall time, peak traced memory in bytes, result memory in bytes) of func(*args)
+    '''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    result = func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peak, int(result.memory_usage(deep=True).sum())
+
+
+def benchmark(archive_fname, predictions_fname, status_fname, repeat=5):
+    print("{:<12} {:>10} {:>14} {:>14}".format("pipeline", "seconds", "peak MB", "result MB"))
+    results = {}
+    for name, func in [("notebook", notebook_pipeline), ("vectorized", run)]:
+        elapsed, peak, size = measure(func, archive_fname, predictions_fname, status_fname, repeat=repeat)
+        results[name] = (elapsed, peak, size)
+        print("{:<12} {:>10.3f} {:>14.1f} {:>14.1f}".format(name, elapsed, peak / 2 ** 20, size / 2 ** 20))
+
+    different = differences(notebook_pipeline(archive_fname, predictions_fname, status_fname),
+                            run(archive_fname, predictions_fname, status_fname))
+    if different:
+        print("the tables differ in: {}".format(", ".join(different)))
+    else:
+        print("both pipelines produce the same table")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build twitter_archive_master.csv")
+    parser.add_argument("--archive", default="twitter-archive-enhanced.csv")
+    parser.add_argument("--predictions", default="image-predictions.tsv")
+    parser.add_argument("--statuses", default="tweet_json.txt")
+    parser.add_argument("--output", default="twitter_archive_master.csv")
+    parser.add_argument("--benchmark", action="store_true", help="compare against the notebook approach")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.archive, args.predictions, args.statuses)
+        return
+
+    master_df = run(args.archive, args.predictions, args.statuses)
+    master_df.to_csv(args.output)
+    print("{} rows written to {}".format(len(master_df), args.output))
+
+
+if __name__ == "__main__":
+    main()
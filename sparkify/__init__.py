@@ -0,0 +1,6 @@
+"""
+Code shared by the Sparkify projects (Postgres, Cassandra, Redshift, Spark and Airflow).
+
+The project scripts are run from their own directory, so they add the repository
+root to sys.path before importing this package.
+"""
@@ -0,0 +1,262 @@
+"""
+Cross-engine benchmark runner for the Sparkify ETLs.
+
+Runs each pipeline against a dataset written by sparkify.generator and appends
+wall time, rows/sec and peak memory to a JSON lines results file, so runs can be
+compared over time:
+
+    python -m sparkify.generator --output data/generated --scale 100
+    python -m sparkify.benchmark --data data/generated --pipelines postgres spark warehouse
+
+Every pipeline runs in its own python process, with the project directory as
+working directory, so that peak memory is measured per pipeline and the
+projects' identically named modules (etl.py, sql_queries.py) do not clash.
+Peak memory is that of the whole process tree, the Spark JVM included, sampled
+with psutil; without psutil only the python process is measured, and
+memory_scope in the results says which.
+"""
+import argparse
+import glob
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_POSTGRES_DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+
+def project_dir(name):
+    return os.path.join(REPO_ROOT, name)
+
+
+def peak_memory_mb():
+    '''
+    Peak resident memory of this process and of its terminated children, in MB
+    '''
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+class MemorySampler:
+    """
+    Samples the resident memory of this process and all its descendants, such as
+    the JVM that pyspark starts, every interval seconds and keeps the peak of the sum
+    """
+
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.process = psutil.Process()
+        self.thread = threading.Thread(target=self.sample_loop, name="sparkify-memory", daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        total = 0
+        for process in [self.process] + self.process.children(recursive=True):
+            try:
+                total += process.memory_info().rss
+            except psutil.Error:
+                # exited between listing and reading
+                pass
+        self.peak = max(self.peak, total)
+
+    def sample_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        '''
+        Stops sampling and returns the peak in MB
+        '''
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+        return self.peak / 2 ** 20
+
+
+# PIPELINES
+# each function runs inside the child process and returns the number of songplays loaded
+
+def run_postgres(data, args):
+    import create_tables
+    import etl
+    from sparkify import db
+
+    conn = db.connect(args.postgres_dsn)
+    cur = conn.cursor()
+    create_tables.drop_tables(cur, conn)
+    create_tables.create_tables(cur, conn)
+
+    pool = db.ConnectionPool(args.postgres_dsn, maxconn=1)
+    etl.process_data(pool, filepath=os.path.join(data, "song_data"), func=etl.process_song_batch)
+    etl.process_data(pool, filepath=os.path.join(data, "log_data"), func=etl.process_log_batch)
+    pool.closeall()
+
+    cur.execute("SELECT count(*) FROM songplays")
+    songplays = cur.fetchone()[0]
+    conn.close()
+    return songplays
+
+
+def spark_input_layout(data, workdir):
+    '''
+    The Spark ETL reads song-data/*/*/*/*.json and a flat log_data/*.json,
+    link the generated files into that layout
+    '''
+    input_data = os.path.join(workdir, "input") + os.sep
+    os.makedirs(os.path.join(input_data, "log_data"))
+    os.symlink(os.path.join(os.path.abspath(data), "song_data"), os.path.join(input_data, "song-data"))
+    for log_file in glob.glob(os.path.join(os.path.abspath(data), "log_data", "**", "*.json"), recursive=True):
+        os.symlink(log_file, os.path.join(input_data, "log_data", os.path.basename(log_file)))
+    return input_data
+
+
+def run_spark(data, args):
+    from pyspark.sql import SparkSession
+    import etl
+
+    workdir = tempfile.mkdtemp(prefix="sparkify-bench-")
+    try:
+        input_data = spark_input_layout(data, workdir)
+        output_data = os.path.join(workdir, "output")
+        spark = SparkSession.builder.master(args.spark_master).appName("sparkify-benchmark").getOrCreate()
+
+        etl.process_song_data(spark, input_data, output_data)
+        etl.process_log_data(spark, input_data, output_data)
+
+        songplays = spark.read.parquet(os.path.join(output_data, "songplays.parquet")).count()
+        spark.stop()
+        return songplays
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_warehouse(data, args):
+    from sparkify import warehouse
+
+    conn = warehouse.connect(data)
+    songplays = warehouse.run_cloud(conn)
+    conn.close()
+    return songplays
+
+
+PIPELINES = {
+    "postgres": ("Data Modeling with Postgres", run_postgres),
+    "spark": ("Data Lakes with Spark", run_spark),
+    "warehouse": ("Cloud Data Warehouse", run_warehouse)
+}
+
+
+def run_one(name, data, args):
+    '''
+    Child process entry point: runs one pipeline and prints its measurements as JSON
+    '''
+    directory, func = PIPELINES[name]
+    sys.path.insert(0, project_dir(directory))
+
+    sampler = MemorySampler() if psutil is not None else None
+    start = time.time()
+    songplays = func(data, args)
+    elapsed = time.time() - start
+
+    if sampler is not None:
+        memory, scope = sampler.stop(), "process tree"
+    else:
+        memory, scope = peak_memory_mb(), "python process"
+    print(json.dumps({"songplays": songplays, "wall_seconds": elapsed, "peak_memory_mb": memory,
+                      "memory_scope": scope}))
+
+
+def input_rows(data):
+    '''
+    Number of input records: one per song file plus one per log event
+    '''
+    with open(os.path.join(data, "_generator.json")) as f:
+        summary = json.load(f)
+    return summary["songs"] + summary["events"], summary
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(args):
+    rows, summary = input_rows(args.data)
+    results = []
+
+    for name in args.pipelines:
+        directory, _ = PIPELINES[name]
+        command = [sys.executable, "-m", "sparkify.benchmark", "--run-one", name,
+                   "--data", os.path.abspath(args.data),
+                   "--postgres-dsn", args.postgres_dsn, "--spark-master", args.spark_master]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])))
+
+        print("running {} ...".format(name))
+        completed = subprocess.run(command, cwd=project_dir(directory), env=env,
+                                   stdout=subprocess.PIPE, universal_newlines=True)
+        if completed.returncode != 0:
+            print("{} failed with exit code {}".format(name, completed.returncode))
+            continue
+
+        measurement = json.loads(completed.stdout.strip().splitlines()[-1])
+        result = {
+            "timestamp": datetime.utcnow().isoformat(),
+            "commit": git_commit(),
+            "host": socket.gethostname(),
+            "pipeline": name,
+            "scale": summary.get("scale"),
+            "input_rows": rows,
+            "rows_per_second": rows / measurement["wall_seconds"] if measurement["wall_seconds"] else None
+        }
+        result.update(measurement)
+        results.append(result)
+
+        with open(args.results, "a") as f:
+            f.write(json.dumps(result) + "\n")
+        print("{pipeline}: {wall_seconds:.1f}s, {rows_per_second:.0f} rows/s, "
+              "peak {peak_memory_mb:.0f} MB, {songplays} songplays".format(**result))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Sparkify ETLs on a generated dataset")
+    parser.add_argument("--data", default="data/generated", help="output directory of sparkify.generator")
+    parser.add_argument("--pipelines", nargs="+", choices=sorted(PIPELINES), default=sorted(PIPELINES))
+    parser.add_argument("--results", default="benchmark_results.jsonl")
+    parser.add_argument("--postgres-dsn", default=DEFAULT_POSTGRES_DSN)
+    parser.add_argument("--spark-master", default="local[*]")
+    parser.add_argument("--run-one", choices=sorted(PIPELINES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        run_one(args.run_one, args.data, args)
+    else:
+        args.results = os.path.abspath(args.results)
+        run_benchmarks(args)
+
+
+if __name__ == "__main__":
+    main()
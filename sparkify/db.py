@@ -0,0 +1,210 @@
+"""
+Database access shared by the Postgres and Redshift scripts.
+
+- connect: a psycopg2 connection, retried with exponential backoff while the server
+  is unreachable, with an optional statement timeout for the session
+- config_dsn: the DSN of a dwh.cfg [CLUSTER] section, by key name
+- retry: runs a unit of work again after a transient error (lost connection,
+  deadlock, serialization failure); other errors, and statements cancelled by
+  the statement timeout, are raised at once
+- ConnectionPool: connections shared by threads, every one opened with connect;
+  run retries a unit of work in its own transaction, on a new connection when
+  the connection was lost
+- prepare / execute_prepared / execute_batch_prepared: server-side prepared
+  statements for the INSERTs run once per record, PREPAREd once per session
+  and run with EXECUTE, so the server parses and plans them only once
+
+    conn = db.connect(db.POSTGRES_DSN, statement_timeout=60000)
+    cur = conn.cursor()
+    db.execute_batch_prepared(cur, "songplay_insert", songplay_table_insert, rows)
+
+    pool = db.ConnectionPool(db.POSTGRES_DSN, maxconn=1)
+    rows = pool.run(load, batch)   # load(cur, batch), committed, retried
+"""
+import contextlib
+import itertools
+import queue
+import random
+import re
+import threading
+import time
+import weakref
+
+import psycopg2
+from psycopg2 import errorcodes
+from psycopg2.extensions import make_dsn, TRANSACTION_STATUS_IDLE
+from psycopg2.extras import execute_batch
+
+POSTGRES_DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+"""Server errors worth running the transaction again for"""
+TRANSIENT_PGCODES = {
+    errorcodes.SERIALIZATION_FAILURE,
+    errorcodes.DEADLOCK_DETECTED,
+    errorcodes.LOCK_NOT_AVAILABLE,
+    errorcodes.ADMIN_SHUTDOWN,
+    errorcodes.CRASH_SHUTDOWN,
+    errorcodes.CANNOT_CONNECT_NOW,
+    errorcodes.TOO_MANY_CONNECTIONS,
+    errorcodes.CONNECTION_FAILURE
+}
+
+"""names of the statements prepared on each connection"""
+_prepared = weakref.WeakKeyDictionary()
+
+
+def config_dsn(section):
+    '''
+    DSN of a dwh.cfg [CLUSTER] section, read by key name rather than by position
+    '''
+    return make_dsn(host=section['HOST'], dbname=section['DB_NAME'], user=section['DB_USER'],
+                    password=section['DB_PASSWORD'], port=section['DB_PORT'])
+
+
+def is_transient(error):
+    '''
+    True for errors after which the same work can succeed: the connection was lost
+    or the server gave up on the transaction. A statement cancelled by the statement
+    timeout (query_canceled) is not retried.
+    '''
+    if error.pgcode is None:
+        return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+    return error.pgcode in TRANSIENT_PGCODES
+
+
+def backoff_delay(attempt, backoff=0.5, cap=30.0):
+    '''
+    Seconds to wait before retry number attempt (0-based): exponential, capped, with jitter
+    '''
+    return min(cap, backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def retry(func, retries=3, backoff=0.5, on_retry=None, record=None):
+    '''
+    Calls func until it succeeds, at most retries more times after transient errors.
+    A lost connection can neither be rolled back nor used again, so func must get its
+    connection on every call, as ConnectionPool.run does.
+    Parameters:
+        - on_retry : called with the error before waiting, e.g. to roll back
+        - record   : metrics stage record whose retries are counted
+    '''
+    for attempt in itertools.count():
+        try:
+            return func()
+        except psycopg2.Error as error:
+            if attempt >= retries or not is_transient(error):
+                raise
+            delay = backoff_delay(attempt, backoff)
+            print("transient database error ({}), retrying in {:.1f}s".format(
+                error.pgcode or type(error).__name__, delay))
+            if record is not None:
+                record.retries += 1
+            if on_retry is not None:
+                on_retry(error)
+            time.sleep(delay)
+
+
+def connect(dsn=POSTGRES_DSN, statement_timeout=None, retries=3, backoff=0.5):
+    '''
+    Connects to dsn, retrying while the server is unreachable
+    statement_timeout, in milliseconds, cancels any statement of the session that runs longer
+    '''
+    conn = retry(lambda: psycopg2.connect(dsn), retries, backoff)
+    if statement_timeout is not None:
+        with conn.cursor() as cur:
+            cur.execute("SET statement_timeout TO %s", (int(statement_timeout),))
+        conn.commit()
+    return conn
+
+
+class ConnectionPool:
+    """
+    Up to maxconn connections to dsn for concurrent threads, opened with connect
+    """
+
+    def __init__(self, dsn=POSTGRES_DSN, maxconn=4, statement_timeout=None, retries=3, backoff=0.5):
+        self.dsn = dsn
+        self.statement_timeout = statement_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(maxconn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''
+        A connection of the pool for the duration of the block. An unfinished
+        transaction is rolled back when it is returned, a broken connection discarded.
+        '''
+        self.slots.acquire()
+        conn = None
+        try:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = connect(self.dsn, self.statement_timeout, self.retries, self.backoff)
+            yield conn
+        finally:
+            if conn is not None and not conn.closed:
+                try:
+                    if conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                    self.idle.put(conn)
+                except psycopg2.Error:
+                    conn.close()
+            self.slots.release()
+
+    def run(self, func, *args, record=None):
+        '''
+        Runs func(cur, *args) in a transaction on a pooled connection and commits,
+        on another connection after a transient error. Returns the result of func.
+        '''
+        def attempt():
+            with self.connection() as conn:
+                with conn.cursor() as cur:
+                    result = func(cur, *args)
+                conn.commit()
+                return result
+
+        return retry(attempt, self.retries, self.backoff, record=record)
+
+    def closeall(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def prepare(cur, name, query):
+    '''
+    PREPAREs query (with psycopg2 %s placeholders) as name, once per session
+    Returns the EXECUTE statement to run it with, with %s placeholders for the parameters
+    '''
+    parameters = query.count("%s")
+    prepared = _prepared.setdefault(cur.connection, set())
+    if name not in prepared:
+        numbers = itertools.count(1)
+        statement = re.sub(r"%s", lambda match: "${}".format(next(numbers)), query).replace("%%", "%")
+        cur.execute("PREPARE {} AS {}".format(name, statement.strip().rstrip(";")))
+        prepared.add(name)
+    return "EXECUTE {} ({})".format(name, ", ".join(["%s"] * parameters)) if parameters else "EXECUTE " + name
+
+
+def execute_prepared(cur, name, query, params=None):
+    cur.execute(prepare(cur, name, query), params)
+
+
+def execute_batch_prepared(cur, name, query, rows, page_size=100):
+    '''
+    execute_batch of the prepared query: page_size EXECUTEs per round trip
+    '''
+    execute_batch(cur, prepare(cur, name, query), rows, page_size=page_size)
+
+
+def deallocate(cur):
+    '''
+    Forgets the statements prepared on the connection of cur
+    '''
+    cur.execute("DEALLOCATE ALL")
+    _prepared.pop(cur.connection, None)
@@ -0,0 +1,269 @@
+"""
+Synthetic Sparkify dataset generator.
+
+Writes song_data and log_data JSON in the layout and with the field names of the
+Udacity datasets read by the Postgres, Spark and Redshift ETLs:
+
+    song_data/A/B/C/TRABC....json   one song record per file
+    log_data/2018/11/2018-11-01-events.json   one event per line
+    log_json_path.json   JSONPaths file of the log fields, for COPY ... FORMAT AS JSON
+
+Artist and song popularity follow a Zipf distribution, session lengths are
+log-normal and free users upgrade (and paid users downgrade) during sessions.
+scale=1 is roughly the size of the Udacity log sample (~8k events over 30 days).
+
+    python -m sparkify.generator --output data/generated --scale 100
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import string
+from datetime import datetime, timedelta, timezone
+
+
+# sizes at scale=1
+BASE_SONGS = 1000
+BASE_ARTISTS = 300
+BASE_USERS = 100
+BASE_SESSIONS_PER_DAY = 30
+
+FIRST_NAMES = ["Walter", "Kaylee", "Ryan", "Jayden", "Jacob", "Lily", "Chloe", "Aleena", "Tegan", "Mohammad",
+               "Jordyn", "Kate", "Matthew", "Layla", "Cienna", "Ava", "Theodore", "Sara", "Rylan", "Emily"]
+LAST_NAMES = ["Frye", "Summers", "Smith", "Bell", "Klein", "Koch", "Cuevas", "Kirby", "Levine", "Rodriguez",
+              "Jones", "Harrell", "Jones", "Griffin", "Freeman", "Robinson", "Harris", "Johnson", "George", "Lee"]
+LOCATIONS = ["San Francisco-Oakland-Hayward, CA", "Phoenix-Mesa-Scottsdale, AZ", "Dallas-Fort Worth-Arlington, TX",
+             "Tampa-St. Petersburg-Clearwater, FL", "New York-Newark-Jersey City, NY-NJ-PA",
+             "Chicago-Naperville-Elgin, IL-IN-WI", "Lansing-East Lansing, MI", "Atlanta-Sandy Springs-Roswell, GA",
+             "Portland-South Portland, ME", "Houston-The Woodlands-Sugar Land, TX"]
+USER_AGENTS = [
+    "\"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36\"",
+    "\"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.153 Safari/537.36\"",
+    "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0",
+    "\"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 (KHTML, like Gecko) Version/7.0 Mobile/11D257 Safari/9537.53\"",
+    "Mozilla/5.0 (X11; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0"
+]
+WORDS = ["love", "night", "heart", "fire", "dream", "blue", "road", "light", "rain", "home", "gold", "time",
+         "dance", "summer", "river", "ghost", "wild", "stone", "city", "song", "moon", "shadow", "girl", "world"]
+
+# page mix of the events that are not a song play
+OTHER_PAGES = [("Home", 0.35), ("Thumbs Up", 0.2), ("Add to Playlist", 0.1), ("Thumbs Down", 0.08),
+               ("Add Friend", 0.07), ("Settings", 0.06), ("Help", 0.05), ("Downgrade", 0.03),
+               ("Upgrade", 0.03), ("About", 0.03)]
+# order of the staging_events columns, as in the bucket's log_json_path.json
+LOG_FIELDS = ["artist", "auth", "firstName", "gender", "itemInSession", "lastName", "length", "level", "location",
+              "method", "page", "registration", "sessionId", "song", "status", "ts", "userAgent", "userId"]
+
+NEXT_SONG_PROBABILITY = 0.8
+UPGRADE_PROBABILITY = 0.02
+DOWNGRADE_PROBABILITY = 0.005
+
+
+class ZipfSampler:
+    """
+    Draws items with probability proportional to 1 / rank ** exponent
+    """
+
+    def __init__(self, items, exponent, rnd):
+        self.items = items
+        self.cum_weights = list(itertools.accumulate(1.0 / (rank ** exponent) for rank in range(1, len(items) + 1)))
+        self.rnd = rnd
+
+    def sample(self):
+        return self.rnd.choices(self.items, cum_weights=self.cum_weights)[0]
+
+
+def random_id(rnd, prefix, length=16):
+    return prefix + "".join(rnd.choice(string.ascii_uppercase + string.digits) for _ in range(length))
+
+
+def random_title(rnd):
+    return " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 4))).title()
+
+
+def make_artists(rnd, count):
+    artists = []
+    for _ in range(count):
+        has_location = rnd.random() < 0.4
+        artists.append({
+            "artist_id": random_id(rnd, "AR"),
+            "artist_name": "{} {}".format(rnd.choice(FIRST_NAMES), random_title(rnd)),
+            "artist_location": rnd.choice(LOCATIONS) if has_location else "",
+            "artist_latitude": round(rnd.uniform(25, 49), 5) if has_location else None,
+            "artist_longitude": round(rnd.uniform(-124, -67), 5) if has_location else None
+        })
+    return artists
+
+
+def make_songs(rnd, count, artists, artist_exponent):
+    '''
+    Creates count songs, popular artists (Zipf) get more songs
+    '''
+    artist_sampler = ZipfSampler(artists, artist_exponent, rnd)
+    songs = []
+    for _ in range(count):
+        artist = artist_sampler.sample()
+        song = {"num_songs": 1}
+        song.update(artist)
+        song.update({
+            "song_id": random_id(rnd, "SO"),
+            "title": random_title(rnd),
+            "duration": round(rnd.lognormvariate(math.log(230), 0.3), 5),
+            "year": rnd.choice([0] * 4 + list(range(1960, 2011))),
+            "track_id": random_id(rnd, "TR")
+        })
+        songs.append(song)
+    return songs
+
+
+def make_users(rnd, count):
+    users = []
+    for user_id in range(1, count + 1):
+        users.append({
+            "userId": str(user_id),
+            "firstName": rnd.choice(FIRST_NAMES),
+            "lastName": rnd.choice(LAST_NAMES),
+            "gender": rnd.choice("MF"),
+            "level": "paid" if rnd.random() < 0.2 else "free",
+            "location": rnd.choice(LOCATIONS),
+            "userAgent": rnd.choice(USER_AGENTS),
+            "registration": float(rnd.randint(1535000000000, 1540000000000))
+        })
+    return users
+
+
+def write_songs(output, songs):
+    for song in songs:
+        track_id = song["track_id"]
+        song_dir = os.path.join(output, "song_data", track_id[2], track_id[3], track_id[4])
+        os.makedirs(song_dir, exist_ok=True)
+        record = {key: value for key, value in song.items() if key != "track_id"}
+        with open(os.path.join(song_dir, track_id + ".json"), "w") as f:
+            json.dump(record, f)
+
+
+def session_events(rnd, user, session_id, start_ms, song_sampler, unknown_songs, match_rate, mean_length):
+    '''
+    Yields the events of one session. Level changes apply to the rest of the session
+    and are kept on the user for the following sessions.
+    '''
+    length = max(1, int(rnd.lognormvariate(math.log(mean_length), 0.8)))
+    ts = start_ms
+    for item in range(length):
+        event = {
+            "artist": None, "auth": "Logged In", "firstName": user["firstName"], "gender": user["gender"],
+            "itemInSession": item, "lastName": user["lastName"], "length": None, "level": user["level"],
+            "location": user["location"], "method": "GET", "page": None, "registration": user["registration"],
+            "sessionId": session_id, "song": None, "status": 200, "ts": ts, "userAgent": user["userAgent"],
+            "userId": user["userId"]
+        }
+
+        if user["level"] == "free" and rnd.random() < UPGRADE_PROBABILITY:
+            event.update(page="Submit Upgrade", method="PUT", status=307)
+            user["level"] = "paid"
+        elif user["level"] == "paid" and rnd.random() < DOWNGRADE_PROBABILITY:
+            event.update(page="Submit Downgrade", method="PUT", status=307)
+            user["level"] = "free"
+        elif rnd.random() < NEXT_SONG_PROBABILITY:
+            song = song_sampler.sample() if rnd.random() < match_rate else rnd.choice(unknown_songs)
+            event.update(page="NextSong", method="PUT", artist=song["artist_name"], song=song["title"],
+                         length=song["duration"])
+        else:
+            event["page"] = rnd.choices([page for page, _ in OTHER_PAGES], [w for _, w in OTHER_PAGES])[0]
+
+        yield event
+        ts += int((event["length"] or rnd.uniform(5, 60)) * 1000)
+
+
+def write_logs(output, rnd, users, song_sampler, unknown_songs, start_date, days, sessions_per_day,
+               user_exponent, match_rate, mean_session_length):
+    '''
+    Writes one log file per day, returns the number of events written
+    '''
+    user_sampler = ZipfSampler(users, user_exponent, rnd)
+    session_ids = itertools.count(1)
+    events = 0
+    for day in range(days):
+        date = start_date + timedelta(days=day)
+        log_dir = os.path.join(output, "log_data", date.strftime("%Y"), date.strftime("%m"))
+        os.makedirs(log_dir, exist_ok=True)
+        day_ms = int(date.timestamp() * 1000)
+
+        day_events = []
+        for _ in range(sessions_per_day):
+            start_ms = day_ms + rnd.randint(0, 86400 * 1000 - 1)
+            day_events.extend(session_events(rnd, user_sampler.sample(), next(session_ids), start_ms,
+                                             song_sampler, unknown_songs, match_rate, mean_session_length))
+        day_events.sort(key=lambda event: event["ts"])
+
+        with open(os.path.join(log_dir, date.strftime("%Y-%m-%d-events.json")), "w") as f:
+            f.write("".join(json.dumps(event) + "\n" for event in day_events))
+        events += len(day_events)
+    return events
+
+
+def write_jsonpaths(output):
+    with open(os.path.join(output, "log_json_path.json"), "w") as f:
+        json.dump({"jsonpaths": ["$['{}']".format(field) for field in LOG_FIELDS]}, f, indent=4)
+
+
+def generate(output, scale=1.0, songs=None, artists=None, users=None, sessions_per_day=None, days=30,
+             start_date="2018-11-01", artist_exponent=1.1, song_exponent=1.1, user_exponent=0.8,
+             match_rate=0.5, mean_session_length=10, seed=42):
+    '''
+    Generates a dataset under output and returns a summary of what was written
+    Parameters:
+        - output             : root directory, song_data/ and log_data/ are created below it
+        - scale              : multiplier applied to the default songs/artists/users/sessions
+        - match_rate         : fraction of song plays that refer to a song present in song_data
+        - *_exponent         : Zipf exponents for artist, song and user popularity
+    '''
+    rnd = random.Random(seed)
+    songs = songs or max(1, int(BASE_SONGS * scale))
+    artists = artists or max(1, int(BASE_ARTISTS * scale))
+    users = users or max(1, int(BASE_USERS * scale))
+    sessions_per_day = sessions_per_day or max(1, int(BASE_SESSIONS_PER_DAY * scale))
+
+    artist_records = make_artists(rnd, artists)
+    song_records = make_songs(rnd, songs, artist_records, artist_exponent)
+    unknown_songs = make_songs(rnd, max(1, songs // 10), make_artists(rnd, max(1, artists // 10)), artist_exponent)
+    user_records = make_users(rnd, users)
+
+    write_songs(output, song_records)
+    events = write_logs(output, rnd, user_records, ZipfSampler(song_records, song_exponent, rnd), unknown_songs,
+                        datetime.strptime(start_date, "%Y-%m-%d").replace(tzinfo=timezone.utc), days, sessions_per_day,
+                        user_exponent, match_rate, mean_session_length)
+    write_jsonpaths(output)
+
+    summary = {"scale": scale, "songs": songs, "artists": artists, "users": users, "days": days,
+               "sessions": sessions_per_day * days, "events": events, "seed": seed}
+    with open(os.path.join(output, "_generator.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Sparkify song_data/log_data dataset")
+    parser.add_argument("--output", default="data/generated")
+    parser.add_argument("--scale", type=float, default=1.0, help="1 is about the size of the Udacity log sample")
+    parser.add_argument("--songs", type=int)
+    parser.add_argument("--artists", type=int)
+    parser.add_argument("--users", type=int)
+    parser.add_argument("--sessions-per-day", type=int)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--start-date", default="2018-11-01")
+    parser.add_argument("--match-rate", type=float, default=0.5,
+                        help="fraction of song plays that match a song in song_data")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    summary = generate(args.output, scale=args.scale, songs=args.songs, artists=args.artists, users=args.users,
+                       sessions_per_day=args.sessions_per_day, days=args.days, start_date=args.start_date,
+                       match_rate=args.match_rate, seed=args.seed)
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
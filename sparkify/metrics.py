@@ -0,0 +1,191 @@
+"""
+Lightweight per-stage instrumentation for the Sparkify ETLs.
+
+Wrap a unit of work in `stage` and fill in what is known about it:
+
+    with metrics.stage("postgres.process_song_file") as record:
+        record.extra["file"] = filepath
+        record.bytes_read += os.path.getsize(filepath)
+        ...
+        record.rows += len(df)
+
+Each finished stage reports its wall time, rows, bytes read/written, retries and
+status to the sinks configured in the SPARKIFY_METRICS environment variable, a
+comma-separated list of:
+
+    jsonl:<path>        one JSON object per stage, appended to <path> ('-' for stderr)
+    prometheus:<path>   totals per stage and labels, in the node_exporter textfile format
+
+Without SPARKIFY_METRICS nothing is emitted and `stage` only costs a timer call.
+"""
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+RUN_ID = os.environ.get("SPARKIFY_RUN_ID") or uuid.uuid4().hex[:12]
+
+COUNTERS = ["rows", "bytes_read", "bytes_written", "retries"]
+
+
+class StageRecord:
+    """
+    Measurements of one execution of a stage. `labels` identify the stage (they
+    become Prometheus labels), `extra` holds per-execution details such as a file name.
+    """
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.extra = {}
+        self.rows = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.retries = 0
+        self.status = "ok"
+        self.started = time.time()
+        self.seconds = 0.0
+
+    def as_dict(self):
+        record = {"ts": self.started, "run_id": RUN_ID, "stage": self.name, "status": self.status,
+                  "seconds": round(self.seconds, 6)}
+        record.update(self.labels)
+        record.update({counter: getattr(self, counter) for counter in COUNTERS})
+        record.update(self.extra)
+        return record
+
+
+class JsonLinesSink:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(record.as_dict(), default=str) + "\n"
+        with self.lock:
+            if self.path == "-":
+                sys.stderr.write(line)
+            else:
+                with open(self.path, "a") as f:
+                    f.write(line)
+
+    def close(self):
+        pass
+
+
+class PrometheusTextfileSink:
+    """
+    Keeps running totals per (stage, labels) and rewrites the textfile atomically,
+    at most every `interval` seconds and when the process exits.
+    """
+
+    def __init__(self, path, interval=5.0):
+        self.path = path
+        self.interval = interval
+        self.totals = {}
+        self.last_write = 0.0
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        key = (record.name, tuple(sorted(record.labels.items())))
+        with self.lock:
+            totals = self.totals.setdefault(key, dict.fromkeys(["runs", "errors", "seconds"] + COUNTERS, 0))
+            totals["runs"] += 1
+            totals["errors"] += record.status != "ok"
+            totals["seconds"] += record.seconds
+            for counter in COUNTERS:
+                totals[counter] += getattr(record, counter)
+            if time.time() - self.last_write >= self.interval:
+                self.write()
+
+    def write(self):
+        lines = []
+        for metric in ["runs", "errors", "seconds"] + COUNTERS:
+            name = "sparkify_stage_{}_total".format(metric)
+            lines.append("# TYPE {} counter".format(name))
+            for (stage, labels), totals in sorted(self.totals.items()):
+                label_text = ",".join('{}="{}"'.format(key, str(value).replace('"', '\\"'))
+                                      for key, value in (("stage", stage),) + labels)
+                lines.append("{}{{{}}} {}".format(name, label_text, totals[metric]))
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.path)
+        self.last_write = time.time()
+
+    def close(self):
+        with self.lock:
+            if self.totals:
+                self.write()
+
+
+SINK_TYPES = {
+    "jsonl": JsonLinesSink,
+    "prometheus": PrometheusTextfileSink
+}
+
+_sinks = None
+_sinks_lock = threading.Lock()
+
+
+def configure(spec=None):
+    '''
+    Sets up the sinks from a spec such as "jsonl:metrics.jsonl,prometheus:sparkify.prom",
+    defaults to the SPARKIFY_METRICS environment variable
+    '''
+    global _sinks
+    if spec is None:
+        spec = os.environ.get("SPARKIFY_METRICS", "")
+
+    sinks = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        kind, _, path = item.partition(":")
+        if kind not in SINK_TYPES or not path:
+            raise ValueError("Invalid metrics sink {!r}, expected one of {} followed by :<path>".format(
+                item, ", ".join(sorted(SINK_TYPES))))
+        sinks.append(SINK_TYPES[kind](path))
+
+    with _sinks_lock:
+        _sinks = sinks
+    return sinks
+
+
+def sinks():
+    if _sinks is None:
+        configure()
+    return _sinks
+
+
+def enabled():
+    '''
+    True when at least one sink is configured, use it to skip measurements that cost extra work
+    '''
+    return bool(sinks())
+
+
+@contextmanager
+def stage(name, **labels):
+    record = StageRecord(name, labels)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException:
+        record.status = "error"
+        raise
+    finally:
+        record.seconds = time.perf_counter() - start
+        for sink in sinks():
+            sink.emit(record)
+
+
+@atexit.register
+def close():
+    for sink in _sinks or []:
+        sink.close()
@@ -0,0 +1,340 @@
+"""
+Pre-staging of the song and log JSON as parquet for COPY ... FORMAT AS PARQUET.
+
+The staging COPYs of the Cloud Data Warehouse project and of the Airflow
+StageToRedshiftOperator used to make Redshift parse every JSON object, with a
+JSONPaths file for the log data and 'auto' for the songs, from tens of
+thousands of small song files. This step does that work once, locally:
+
+- the columns and types of each staging table are read from its CREATE TABLE
+  (sql_queries.py, create_tables.sql), IDENTITY columns left out
+- every JSON record is mapped to the columns like COPY does: by position with the
+  JSONPaths file, by lower case name with 'auto', TIMEFORMAT 'epochmillisecs'
+  for the Cloud staging_events.ts; values that do not convert are NULL. The JSONPaths
+  file is <data>/log_json_path.json (written by sparkify.generator, a copy of
+  s3://udacity-dend/log_json_path.json for the Udacity data) or --jsonpaths, and
+  pre-staging stops when it is missing
+- the source files are grouped into parts of about --target-mb of JSON, converted
+  in parallel worker processes and written as compressed parquet files named
+  <output>/<table>/part-NNNNN.parquet, which COPY loads from the part- prefix
+- <output>/<table>/_prestaged.json records the size and modification time of every
+  converted source file and the part it went into. A rerun only converts new files
+  and rewrites the parts of the files that changed or disappeared, everything when
+  the columns of the table changed
+
+    python -m sparkify.prestage --data data/generated --project airflow --workers 8
+    python -m sparkify.prestage --data "Data Lakes with Spark/Data" --project cloud --jsonpaths log_json_path.json
+    aws s3 sync data/generated/prestaged/airflow s3://sparkify-prestaged/prestaged/airflow
+
+The output defaults to <data>/prestaged/<project>, the layout the COPY statements
+read from s3://sparkify-prestaged/prestaged/<project>/, so sparkify.warehouse loads
+it from <data> like the JSON. The report compares the JSON and parquet file
+counts and bytes of every table.
+"""
+import argparse
+import datetime
+import decimal
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sparkify import metrics, warehouse
+
+MANIFEST_NAME = "_prestaged.json"
+PART_PATTERN = re.compile(r"^part-(\d+)\.parquet$")
+
+"""Staging tables of each project: table, source prefix under the data directory, JSON mapping, TIMEFORMAT"""
+PROJECTS = {
+    "cloud": [("staging_events", "log_data", "log_json_path.json", "epochmillisecs"),
+              ("staging_songs", "song_data", "auto", None)],
+    "airflow": [("staging_events", "log_data", "log_json_path.json", None),
+                ("staging_songs", "song_data", "auto", None)]
+}
+
+COLUMN_PATTERN = re.compile(r"^\s*\"?(\w+)\"?\s+(\w+(?:\s+precision)?(?:\s*\(\s*\w+\s*(?:,\s*\d+\s*)?\))?)(.*)$",
+                            re.IGNORECASE)
+
+
+def create_statements(project):
+    '''
+    CREATE TABLE statement of every table of a project, by table name
+    '''
+    if project == "cloud":
+        sql_queries, = warehouse.import_project(warehouse.CLOUD_DIRECTORY, "sql_queries")
+        statements = sql_queries.create_table_queries
+    else:
+        with open(os.path.join(warehouse.AIRFLOW_DIRECTORY, "create_tables.sql")) as f:
+            statements = warehouse.split_statements(f.read())
+    return {warehouse.unquote(warehouse.CREATE_TABLE_PATTERN.match(statement).group(1)): statement
+            for statement in statements}
+
+
+def table_columns(create_statement):
+    '''
+    (name, type) of the columns of a CREATE TABLE, in order, without IDENTITY columns
+    '''
+    body = create_statement[create_statement.index("(") + 1:create_statement.rindex(")")]
+    columns = []
+    for line in body.splitlines():
+        match = COLUMN_PATTERN.match(line.rstrip().rstrip(","))
+        if not match or match.group(1).upper() in ("CONSTRAINT", "PRIMARY", "UNIQUE", "FOREIGN"):
+            continue
+        if re.search(r"\bIDENTITY\b", match.group(3), re.IGNORECASE):
+            continue
+        columns.append((match.group(1).lower(), re.sub(r"\s+", " ", match.group(2).lower())))
+    return columns
+
+
+def arrow_type(sql_type, timeformat=None):
+    '''
+    Parquet type that COPY loads into a column of this Redshift type
+    '''
+    base = sql_type.split("(")[0].strip()
+    if base in ("varchar", "character varying", "char", "character", "text", "bpchar"):
+        return pa.string()
+    if base in ("smallint", "int2"):
+        return pa.int16()
+    if base in ("integer", "int", "int4"):
+        return pa.int32()
+    if base in ("bigint", "int8"):
+        return pa.int64()
+    if base in ("float", "float8", "double precision", "double"):
+        return pa.float64()
+    if base in ("real", "float4"):
+        return pa.float32()
+    if base in ("numeric", "decimal"):
+        precision, _, scale = sql_type[len(base):].strip("() ").partition(",")
+        return pa.decimal128(int(precision or 18), int(scale or 0))
+    if base in ("boolean", "bool"):
+        return pa.bool_()
+    if base == "timestamp":
+        return pa.timestamp("ms")
+    raise ValueError("No parquet type for {}".format(sql_type))
+
+
+def convert_value(value, data_type, timeformat=None):
+    '''
+    A JSON value converted like COPY converts it to the column type, None when it does not convert
+    '''
+    if value is None or value == "":
+        return None
+    try:
+        if pa.types.is_string(data_type):
+            return value if isinstance(value, str) else json.dumps(value)
+        if pa.types.is_integer(data_type):
+            # integers written as floats, like the registration of the log data
+            return int(value) if isinstance(value, int) else int(float(value))
+        if pa.types.is_floating(data_type):
+            return float(value)
+        if pa.types.is_decimal(data_type):
+            number = decimal.Decimal(str(value)).quantize(decimal.Decimal(1).scaleb(-data_type.scale),
+                                                          rounding=decimal.ROUND_HALF_UP)
+            return number if len(number.as_tuple().digits) <= data_type.precision else None
+        if pa.types.is_boolean(data_type):
+            return value if isinstance(value, bool) else str(value).lower() in ("true", "t", "1")
+        if pa.types.is_timestamp(data_type):
+            if timeformat == "epochmillisecs":
+                return int(float(value))
+            if timeformat == "epochsecs":
+                return int(float(value) * 1000)
+            return datetime.datetime.fromisoformat(str(value))
+    except (ValueError, TypeError, ArithmeticError):
+        return None
+    return None
+
+
+def read_records(path):
+    '''
+    The JSON objects of a file: a single object (song_data) or one per line (log_data)
+    '''
+    with open(path) as f:
+        text = f.read()
+    try:
+        return [json.loads(text)]
+    except ValueError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def convert_part(sources, fields, columns, timeformat, path, compression):
+    '''
+    Worker process: converts the JSON files sources into the parquet file path
+    Returns the number of rows and the size of the parquet file
+    '''
+    types = [arrow_type(data_type, timeformat) for _, data_type in columns]
+    values = [[] for _ in columns]
+    for source in sources:
+        for record in read_records(source):
+            for column_values, field, data_type in zip(values, fields, types):
+                column_values.append(convert_value(record.get(field), data_type, timeformat))
+
+    table = pa.table([pa.array(column_values, type=data_type) for column_values, data_type in zip(values, types)],
+                     names=[name for name, _ in columns])
+    # written under a hidden name first, so COPY never sees a partial file
+    temporary = os.path.join(os.path.dirname(path), "." + os.path.basename(path))
+    pq.write_table(table, temporary, compression=compression)
+    os.replace(temporary, path)
+    return table.num_rows, os.path.getsize(path)
+
+
+def json_fields(mapping, columns, data, jsonpaths=None):
+    '''
+    The JSON key of each column: from the JSONPaths file (jsonpaths, or the mapping under
+    the data directory), or the column name for 'auto'
+    '''
+    if mapping == "auto":
+        return [name for name, _ in columns]
+    path = jsonpaths or os.path.join(data, mapping)
+    if not os.path.exists(path):
+        # COPY ... FORMAT AS PARQUET matches columns by position, so a guessed order
+        # would load the wrong values without any error
+        raise FileNotFoundError("JSONPaths file {} not found".format(path))
+    fields = warehouse.read_jsonpaths(path)
+    if len(fields) != len(columns):
+        raise ValueError("{} JSONPaths expressions for {} columns".format(len(fields), len(columns)))
+    return fields
+
+
+def load_manifest(table_output):
+    path = os.path.join(table_output, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {"columns": None, "sources": {}, "parts": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(table_output, manifest):
+    with open(os.path.join(table_output, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+
+
+def group_files(files, target_bytes):
+    '''
+    Consecutive groups of files holding about target_bytes of JSON each
+    '''
+    groups, current, size = [], [], 0
+    for path in files:
+        current.append(path)
+        size += os.path.getsize(path)
+        if size >= target_bytes:
+            groups.append(current)
+            current, size = [], 0
+    if current:
+        groups.append(current)
+    return groups
+
+
+def prestage_table(executor, data, output, table, columns, source, mapping, timeformat, target_bytes, compression,
+                   jsonpaths=None):
+    '''
+    Converts the new and changed source files of one staging table, returns its report
+    '''
+    table_output = os.path.join(output, table)
+    os.makedirs(table_output, exist_ok=True)
+    manifest = load_manifest(table_output)
+    files = warehouse.source_files(os.path.join(data, source))
+    stats = {os.path.relpath(path, data): os.stat(path) for path in files}
+    current = {name: {"size": stat.st_size, "mtime": stat.st_mtime} for name, stat in stats.items()}
+
+    if manifest["columns"] != [list(column) for column in columns]:
+        stale_parts = set(manifest["parts"])
+    else:
+        stale_parts = {entry["part"] for name, entry in manifest["sources"].items()
+                       if {"size": entry["size"], "mtime": entry["mtime"]} != current.get(name)}
+    convert = sorted(name for name in current
+                     if name not in manifest["sources"] or manifest["sources"][name]["part"] in stale_parts)
+
+    for part in stale_parts:
+        manifest["parts"].pop(part, None)
+        if os.path.exists(os.path.join(table_output, part)):
+            os.remove(os.path.join(table_output, part))
+    manifest["sources"] = {name: entry for name, entry in manifest["sources"].items()
+                           if entry["part"] not in stale_parts and name in current}
+    manifest["columns"] = [list(column) for column in columns]
+
+    with metrics.stage("prestage.convert", table=table) as record:
+        fields = json_fields(mapping, columns, data, jsonpaths)
+        next_part = max([int(PART_PATTERN.match(part).group(1)) + 1 for part in manifest["parts"]] or [0])
+        groups = group_files([os.path.join(data, name) for name in convert], target_bytes)
+        parts = ["part-{:05d}.parquet".format(next_part + index) for index in range(len(groups))]
+        results = executor.map(convert_part, groups, [fields] * len(groups), [columns] * len(groups),
+                               [timeformat] * len(groups), [os.path.join(table_output, part) for part in parts],
+                               [compression] * len(groups))
+        for group, part, (rows, size) in zip(groups, parts, results):
+            manifest["parts"][part] = {"rows": rows, "bytes": size}
+            for path in group:
+                manifest["sources"][os.path.relpath(path, data)] = dict(current[os.path.relpath(path, data)],
+                                                                       part=part)
+            record.rows += rows
+            record.bytes_read += sum(os.path.getsize(path) for path in group)
+            record.bytes_written += size
+        save_manifest(table_output, manifest)
+
+    return {
+        "table": table,
+        "converted": len(convert),
+        "json_files": len(current),
+        "json_bytes": sum(entry["size"] for entry in current.values()),
+        "parquet_files": len(manifest["parts"]),
+        "parquet_bytes": sum(part["bytes"] for part in manifest["parts"].values()),
+        "rows": sum(part["rows"] for part in manifest["parts"].values())
+    }
+
+
+def prestage(data, project="cloud", output=None, workers=None, target_mb=128, compression="snappy",
+             jsonpaths=None):
+    '''
+    Pre-stages the staging tables of a project, returns a report per table
+    Parameters:
+        - data        : directory with song_data/, log_data/ and log_json_path.json
+        - project     : cloud or airflow, whose CREATE TABLE statements give the columns
+        - output      : parquet directory, <data>/prestaged/<project> by default
+        - workers     : worker processes, one per CPU by default
+        - target_mb   : JSON megabytes converted into each parquet file
+        - compression : parquet codec, one COPY reads (snappy, gzip, zstd)
+        - jsonpaths   : JSONPaths file of the log data, <data>/log_json_path.json by default
+    '''
+    output = output or os.path.join(data, "prestaged", project)
+    statements = create_statements(project)
+    reports = []
+    with ProcessPoolExecutor(workers) as executor:
+        for table, source, mapping, timeformat in PROJECTS[project]:
+            start = time.time()
+            report = prestage_table(executor, data, output, table, table_columns(statements[table]), source,
+                                    mapping, timeformat, target_mb * 1024 * 1024, compression, jsonpaths)
+            report["seconds"] = time.time() - start
+            reports.append(report)
+    return reports
+
+
+def print_report(reports):
+    print("{:<16}{:>10}{:>12}{:>14}{:>10}{:>14}{:>10}{:>9}".format(
+        "table", "rows", "json files", "json bytes", "parquet", "parquet bytes", "converted", "seconds"))
+    for report in reports:
+        print("{table:<16}{rows:>10}{json_files:>12}{json_bytes:>14}{parquet_files:>10}{parquet_bytes:>14}"
+              "{converted:>10}{seconds:>9.2f}".format(**report))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the song and log JSON into parquet for COPY")
+    parser.add_argument("--data", default="data/generated", help="directory with song_data/ and log_data/")
+    parser.add_argument("--project", choices=sorted(PROJECTS), default="cloud")
+    parser.add_argument("--output", help="parquet directory, <data>/prestaged/<project> by default")
+    parser.add_argument("--workers", type=int, help="worker processes, one per CPU by default")
+    parser.add_argument("--target-mb", type=float, default=128, help="JSON megabytes per parquet file")
+    parser.add_argument("--compression", default="snappy", choices=["snappy", "gzip", "zstd"])
+    parser.add_argument("--jsonpaths", help="JSONPaths file of the log data, <data>/log_json_path.json by default")
+    args = parser.parse_args()
+
+    print_report(prestage(args.data, args.project, args.output, args.workers, args.target_mb, args.compression,
+                          args.jsonpaths))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Opt-in sampling profiler for the Sparkify ETL stages.
+
+When enabled, a background thread samples the stack of every thread running a stage
+every few milliseconds, and charges it to the innermost stage of that thread. Samples are aggregated per stage name (a stage that runs
+once per input file is reported once), and `close` writes for every stage:
+
+    <stage>.collapsed   collapsed stacks, input for flamegraph.pl or speedscope
+    <stage>.top.txt     top-N functions by self and total samples, wall time, calls
+                        and, with memory tracing, the top allocation sites
+
+Sampling only reads frames, so the overhead is a few percent at the default 5 ms
+interval. Memory tracing uses tracemalloc with a single frame per allocation and
+reports the peak traced memory of each stage and where the memory it keeps was
+allocated.
+Like sparkify.metrics, `stage` is a no-op until `enable` is called.
+"""
+import collections
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class StageProfile:
+
+    def __init__(self, name):
+        self.name = name
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.calls = 0
+        self.seconds = 0.0
+        self.allocations = collections.Counter()
+        self.peak_memory = 0
+        self.last_snapshot = 0.0
+
+
+def take_snapshot():
+    '''
+    tracemalloc snapshot without the allocations of the profiler itself
+    '''
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__)
+    ])
+
+
+def frame_label(code):
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Profiler:
+
+    def __init__(self, output_dir, interval=0.005, trace_memory=False, top=20):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.trace_memory = trace_memory
+        self.top = top
+        self.profiles = {}
+        self.active = []
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self.sample_loop, name="sparkify-profiler", daemon=True)
+        self.thread.start()
+
+    def sample_loop(self):
+        while self.running:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    continue
+                # stages are entered and left in order on each thread, the last one is the innermost
+                innermost = {thread_id: profile for profile, thread_id in self.active}
+            frames = sys._current_frames()
+
+            for thread_id, profile in innermost.items():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                with self.lock:
+                    profile.stacks[";".join(reversed(stack))] += 1
+                    profile.samples += 1
+
+    @contextmanager
+    def stage(self, name):
+        with self.lock:
+            profile = self.profiles.setdefault(name, StageProfile(name))
+
+        # snapshots cost time proportional to the live allocations, so a stage that runs
+        # once per file only compares snapshots about once per second. They are taken while
+        # the stage is not active, so that the sampler does not charge them to the stage.
+        before = None
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(1)
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            if time.time() - profile.last_snapshot >= 1.0:
+                before = take_snapshot()
+                profile.last_snapshot = time.time()
+
+        with self.lock:
+            self.active.append((profile, threading.get_ident()))
+        start = time.perf_counter()
+        try:
+            yield profile
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.active.remove((profile, threading.get_ident()))
+                profile.calls += 1
+                profile.seconds += elapsed
+
+            if before is not None:
+                after = take_snapshot()
+                for stat in after.compare_to(before, "lineno"):
+                    if stat.size_diff > 0:
+                        frame = stat.traceback[0]
+                        profile.allocations["{}:{}".format(frame.filename, frame.lineno)] += stat.size_diff
+            if self.trace_memory:
+                profile.peak_memory = max(profile.peak_memory, tracemalloc.get_traced_memory()[1])
+
+    def summary(self, profile):
+        self_samples = collections.Counter()
+        total_samples = collections.Counter()
+        for stack, count in profile.stacks.items():
+            frames = stack.split(";")
+            self_samples[frames[-1]] += count
+            for frame in set(frames):
+                total_samples[frame] += count
+
+        lines = ["stage {}: {} calls, {:.3f}s wall, {} samples every {:.0f} ms".format(
+            profile.name, profile.calls, profile.seconds, profile.samples, self.interval * 1000), ""]
+
+        for title, counter in [("self", self_samples), ("total", total_samples)]:
+            lines.append("top {} functions by {} samples".format(self.top, title))
+            for frame, count in counter.most_common(self.top):
+                lines.append("{:>8} {:>6.1%}  {}".format(count, count / max(profile.samples, 1), frame))
+            lines.append("")
+
+        if self.trace_memory:
+            lines.append("peak traced memory {:.1f} MB, top {} sites of memory retained by sampled calls".format(
+                profile.peak_memory / 2 ** 20, self.top))
+            for site, size in profile.allocations.most_common(self.top):
+                lines.append("{:>12.1f} KB  {}".format(size / 2 ** 10, site))
+            lines.append("")
+        return "\n".join(lines)
+
+    def close(self):
+        '''
+        Stops sampling and writes the collapsed stacks and summary of every stage
+        '''
+        self.running = False
+        self.thread.join()
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        for name, profile in self.profiles.items():
+            fname = os.path.join(self.output_dir, name.replace(os.sep, "_"))
+            with open(fname + ".collapsed", "w") as f:
+                for stack, count in sorted(profile.stacks.items()):
+                    f.write("{} {}\n".format(stack, count))
+            with open(fname + ".top.txt", "w") as f:
+                f.write(self.summary(profile))
+        print("profiles written to {}".format(self.output_dir))
+
+
+_profiler = None
+
+
+def enable(output_dir, interval=0.005, trace_memory=False, top=20):
+    '''
+    Starts profiling every subsequent stage, results are written to output_dir by close()
+    '''
+    global _profiler
+    _profiler = Profiler(output_dir, interval=interval, trace_memory=trace_memory, top=top)
+    return _profiler
+
+
+def enabled():
+    return _profiler is not None
+
+
+@contextmanager
+def stage(name):
+    if _profiler is None:
+        yield None
+    else:
+        with _profiler.stage(name) as profile:
+            yield profile
+
+
+def close():
+    global _profiler
+    if _profiler is not None:
+        _profiler.close()
+        _profiler = None
@@ -0,0 +1,522 @@
+"""
+Embedded DuckDB backend for the Redshift star schema.
+
+Runs the create/copy/insert query lists of the Cloud Data Warehouse project
+(sql_queries.py) and the SqlQueries of the Airflow project against an embedded
+columnar database, reading local files instead of S3 (the song_data/log_data
+JSON, pre-staged as parquet by sparkify.prestage for the staging COPYs), so SQL
+changes can be tried and benchmarked without a cluster:
+
+    python -m sparkify.generator --output data/generated --scale 10
+    python -m sparkify.warehouse --data data/generated --project cloud
+    python -m sparkify.warehouse --data data/generated --project airflow --sql "SELECT count(*) FROM songplays"
+
+`connect` returns a connection with the psycopg2 methods the project scripts
+use (cursor, execute, fetchone, fetchall, rowcount, commit), so their load
+functions run unchanged. Each statement is translated first:
+
+    IDENTITY(seed, step)        a sequence and DEFAULT nextval(...)
+    distkey, sortkey, diststyle, ENCODE
+                                dropped, DuckDB decides its own layout
+    PRIMARY KEY, UNIQUE, REFERENCES
+                                dropped, Redshift does not enforce them either
+    FLOAT                       DOUBLE, FLOAT is double precision in Redshift
+    COPY ... FORMAT AS JSON     INSERT ... SELECT from read_json of the local files,
+                                with 'auto', 'auto ignorecase' or a JSONPaths file
+    COPY ... FORMAT AS PARQUET  INSERT ... SELECT from read_parquet, by column position
+    TIMEFORMAT 'epochmillisecs' epoch_ms(...)
+    TIMESTAMP 'epoch' + ts/1000 * interval '1 second'
+                                integer division as in Redshift
+    pg_last_copy_count()        rows loaded by the last COPY
+
+An S3 source s3://<bucket>/<key> is read from <data>/<key>: like COPY, every
+file whose path starts with the prefix is loaded. Values that do not convert
+to the column type are loaded as NULL rather than failing the COPY.
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+import duckdb
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.append(REPO_ROOT)
+
+from sparkify import metrics
+
+
+# TRANSLATION
+
+IDENTITY_PATTERN = re.compile(r"(\"?(\w+)\"?\s+\w+)\s+IDENTITY\s*\(\s*(-?\d+)\s*,\s*(-?\d+)\s*\)", re.IGNORECASE)
+CREATE_TABLE_PATTERN = re.compile(r"^\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?([\w.\"]+)", re.IGNORECASE)
+DROP_TABLE_PATTERN = re.compile(r"^\s*DROP\s+TABLE\s+(?:IF\s+EXISTS\s+)?([\w.\"]+)", re.IGNORECASE)
+COPY_PATTERN = re.compile(r"^\s*COPY\s+([\w.\"]+)\s*(?:\(([^)]*)\))?\s+FROM\s+'([^']*)'(.*)$",
+                          re.IGNORECASE | re.DOTALL)
+FORMAT_PATTERN = re.compile(r"\bFORMAT\s+(?:AS\s+)?(JSON|PARQUET|CSV|AVRO|ORC)\b(?:\s+'([^']*)')?", re.IGNORECASE)
+TIMEFORMAT_PATTERN = re.compile(r"\bTIMEFORMAT\s+(?:AS\s+)?'([^']*)'", re.IGNORECASE)
+JSONPATH_PATTERN = re.compile(r"""^\$(?:\[['"]([^'"]+)['"]\]|\.(\w+))$""")
+
+# (pattern, replacement) applied to the table definitions only
+DDL_REWRITES = [
+    (r",\s*(?:CONSTRAINT\s+\w+\s+)?(?:PRIMARY\s+KEY|UNIQUE|FOREIGN\s+KEY)\s*\([^)]*\)"
+     r"(?:\s*REFERENCES\s+[\w.\"]+\s*(?:\([^)]*\))?)?", ""),
+    (r"\s+PRIMARY\s+KEY\b", ""),
+    (r"\s+UNIQUE\b", ""),
+    (r"\s+REFERENCES\s+[\w.\"]+\s*(?:\([^)]*\))?", ""),
+    (r"\s*\bDISTSTYLE\s+\w+", ""),
+    (r"\s*\b(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)", ""),
+    (r"\s*\bDISTKEY\s*\([^)]*\)", ""),
+    (r"\s+(?:SORTKEY|DISTKEY)\b", ""),
+    (r"\s+ENCODE\s+\w+", ""),
+    (r"\s*\bBACKUP\s+(?:YES|NO)\b", ""),
+    (r"\bVARCHAR\s*\(\s*MAX\s*\)", "VARCHAR"),
+    (r"\bFLOAT\b", "DOUBLE"),
+]
+
+# (pattern, replacement) applied to every statement
+REWRITES = [
+    # ts/1000 is an integer division in Redshift, whole seconds
+    (r"(TIMESTAMP\s+'epoch'\s*\+\s*)\(?\s*([\w.\"]+)\s*/\s*(\d+)\s*\)?(\s*\*\s*INTERVAL\s+'1 second')",
+     r"\1(\2 // \3)\4"),
+    # Cloud Data Warehouse songplay_table_insert: ts to whole seconds
+    (r"to_timestamp\s*\(\s*to_char\s*\(\s*([\w.\"]+)\s*,\s*'9999-99-99 99:99:99'\s*\)\s*,"
+     r"\s*'YYYY-MM-DD HH24:MI:SS'\s*\)", r"date_trunc('second', \1)"),
+    (r"\bpublic\.", ""),
+    (r"\b(?:GETDATE\s*\(\s*\)|SYSDATE\b)", "current_timestamp::TIMESTAMP"),
+]
+
+
+def split_statements(sql):
+    '''
+    Splits a script on the semicolons outside of quotes, drops empty statements
+    '''
+    statements, current, quote = [], [], None
+    for char in sql:
+        if quote:
+            quote = None if char == quote else quote
+        elif char in "'\"":
+            quote = char
+        elif char == ";":
+            statements.append("".join(current))
+            current = []
+            continue
+        current.append(char)
+    statements.append("".join(current))
+    return [statement.strip() for statement in statements if statement.strip()]
+
+
+def unquote(identifier):
+    return identifier.replace('"', "").split(".")[-1].lower()
+
+
+def sequence_name(table, column):
+    return "{}_{}_identity".format(table, column.lower())
+
+
+def translate_ddl(statement):
+    '''
+    Translates a Redshift CREATE TABLE into the DuckDB statements that create it
+    Returns a list of statements: the sequences of the IDENTITY columns, then the table
+    '''
+    table = unquote(CREATE_TABLE_PATTERN.match(statement).group(1))
+    sequences = []
+
+    def identity(match):
+        name = sequence_name(table, match.group(2))
+        seed, step = int(match.group(3)), int(match.group(4))
+        sequences.append("CREATE SEQUENCE IF NOT EXISTS {} START {} INCREMENT {} MINVALUE {}".format(
+            name, seed, step, min(seed, 0)))
+        return "{} DEFAULT nextval('{}')".format(match.group(1), name)
+
+    statement = IDENTITY_PATTERN.sub(identity, statement)
+    for pattern, replacement in DDL_REWRITES:
+        statement = re.sub(pattern, replacement, statement, flags=re.IGNORECASE)
+    return sequences + [statement]
+
+
+def translate(statement):
+    '''
+    Translates one Redshift statement other than COPY into a list of DuckDB statements
+    '''
+    for pattern, replacement in REWRITES:
+        statement = re.sub(pattern, replacement, statement, flags=re.IGNORECASE)
+    if CREATE_TABLE_PATTERN.match(statement):
+        return translate_ddl(statement)
+    return [statement]
+
+
+# COPY
+
+def local_path(url, data):
+    '''
+    Maps s3://<bucket>/<key> to <data>/<key>, a relative local path to <data>/<path>
+    '''
+    match = re.match(r"^s3a?://[^/]+/?(.*)$", url)
+    if match:
+        return os.path.join(data, match.group(1))
+    return url if os.path.isabs(url) else os.path.join(data, url)
+
+
+def source_files(prefix):
+    '''
+    The files whose path starts with prefix, as COPY loads every object under a key prefix.
+    Hidden files and files starting with an underscore (_SUCCESS, _generator.json) are skipped.
+    '''
+    files = []
+    for path in sorted(glob.glob(glob.escape(prefix) + "*")):
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names) if name[0] not in "._")
+        elif os.path.basename(path)[0] not in "._":
+            files.append(path)
+    return files
+
+
+def sql_literal(value):
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def value_expression(expression, data_type, timeformat=None):
+    '''
+    Converts a VARCHAR value read from the source to the column type, NULL when it does not convert
+    '''
+    data_type = data_type.upper()
+    number = "TRY_CAST({} AS DOUBLE)".format(expression)
+    if data_type == "VARCHAR":
+        return expression
+    if data_type.startswith("TIMESTAMP") and timeformat:
+        if timeformat.lower() == "epochmillisecs":
+            return "epoch_ms(TRY_CAST({} AS BIGINT))".format(number)
+        if timeformat.lower() == "epochsecs":
+            return "make_timestamp(TRY_CAST({} * 1000000 AS BIGINT))".format(number)
+        if timeformat.lower() != "auto":
+            return "TRY_STRPTIME({}, {})".format(expression, sql_literal(redshift_time_format(timeformat)))
+    if data_type in ("TINYINT", "SMALLINT", "INTEGER", "BIGINT", "HUGEINT"):
+        # integers written as floats, like the registration of the log data
+        return "coalesce(TRY_CAST({0} AS {1}), TRY_CAST({2} AS {1}))".format(expression, data_type, number)
+    return "TRY_CAST({} AS {})".format(expression, data_type)
+
+
+def redshift_time_format(timeformat):
+    for redshift, strftime in [("YYYY", "%Y"), ("MM", "%m"), ("DD", "%d"), ("HH24", "%H"), ("HH", "%H"),
+                               ("MI", "%M"), ("SS", "%S")]:
+        timeformat = timeformat.replace(redshift, strftime)
+    return timeformat
+
+
+def read_jsonpaths(path):
+    '''
+    Top-level field names of a JSONPaths file, in column order
+    '''
+    with open(path) as f:
+        jsonpaths = json.load(f)["jsonpaths"]
+    fields = []
+    for jsonpath in jsonpaths:
+        match = JSONPATH_PATTERN.match(jsonpath.strip())
+        if not match:
+            raise ValueError("Only top-level JSONPath expressions are supported: {}".format(jsonpath))
+        fields.append(match.group(1) or match.group(2))
+    return fields
+
+
+def first_record_keys(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                return list(json.loads(line))
+    return []
+
+
+class Connection:
+    """
+    A DuckDB database that executes Redshift SQL, with the psycopg2 connection
+    methods the project scripts use
+    """
+
+    def __init__(self, data=".", database=":memory:"):
+        self.data = os.path.abspath(data)
+        self.db = duckdb.connect(database)
+        self.db.execute("SET TimeZone = 'UTC'")
+        self.last_copy_count = 0
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        # every statement runs in its own DuckDB transaction
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.db.close()
+
+    def columns(self, table):
+        '''
+        (name, type, is identity) of the columns of table, in order
+        '''
+        rows = self.db.execute("SELECT column_name, data_type, column_default FROM duckdb_columns() "
+                               "WHERE table_name = ? ORDER BY column_index", [table]).fetchall()
+        if not rows:
+            raise ValueError("Table {} does not exist".format(table))
+        return [(name, data_type, (default or "").startswith("nextval(")) for name, data_type, default in rows]
+
+    def copy(self, match):
+        '''
+        Runs a COPY as an INSERT ... SELECT from the local files, returns the number of rows loaded
+        '''
+        table, column_list, source, options = match.groups()
+        table = unquote(table)
+        columns = [(name, data_type) for name, data_type, is_identity in self.columns(table) if not is_identity]
+        if column_list:
+            types = {name.lower(): data_type for name, data_type in columns}
+            columns = [(unquote(name.strip()), types[unquote(name.strip())]) for name in column_list.split(",")]
+
+        files = source_files(local_path(source, self.data))
+        if not files:
+            raise ValueError("COPY {}: no files match {}".format(table, local_path(source, self.data)))
+        file_list = "[{}]".format(", ".join(sql_literal(path) for path in files))
+
+        format_match = FORMAT_PATTERN.search(options)
+        file_format = format_match.group(1).upper() if format_match else "JSON"
+        timeformat = TIMEFORMAT_PATTERN.search(options)
+        timeformat = timeformat.group(1) if timeformat else None
+
+        if file_format == "PARQUET":
+            names = [row[0] for row in self.db.execute(
+                "DESCRIBE SELECT * FROM read_parquet({})".format(file_list)).fetchall()]
+            if len(names) != len(columns):
+                raise ValueError("COPY {}: {} columns in the parquet files, {} in the table".format(
+                    table, len(names), len(columns)))
+            values = [value_expression('"{}"'.format(field), data_type)
+                      for field, (_, data_type) in zip(names, columns)]
+            source_sql = "read_parquet({})".format(file_list)
+        elif file_format == "JSON":
+            fields = self.json_fields(table, columns, (format_match.group(2) if format_match else None) or "auto",
+                                      files[0])
+            # read everything as VARCHAR and convert like COPY does
+            field_types = ", ".join("{}: 'VARCHAR'".format(sql_literal(field)) for field in set(fields))
+            values = [value_expression('"{}"'.format(field.replace('"', '""')), data_type, timeformat)
+                      for field, (_, data_type) in zip(fields, columns)]
+            source_sql = "read_json({}, format = 'auto', columns = {{{}}})".format(file_list, field_types)
+        else:
+            raise ValueError("COPY {}: FORMAT AS {} is not supported".format(table, file_format))
+
+        loaded, = self.db.execute("INSERT INTO {} ({}) SELECT {} FROM {}".format(
+            table, ", ".join('"{}"'.format(name) for name, _ in columns), ", ".join(values), source_sql)).fetchone()
+        self.last_copy_count = loaded
+        return loaded
+
+    def json_fields(self, table, columns, option, first_file):
+        '''
+        The JSON field of each column: by name for 'auto', by position for a JSONPaths file
+        '''
+        if option.lower() == "auto":
+            # Redshift matches 'auto' case-sensitively and its column names are lower case
+            return [name.lower() for name, _ in columns]
+        if option.lower() == "auto ignorecase":
+            keys = {key.lower(): key for key in first_record_keys(first_file)}
+            return [keys.get(name.lower(), name.lower()) for name, _ in columns]
+
+        jsonpaths = local_path(option, self.data)
+        if not os.path.exists(jsonpaths):
+            raise ValueError("COPY {}: JSONPaths file {} not found".format(table, jsonpaths))
+        fields = read_jsonpaths(jsonpaths)
+        if len(fields) != len(columns):
+            raise ValueError("COPY {}: {} JSONPaths expressions for {} columns".format(
+                table, len(fields), len(columns)))
+        return fields
+
+    def execute(self, query, params=None):
+        '''
+        Translates and runs a Redshift statement or script
+        Returns the rows of the last statement and the number of rows it changed (-1 if unknown)
+        '''
+        rows, rowcount = [], -1
+        if params is not None:
+            query = query.replace("%s", "?")
+        for statement in split_statements(query):
+            statement = re.sub(r"\bpg_last_copy_count\s*\(\s*\)", str(self.last_copy_count), statement,
+                               flags=re.IGNORECASE)
+            copy_match = COPY_PATTERN.match(statement)
+            if copy_match:
+                rows, rowcount = [], self.copy(copy_match)
+                continue
+
+            for translated in translate(statement):
+                result = self.db.execute(translated, params) if params is not None else self.db.execute(translated)
+                rows = result.fetchall() if result.description else []
+            if re.match(r"^\s*(INSERT|UPDATE|DELETE)\b", statement, re.IGNORECASE):
+                # DuckDB returns the number of changed rows as the result
+                rows, rowcount = [], rows[0][0] if rows else 0
+            else:
+                rowcount = len(rows) if result.description else -1
+
+            drop_match = DROP_TABLE_PATTERN.match(statement)
+            if drop_match:
+                table = unquote(drop_match.group(1))
+                for name, in self.db.execute("SELECT sequence_name FROM duckdb_sequences() WHERE sequence_name "
+                                             "LIKE ? ESCAPE '\\'", [table.replace("_", "\\_") + "\\_%\\_identity"]
+                                             ).fetchall():
+                    self.db.execute("DROP SEQUENCE IF EXISTS {}".format(name))
+        return rows, rowcount
+
+
+class Cursor:
+    """
+    psycopg2-like cursor of a Connection
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.rowcount = -1
+
+    def execute(self, query, params=None):
+        self.rows, self.rowcount = self.connection.execute(query, params)
+        self.rows = list(self.rows)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self.rows = []
+
+
+def connect(data=".", database=":memory:"):
+    '''
+    Opens a DuckDB warehouse
+    Parameters:
+        - data      : local directory standing in for the S3 buckets of the COPY statements
+        - database  : DuckDB database file, in memory by default
+    '''
+    return Connection(data, database)
+
+
+# PROJECTS
+
+CLOUD_DIRECTORY = os.path.join(REPO_ROOT, "Cloud Data Warehouse")
+AIRFLOW_DIRECTORY = os.path.join(REPO_ROOT, "Data Pipelines with Airflow")
+
+# the staging and load tasks of the Airflow DAG: table, s3_key of the pre-staged parquet and SqlQueries attribute
+AIRFLOW_STAGING = [("staging_events", "prestaged/airflow/staging_events/part-"),
+                   ("staging_songs", "prestaged/airflow/staging_songs/part-")]
+AIRFLOW_INSERTS = [("songplays", "songplay_table_insert"), ("users", "user_table_insert"),
+                   ("songs", "song_table_insert"), ("artists", "artist_table_insert"),
+                   ("time", "time_table_insert")]
+
+
+def import_project(directory, *modules):
+    '''
+    Imports modules of a project directory, from that directory since sql_queries.py reads dwh.cfg
+    '''
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        return [__import__(module) for module in modules]
+    finally:
+        os.chdir(cwd)
+
+
+def run_cloud(conn):
+    '''
+    Runs create_tables.py and etl.py of the Cloud Data Warehouse project, after pre-staging
+    the JSON of the data directory as the parquet its COPY statements read
+    Returns the number of rows of the songplay table
+    '''
+    from sparkify import prestage
+
+    prestage.prestage(conn.data, "cloud")
+    create_tables, etl = import_project(CLOUD_DIRECTORY, "create_tables", "etl")
+    cur = conn.cursor()
+    create_tables.drop_tables(cur, conn)
+    create_tables.create_tables(cur, conn)
+    etl.load_staging_tables(cur, conn)
+    etl.insert_tables(cur, conn)
+    cur.execute("SELECT count(*) FROM songplay")
+    return cur.fetchone()[0]
+
+
+def run_airflow(conn):
+    '''
+    Runs the tasks of the Airflow DAG: create_tables.sql, the COPY of StageToRedshiftOperator
+    from the pre-staged parquet and the INSERT INTO <table> SqlQueries of the load operators
+    Returns the number of rows of the songplays table
+    '''
+    from sparkify import prestage
+
+    sys.path.insert(0, os.path.join(AIRFLOW_DIRECTORY, "plugins"))
+    from helpers import SqlQueries
+
+    prestage.prestage(conn.data, "airflow")
+    cur = conn.cursor()
+    with open(os.path.join(AIRFLOW_DIRECTORY, "create_tables.sql")) as f:
+        create_sql = f.read()
+    for statement in split_statements(create_sql):
+        cur.execute("DROP TABLE IF EXISTS {}".format(CREATE_TABLE_PATTERN.match(statement).group(1)))
+    cur.execute(create_sql)
+
+    for table, s3_key in AIRFLOW_STAGING:
+        with metrics.stage("warehouse.copy", table=table) as record:
+            cur.execute("COPY {} FROM 's3://sparkify-prestaged/{}' FORMAT AS PARQUET".format(table, s3_key))
+            record.rows += cur.rowcount
+    for table, query in AIRFLOW_INSERTS:
+        with metrics.stage("warehouse.insert", table=table) as record:
+            cur.execute("INSERT INTO {} {}".format(table, getattr(SqlQueries, query)))
+            record.rows += max(cur.rowcount, 0)
+
+    cur.execute("SELECT count(*) FROM songplays")
+    return cur.fetchone()[0]
+
+
+PROJECTS = {
+    "cloud": run_cloud,
+    "airflow": run_airflow
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Redshift queries on an embedded DuckDB warehouse")
+    parser.add_argument("--data", default="data/generated", help="directory with song_data/ and log_data/")
+    parser.add_argument("--project", choices=sorted(PROJECTS), default="cloud")
+    parser.add_argument("--database", default=":memory:", help="DuckDB database file")
+    parser.add_argument("--sql", action="append", default=[], help="query to run after the load, repeatable")
+    args = parser.parse_args()
+
+    conn = connect(args.data, args.database)
+    start = time.time()
+    songplays = PROJECTS[args.project](conn)
+    print("{} loaded in {:.2f}s, {} songplays".format(args.project, time.time() - start, songplays))
+
+    cur = conn.cursor()
+    for table, in conn.db.execute("SELECT table_name FROM duckdb_tables() ORDER BY table_name").fetchall():
+        cur.execute("SELECT count(*) FROM {}".format(table))
+        print("{:>12}  {}".format(cur.fetchone()[0], table))
+    for query in args.sql:
+        start = time.time()
+        cur.execute(query)
+        rows = cur.fetchall()
+        print("{} ({} rows, {:.3f}s)".format(query, len(rows), time.time() - start))
+        for row in rows[:20]:
+            print("    {}".format(row))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()